@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+"""
+benchmarks
+~~~~~~~~~~
+
+Benchmarks for the nightshades data layer. These seed a large amount of data,
+so point ``NIGHTSHADES_POSTGRESQL_DB_URI`` at a throwaway database.
+"""
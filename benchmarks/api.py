@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+'''Time the nightshades.api functions against a seeded dataset and print the
+results as JSON, to be saved and diffed between versions.
+
+    $ NIGHTSHADES_POSTGRESQL_DB_URI='postgresqlext:///nightshades_bench' \\
+        python -m benchmarks.api --users 100 --units 1000 --tags 20 > before.json
+'''
+import sys
+import time
+import json
+import random
+import argparse
+import datetime
+import subprocess
+from contextlib import contextmanager
+
+import peewee
+
+import nightshades
+from nightshades import api
+from nightshades.models import db, Unit
+
+from . import seed
+
+
+@contextmanager
+def count_queries():
+    '''Count the statements sent to postgres within the block. Everything in
+    nightshades.api goes through ``db.execute_sql``.
+    '''
+    counter = [0]
+    execute_sql = db.execute_sql
+
+    def counted(*args, **kwargs):
+        counter[0] += 1
+        return execute_sql(*args, **kwargs)
+
+    db.execute_sql = counted
+    try:
+        yield counter
+    finally:
+        del db.execute_sql
+
+
+def percentile(values, p):
+    '''The nearest-rank percentile of sorted values.'''
+    index = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(timings, queries, elapsed):
+    ms = sorted(t * 1000 for t in timings)
+    return {
+        'calls': len(ms),
+        'p50_ms': percentile(ms, 50),
+        'p95_ms': percentile(ms, 95),
+        'p99_ms': percentile(ms, 99),
+        'max_ms': ms[-1],
+        'queries_per_call': queries / float(len(ms)),
+        'calls_per_second': len(ms) / elapsed,
+    }
+
+
+def measure(setup, call, iterations):
+    '''Run ``call(setup())`` ``iterations`` times, timing and counting the
+    queries of only the call.
+    '''
+    timings = []
+    queries = 0
+    elapsed = 0
+    for i in range(iterations):
+        arg = setup(i)
+        with count_queries() as counter:
+            start = time.perf_counter()
+            call(arg)
+            took = time.perf_counter() - start
+
+        timings.append(took)
+        queries += counter[0]
+        elapsed += took
+
+    return summarize(timings, queries, elapsed)
+
+
+def cancel_ongoing(user_id):
+    try:
+        api.cancel_ongoing_unit(user_id)
+    except peewee.DoesNotExist:
+        pass
+
+
+def create_completable_unit(user_id):
+    '''A unit that has just reached its expiry_time.'''
+    cancel_ongoing(user_id)
+    return Unit.create(
+        user        = user_id,
+        start_time  = peewee.SQL("NOW() - INTERVAL '25 minutes 1 second'"),
+        expiry_time = peewee.SQL("NOW() - INTERVAL '1 second'")).id
+
+
+def scenarios(user_ids, unit_ids, rand):
+    '''Each scenario is a name, a setup function taking the iteration number
+    (not timed) and the call to time, which takes what setup returned.
+    '''
+    def user(i):
+        return user_ids[i % len(user_ids)]
+
+    def ongoing_user(i):
+        user_id = user(i)
+        if not api.has_ongoing_unit(user_id):
+            api.start_unit(user_id)
+
+        api.invalidate_ongoing_unit(user_id)
+        return user_id
+
+    def idle_user(i):
+        user_id = user(i)
+        cancel_ongoing(user_id)
+        return user_id
+
+    now    = datetime.datetime.now(datetime.timezone.utc)
+    week   = now - datetime.timedelta(days = 7)
+    tagged = ','.join('tag-{}'.format(n) for n in range(3))
+
+    return (
+        ('start_unit', idle_user, api.start_unit),
+        ('mark_complete', lambda i: create_completable_unit(user(i)),
+            api.mark_complete),
+        ('set_tags', lambda i: rand.choice(unit_ids),
+            lambda unit_id: api.set_tags(unit_id, tagged)),
+        ('get_unit', lambda i: rand.choice(unit_ids), api.get_unit),
+        ('get_units', user,
+            lambda user_id: list(api.get_units(user_id, week, now))),
+        ('get_units_page', user,
+            lambda user_id: list(api.get_units(
+                user_id, now - datetime.timedelta(days = 365), now,
+                limit = 100))),
+        ('get_ongoing_unit', ongoing_user, api.get_ongoing_unit),
+        ('get_ongoing_unit_cached', user,
+            lambda user_id: api.has_ongoing_unit(user_id)),
+        ('login_via_provider',
+            lambda i: seed.name_prefix + str(i % len(user_ids) + 1),
+            lambda puid: api.login_via_provider(seed.provider, puid)),
+    )
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr = subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--users', type = int, default = 100)
+    parser.add_argument('--units', type = int, default = 1000,
+                        help = 'units per user')
+    parser.add_argument('--tags', type = int, default = 20,
+                        help = 'tag names per user')
+    parser.add_argument('--tags-per-unit', type = int, default = 2)
+    parser.add_argument('--iterations', type = int, default = 500)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--only', nargs = '*',
+                        help = 'names of the scenarios to run')
+    args = parser.parse_args()
+
+    user_ids = seed.seed(args.users, args.units, args.tags, args.tags_per_unit)
+    try:
+        rand     = random.Random(args.seed)
+        unit_ids = [unit_id for (unit_id,) in Unit.select(Unit.id).where(
+            Unit.user << user_ids
+        ).order_by(Unit.id).tuples()]
+
+        results = {}
+        for name, setup, call in scenarios(user_ids, unit_ids, rand):
+            if args.only and name not in args.only:
+                continue
+
+            print('Running {}'.format(name), file = sys.stderr)
+            results[name] = measure(setup, call, args.iterations)
+
+        print(json.dumps({
+            'version': nightshades.__version__,
+            'git_revision': git_revision(),
+            'dataset': {
+                'users': args.users,
+                'units_per_user': args.units,
+                'tags_per_user': args.tags,
+                'tags_per_unit': args.tags_per_unit,
+            },
+            'iterations': args.iterations,
+            'seed': args.seed,
+            'results': results,
+        }, indent = 2, sort_keys = True))
+    finally:
+        seed.clear()
+
+
+if __name__ == '__main__':
+    main()
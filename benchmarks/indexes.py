@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+'''Compare query plans and latency of the ongoing unit and date range queries
+with and without the units indexes.
+
+    $ NIGHTSHADES_POSTGRESQL_DB_URI='postgresqlext:///nightshades_bench' \\
+        python -m benchmarks.indexes --users 1000 --units 1000
+'''
+import argparse
+import datetime
+import json
+import random
+
+from nightshades import api
+from nightshades.models import db
+
+from . import seed
+
+indexes = (
+    'units_user_id_start_time_id',
+    'units_incomplete_user_id_expiry_time',
+)
+
+
+def plan_nodes(plan):
+    nodes = [plan['Node Type'] + (' on ' + plan['Index Name']
+                                  if 'Index Name' in plan else '')]
+    for child in plan.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+
+    return nodes
+
+
+def explain(query):
+    sql, params = query.sql()
+    cursor = db.execute_sql('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params)
+    res = cursor.fetchone()[0][0]
+    return {
+        'execution_ms': res['Execution Time'],
+        'plan': plan_nodes(res['Plan']),
+    }
+
+
+def scenarios(user_ids, samples):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    picked = random.Random(0).sample(user_ids, min(samples, len(user_ids)))
+
+    def run(name, make_query):
+        results = [explain(make_query(user_id)) for user_id in picked]
+        times = sorted(r['execution_ms'] for r in results)
+        return name, {
+            'median_ms': times[len(times) // 2],
+            'max_ms': times[-1],
+            'plan': results[0]['plan'],
+        }
+
+    return dict((
+        run('query_ongoing_unit', api.query_ongoing_unit),
+        run('get_units', lambda user_id: api.get_units(
+            user_id, now - datetime.timedelta(days = 1), now)),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--users', type = int, default = 1000)
+    parser.add_argument('--units', type = int, default = 1000)
+    parser.add_argument('--samples', type = int, default = 50)
+    args = parser.parse_args()
+
+    user_ids = seed.seed(args.users, args.units)
+    try:
+        report = {}
+        report['with_indexes'] = scenarios(user_ids, args.samples)
+
+        # Dropping inside a transaction that is rolled back leaves the
+        # indexes untouched afterwards.
+        with db.atomic() as trans:
+            for index in indexes:
+                db.execute_sql('DROP INDEX IF EXISTS {}'.format(index))
+
+            report['without_indexes'] = scenarios(user_ids, args.samples)
+            trans.rollback()
+
+        print(json.dumps(report, indent = 2))
+    finally:
+        seed.clear()
+
+
+if __name__ == '__main__':
+    main()
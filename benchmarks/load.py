@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+'''Drive a running nightshades HTTP server (run.py or run_asgi.py) with many
+concurrent virtual users and print per-route latency histograms and error
+rates as JSON.
+
+Each virtual user is a seeded user logged in with a JWT cookie signed with
+the app's secret key, so the server must use the same database and
+``NIGHTSHADES_APP_SECRET``.
+
+    $ python -m benchmarks.load --url http://localhost:5000 \\
+        --users 50 --duration 60 --mix me=2,index=5,create=1,update=1,cancel=1
+'''
+import sys
+import json
+import time
+import bisect
+import random
+import argparse
+import itertools
+import threading
+import http.client
+from urllib.parse import urlsplit
+
+import jwt
+
+from nightshades import api
+from nightshades.http import app
+
+from . import seed
+from .api import percentile
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+buckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+routes = {
+    'me': 'GET /v1/me',
+    'index': 'GET /v1/units',
+    'create': 'POST /v1/units',
+    'update': 'PATCH /v1/units/<uuid>',
+    'cancel': 'DELETE /v1/units',
+}
+
+default_mix = 'me=2,index=5,create=1,update=1,cancel=1'
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in routes:
+            raise ValueError('Unknown route {}, expected one of {}'.format(
+                name, ', '.join(sorted(routes))))
+
+        weights[name] = float(weight or 1)
+        if weights[name] < 0:
+            raise ValueError('Weight of {} must not be negative'.format(name))
+
+    if not sum(weights.values()) > 0:
+        raise ValueError('At least one route needs a positive weight')
+
+    return weights
+
+
+class Stats(object):
+    '''Latencies and outcomes per route, shared by all virtual users.'''
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.timings = dict((route, []) for route in routes.values())
+        self.status  = dict((route, {}) for route in routes.values())
+
+    def record(self, route, seconds, status):
+        with self.lock:
+            self.timings[route].append(seconds * 1000)
+            counts = self.status[route]
+            counts[status] = counts.get(status, 0) + 1
+
+    def histogram(self, ms):
+        counts = [0] * (len(buckets) + 1)
+        for value in ms:
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+
+        labels = ['le_{}'.format(bound) for bound in buckets] + ['le_inf']
+        return dict(zip(labels, counts))
+
+    def report(self, elapsed):
+        routes_report = {}
+        for route, ms in self.timings.items():
+            if not ms:
+                continue
+
+            ms     = sorted(ms)
+            status = self.status[route]
+            errors = sum(n for s, n in status.items()
+                         if s == 'error' or s >= 500)
+            client = sum(n for s, n in status.items()
+                         if s != 'error' and 400 <= s < 500)
+
+            routes_report[route] = {
+                'requests': len(ms),
+                'p50_ms': percentile(ms, 50),
+                'p95_ms': percentile(ms, 95),
+                'p99_ms': percentile(ms, 99),
+                'max_ms': ms[-1],
+                'error_rate': errors / float(len(ms)),
+                'client_error_rate': client / float(len(ms)),
+                'status': dict((str(s), n) for s, n in status.items()),
+                'histogram_ms': self.histogram(ms),
+            }
+
+        total = sum(len(ms) for ms in self.timings.values())
+        return {
+            'elapsed_seconds': elapsed,
+            'requests': total,
+            'requests_per_second': total / elapsed,
+            'routes': routes_report,
+        }
+
+
+class VirtualUser(threading.Thread):
+    '''Picks routes by weight, keeping track of its ongoing unit so that it
+    only updates or cancels a unit it has and only starts one when it has
+    none.
+    '''
+    def __init__(self, url, user_id, ongoing, weights, stats, deadline, rand):
+        threading.Thread.__init__(self, daemon = True)
+        self.url      = urlsplit(url)
+        self.stats    = stats
+        self.deadline = deadline
+        self.rand     = rand
+        self.names    = list(weights)
+        # Cumulative weights, for bisecting (random.choices is 3.6+).
+        self.cumulative = list(itertools.accumulate(
+            weights[name] for name in self.names))
+        self.conn     = None
+        self.ongoing  = ongoing
+
+        token = jwt.encode({ 'user_id': str(user_id) }, app.secret_key,
+                           algorithm = 'HS256')
+        self.cookie = 'jwt={}'.format(token.decode('ascii'))
+
+    def connect(self):
+        cls = (http.client.HTTPSConnection if self.url.scheme == 'https'
+               else http.client.HTTPConnection)
+        self.conn = cls(self.url.netloc, timeout = 30)
+
+    def request(self, name, method, path, payload = None):
+        headers = { 'Cookie': self.cookie }
+        body    = None
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.connect()
+
+            self.conn.request(method, self.url.path.rstrip('/') + path,
+                              body, headers)
+            res  = self.conn.getresponse()
+            data = res.read()
+            status = res.status
+
+            # The development server doesn't keep connections alive.
+            if res.getheader('Connection', '').lower() == 'close' or \
+                    res.version == 10:
+                self.conn.close()
+                self.conn = None
+        except (OSError, http.client.HTTPException):
+            data, status = None, 'error'
+            self.conn = None
+
+        self.stats.record(routes[name], time.perf_counter() - start, status)
+        if status in (200, 201) and data:
+            return json.loads(data.decode('utf-8'))
+
+    def choose(self):
+        point = self.rand.random() * self.cumulative[-1]
+        name  = self.names[bisect.bisect(self.cumulative, point)]
+        if name == 'create' and self.ongoing:
+            return 'cancel'
+        if name in ('update', 'cancel') and not self.ongoing:
+            return 'create'
+
+        return name
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            name = self.choose()
+            if name == 'me':
+                self.request(name, 'GET', '/v1/me')
+            elif name == 'index':
+                self.request(name, 'GET', '/v1/units')
+            elif name == 'create':
+                res = self.request(name, 'POST', '/v1/units', {
+                    'data': {
+                        'type': 'unit',
+                        'attributes': { 'description': 'load test' },
+                    }
+                })
+                self.ongoing = res and res['data']['id']
+            elif name == 'update':
+                tags = ','.join(self.rand.sample(
+                    ['focus', 'reading', 'writing', 'email', 'review'], 2))
+                path = '/v1/units/{}'.format(self.ongoing)
+                self.request(name, 'PATCH', path, {
+                    'data': { 'type': 'unit', 'attributes': { 'tags': tags } }
+                })
+            elif name == 'cancel':
+                self.request(name, 'DELETE', '/v1/units')
+                self.ongoing = None
+
+
+def ongoing_unit_id(user_id):
+    try:
+        return str(api.get_ongoing_unit(user_id)['id'])
+    except api.NoOngoingUnit:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--url', default = 'http://localhost:5000')
+    parser.add_argument('--users', type = int, default = 50,
+                        help = 'concurrent virtual users')
+    parser.add_argument('--units', type = int, default = 100,
+                        help = 'units seeded per user')
+    parser.add_argument('--duration', type = float, default = 30,
+                        help = 'seconds to run for')
+    parser.add_argument('--mix', default = default_mix,
+                        help = 'relative weights of {}'.format(
+                            ', '.join(sorted(routes))))
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    if not app.secret_key:
+        parser.error('NIGHTSHADES_APP_SECRET must be set')
+
+    user_ids = seed.seed(args.users, args.units)
+    try:
+        stats    = Stats()
+        deadline = time.monotonic() + args.duration
+        users    = [
+            VirtualUser(args.url, user_id, ongoing_unit_id(user_id), weights,
+                        stats, deadline, random.Random(args.seed + i))
+            for i, user_id in enumerate(user_ids)
+        ]
+
+        print('Running {} virtual users for {}s'.format(
+            len(users), args.duration), file = sys.stderr)
+        start = time.monotonic()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+
+        report = stats.report(time.monotonic() - start)
+        report['mix'] = weights
+        report['users'] = args.users
+        print(json.dumps(report, indent = 2, sort_keys = True))
+    finally:
+        seed.clear()
+
+
+if __name__ == '__main__':
+    main()
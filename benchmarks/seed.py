@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from nightshades import rollups
+from nightshades.models import db
+
+# Every seeded user's name starts with this so seeded data can be found (and
+# removed) without touching anything else in the database.
+name_prefix = 'benchmark-'
+
+# Seeded users log in through this provider, with their name as their ID.
+provider = 'twitter'
+
+
+def seed(users = 100, units_per_user = 1000, tags_per_user = 0,
+         tags_per_unit = 0):
+    '''Seed ``users`` users with ``units_per_user`` units each. Units are
+    spaced 30 minutes apart going back from now. Each user's most recent unit
+    is ongoing, every tenth unit is incomplete (expired) and the rest are
+    complete.
+
+    Each user gets ``tags_per_user`` tag names, and each unit the
+    ``tags_per_unit`` of them following its position, so the same arguments
+    always seed the same data.
+
+    :return: list of the seeded user IDs
+    '''
+    tags_per_unit = min(tags_per_unit, tags_per_user)
+
+    with db.atomic():
+        cursor = db.execute_sql('''
+            INSERT INTO users (name)
+            SELECT %s || g FROM generate_series(1, %s) g
+            RETURNING id
+        ''', (name_prefix, users))
+        user_ids = [row[0] for row in cursor.fetchall()]
+
+        db.execute_sql('''
+            INSERT INTO login_providers (user_id, provider, provider_user_id)
+            SELECT id, %s, name FROM users WHERE id = ANY(%s::uuid[])
+        ''', (provider, list(map(str, user_ids))))
+
+        db.execute_sql('''
+            INSERT INTO units (user_id, completed, start_time, expiry_time)
+            SELECT
+                u,
+                g > 0 AND g %% 10 <> 0,
+                NOW() - g * INTERVAL '30 minutes',
+                NOW() - g * INTERVAL '30 minutes' + INTERVAL '25 minutes'
+            FROM unnest(%s::uuid[]) u, generate_series(0, %s - 1) g
+        ''', (list(map(str, user_ids)), units_per_user))
+
+        if tags_per_unit > 0:
+            seed_tags(user_ids, tags_per_user, tags_per_unit)
+
+    rollups.backfill(user_ids)
+    db.execute_sql('ANALYZE')
+    return user_ids
+
+
+def seed_tags(user_ids, tags_per_user, tags_per_unit):
+    user_ids = list(map(str, user_ids))
+    db.execute_sql('''
+        INSERT INTO tag_names (user_id, name)
+        SELECT u, 'tag-' || g
+        FROM unnest(%s::uuid[]) u, generate_series(0, %s - 1) g
+    ''', (user_ids, tags_per_user))
+
+    # Units are numbered by start_time within each user.
+    db.execute_sql('''
+        WITH numbered AS (
+            SELECT id, user_id, row_number() OVER (
+                PARTITION BY user_id ORDER BY start_time
+            ) AS n
+            FROM units
+            WHERE user_id = ANY(%(user_ids)s::uuid[])
+        )
+        INSERT INTO tags (unit_id, tag_name_id)
+        SELECT numbered.id, tag_names.id
+        FROM numbered
+        CROSS JOIN generate_series(0, %(per_unit)s - 1) k
+        JOIN tag_names
+          ON tag_names.user_id = numbered.user_id
+         AND tag_names.name = 'tag-' || ((numbered.n + k) %% %(per_user)s)
+    ''', dict(user_ids = user_ids, per_unit = tags_per_unit,
+              per_user = tags_per_user))
+
+
+def clear():
+    '''Delete all seeded users, and by cascade their units and tags.'''
+    db.execute_sql('DELETE FROM users WHERE name LIKE %s', (name_prefix + '%',))
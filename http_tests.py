@@ -1,4 +1,10 @@
+import io
 import os
+import csv
+import json
+import time
+import cProfile
+import tempfile
 import unittest
 import datetime
 from unittest.mock import patch
@@ -14,7 +20,16 @@ from flask.ext.testing import TestCase
 from peewee import SQL
 
 import nightshades.http
+import nightshades.profiling
 from nightshades.models import User, LoginProvider, Unit, Tag
+from test_helpers import create_tag, tag_names, max_queries, run
+
+try:
+    import asyncio
+    from nightshades import aio, asgi
+except (ImportError, SyntaxError):
+    # They need Python 3.5+ and requirements.aio.txt
+    asgi = None
 
 
 def mock_authenticate_start(provider, redirect_url, params, token_secret, token_cookie):
@@ -178,13 +193,61 @@ class TestEndpoints(TestAPIv1):
         self.client.set_cookie('localhost', 'jwt', token)
 
 
+class TestTokenCache(TestAPIv1):
+    def setUp(self):
+        self.user = User.create(name = 'Alice')
+        nightshades.tokens.token_cache.entries.clear()
+
+    def test_decoded_once(self):
+        token = jwt.encode({ 'user_id': str(self.user.id) }, 'sekret')
+        self.client.set_cookie('localhost', 'jwt', token)
+
+        with patch('jwt.decode', wraps = jwt.decode) as decode:
+            self.assertStatus(self.client.get(url_for('api.v1.me')), 200)
+            self.assertStatus(self.client.get(url_for('api.v1.me')), 200)
+            self.assertEqual(decode.call_count, 1)
+
+    def test_invalid_token(self):
+        self.client.set_cookie('localhost', 'jwt', 'foobar')
+        res = self.client.get(url_for('api.v1.me'))
+        self.assertStatus(res, 401)
+        self.assertEqual(res.json['errors'][0]['title'], 'Invalid Authorization token')
+
+    def test_expired_token(self):
+        exp   = datetime.datetime.utcnow() - datetime.timedelta(seconds = 1)
+        token = jwt.encode({ 'user_id': str(self.user.id), 'exp': exp }, 'sekret')
+        self.client.set_cookie('localhost', 'jwt', token)
+
+        self.assertStatus(self.client.get(url_for('api.v1.me')), 401)
+        self.assertFalse(nightshades.tokens.token_cache.entries)
+
+
 class TestMe(TestEndpoints):
     def test_me(self):
         res = self.client.get(url_for('api.v1.me'))
         self.assertStatus(res, 200)
         self.assertEqual(res.json['data']['attributes']['name'], 'Alice')
+        self.assertEqual(res.json['data']['attributes']['timezone'], 'UTC')
         self.assertEqual(res.json['data']['type'], 'user')
 
+    def patch_me(self, attributes):
+        payload = { 'data': { 'type': 'user', 'attributes': attributes } }
+        return self.client.patch(
+            url_for('api.v1.update_me'),
+            data = dumps(payload),
+            content_type = 'application/json'
+        )
+
+    def test_update_timezone(self):
+        res = self.patch_me({ 'timezone': 'America/Toronto' })
+        self.assertStatus(res, 200)
+        self.assertEqual(res.json['data']['attributes']['timezone'], 'America/Toronto')
+
+    def test_update_invalid_timezone(self):
+        res = self.patch_me({ 'timezone': 'Nowhere' })
+        self.assertStatus(res, 400)
+        self.assertEqual(res.json['errors'][0]['title'], 'Invalid timezone')
+
 
 class TestIndexUnits(TestEndpoints):
     def test_index_units(self):
@@ -204,6 +267,81 @@ class TestIndexUnits(TestEndpoints):
         self.assertEqual(ret[1]['id'], str(b.id))
 
 
+    def test_index_units_paginated(self):
+        units = [Unit.create(
+            user        = self.user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '%s days'", days),
+            expiry_time = SQL("NOW() - INTERVAL '%s days' + INTERVAL '25 minutes'", days)
+        ) for days in (1, 2, 3)]
+
+        url = url_for('api.v1.index_units', **{
+            'filter[from]': (datetime.datetime.now() - datetime.timedelta(days = 7)).isoformat(),
+            'filter[to]': datetime.datetime.now().isoformat(),
+            'page[size]': 2,
+        })
+        res = self.client.get(url)
+        self.assertStatus(res, 200)
+        self.assertEqual([u['id'] for u in res.json['data']],
+                         [str(units[0].id), str(units[1].id)])
+
+        res = self.client.get(res.json['links']['next'])
+        self.assertStatus(res, 200)
+        self.assertEqual([u['id'] for u in res.json['data']], [str(units[2].id)])
+        self.assertNotIn('next', res.json['links'])
+
+    def test_index_units_next_after_deleted_unit(self):
+        units = [Unit.create(
+            user        = self.user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '%s days'", days),
+            expiry_time = SQL("NOW() - INTERVAL '%s days' + INTERVAL '25 minutes'", days)
+        ) for days in (1, 2, 3)]
+
+        url = url_for('api.v1.index_units', **{
+            'filter[from]': (datetime.datetime.now() - datetime.timedelta(days = 7)).isoformat(),
+            'filter[to]': datetime.datetime.now().isoformat(),
+            'page[size]': 1,
+        })
+        res = self.client.get(url)
+        units[0].delete_instance()
+
+        res = self.client.get(res.json['links']['next'])
+        self.assertStatus(res, 200)
+        self.assertEqual([u['id'] for u in res.json['data']], [str(units[1].id)])
+
+    def test_index_units_invalid_cursor(self):
+        res = self.client.get(url_for('api.v1.index_units', **{
+            'page[after]': str(uuid4())
+        }))
+        self.assertStatus(res, 400)
+
+    def test_index_units_by_expired(self):
+        expired = Unit.create(
+            user        = self.user,
+            start_time  = SQL("NOW() - INTERVAL '1 hour'"),
+            expiry_time = SQL("NOW() - INTERVAL '35 minutes'"),
+            expired     = True)
+        Unit.create(user = self.user)
+
+        res = self.client.get(url_for('api.v1.index_units', **{
+            'filter[from]': (datetime.datetime.now() - datetime.timedelta(days = 1)).isoformat(),
+            'filter[to]': datetime.datetime.now().isoformat(),
+            'filter[expired]': 'true',
+        }))
+        self.assertStatus(res, 200)
+        self.assertEqual([u['id'] for u in res.json['data']], [str(expired.id)])
+        self.assertTrue(res.json['data'][0]['attributes']['expired'])
+
+        res = self.client.get(url_for('api.v1.index_units', **{
+            'filter[expired]': 'yes'
+        }))
+        self.assertStatus(res, 400)
+
+    def test_index_units_invalid_page_size(self):
+        res = self.client.get(url_for('api.v1.index_units', **{ 'page[size]': 0 }))
+        self.assertStatus(res, 400)
+
     def test_has_date_meta(self):
         res = self.client.get(url_for('api.v1.index_units'))
         ret = res.json['meta']
@@ -213,6 +351,104 @@ class TestIndexUnits(TestEndpoints):
             self.fail(e)
 
 
+class TestExportUnits(TestEndpoints):
+    def setUp(self):
+        TestEndpoints.setUp(self)
+        self.unit = Unit.create(user = self.user, description = 'Foo, "bar"')
+        create_tag(self.unit, 'foo')
+
+    def test_export_ndjson(self):
+        res = self.client.get(url_for('api.v1.export_units'))
+        self.assertStatus(res, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+
+        lines = res.data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1)
+
+        row = flask.json.loads(lines[0])
+        self.assertEqual(row['id'], str(self.unit.id))
+        self.assertEqual(row['tags'], ['foo'])
+
+    def test_export_csv(self):
+        res = self.client.get(url_for('api.v1.export_units', format = 'csv'))
+        self.assertStatus(res, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+
+        rows = list(csv.DictReader(io.StringIO(res.data.decode('utf-8'))))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['id'], str(self.unit.id))
+        self.assertEqual(rows[0]['description'], 'Foo, "bar"')
+
+    def test_export_invalid_format(self):
+        res = self.client.get(url_for('api.v1.export_units', format = 'xml'))
+        self.assertStatus(res, 400)
+
+
+class TestStats(TestEndpoints):
+    def setUp(self):
+        TestEndpoints.setUp(self)
+        unit = Unit.create(
+            user        = self.user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '30 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '5 minutes'"))
+        create_tag(unit, 'foo')
+        nightshades.rollups.backfill([self.user.id])
+
+    def test_stats_totals(self):
+        res = self.client.get(url_for('api.v1.stats_totals', period = 'week'))
+        self.assertStatus(res, 200)
+
+        attrs = res.json['data'][0]['attributes']
+        self.assertEqual(attrs['units'], 1)
+        self.assertEqual(attrs['seconds'], 1500)
+        self.assertEqual(attrs['completion_ratio'], 1)
+
+    def test_stats_totals_invalid_period(self):
+        res = self.client.get(url_for('api.v1.stats_totals', period = 'year'))
+        self.assertStatus(res, 400)
+
+    def test_stats_tags(self):
+        res = self.client.get(url_for('api.v1.stats_tags'))
+        self.assertStatus(res, 200)
+        self.assertEqual(res.json['data'][0]['id'], 'foo')
+
+    def test_stats_streak(self):
+        res = self.client.get(url_for('api.v1.stats_streak'))
+        self.assertStatus(res, 200)
+        self.assertGreaterEqual(res.json['data']['attributes']['days'], 1)
+
+
+class TestConditionalGet(TestEndpoints):
+    def test_not_modified(self):
+        res = self.client.get(url_for('api.v1.index_units'))
+        self.assertStatus(res, 200)
+        etag = res.headers.get('ETag')
+        self.assertTrue(etag.startswith('W/'))
+
+        res = self.client.get(url_for('api.v1.index_units'),
+                              headers = { 'If-None-Match': etag })
+        self.assertStatus(res, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_modified_after_write(self):
+        res  = self.client.get(url_for('api.v1.index_units'))
+        etag = res.headers.get('ETag')
+
+        nightshades.api.start_unit(self.user.id)
+        res = self.client.get(url_for('api.v1.index_units'),
+                              headers = { 'If-None-Match': etag })
+        self.assertStatus(res, 200)
+        self.assertEqual(len(res.json['data']), 1)
+        self.assertNotEqual(res.headers.get('ETag'), etag)
+
+    def test_etag_differs_per_url(self):
+        unit = Unit.create(user = self.user)
+        a = self.client.get(url_for('api.v1.index_units')).headers.get('ETag')
+        b = self.client.get(url_for('api.v1.show_unit', uuid = unit.id)).headers.get('ETag')
+        self.assertNotEqual(a, b)
+
+
 class TestCreateUnit(TestEndpoints):
     def test_create_unit(self):
         payload = {
@@ -351,8 +587,7 @@ class TestUpdateUnit(TestEndpoints):
         )
         self.assertStatus(res, 200)
 
-        tags = set(Tag.select(Tag.string).where(Tag.unit == unit).tuples())
-        self.assertEqual(tags, set((('foo',), ('bar',))))
+        self.assertEqual(tag_names(unit), set(('foo', 'bar')))
 
     def test_already_marked_complete(self):
         unit = Unit.create(user = self.user, completed = True)
@@ -390,6 +625,22 @@ class TestUpdateUnit(TestEndpoints):
             expiry_time = SQL("NOW() - INTERVAL '1 second'")
         )
 
+        payload = {
+            'data': {
+                'type': 'unit',
+                'id': unit.id,
+                'attributes': { 'completed': True }
+            }
+        }
+        res = self.client.patch(
+            url_for('api.v1.update_unit', uuid = unit.id),
+            data = dumps(payload),
+            content_type = 'application/json'
+        )
+        self.assertStatus(res, 404)
+
+    def test_not_yet_complete(self):
+        unit = Unit.create(user = self.user)
         payload = {
             'data': {
                 'type': 'unit',
@@ -403,8 +654,149 @@ class TestUpdateUnit(TestEndpoints):
             content_type = 'application/json'
         )
         self.assertStatus(res, 400)
+        self.assertEqual(res.json['errors'][0]['title'], 'Unit is not yet complete')
+
 
 
+class TestMetrics(TestAPIv1):
+    def test_metrics(self):
+        self.client.get(url_for('api.v1.me'))
+        res = self.client.get('/metrics')
+        self.assertStatus(res, 200)
+        self.assertIn('nightshades_http_request_duration_seconds_bucket{'
+                      'method="GET",endpoint="api.v1.me",status="401"',
+                      res.data.decode('utf-8'))
+
+    def test_metrics_token(self):
+        with patch.dict(os.environ, { 'NIGHTSHADES_METRICS_TOKEN': 'foo' }):
+            self.assert404(self.client.get('/metrics'))
+            res = self.client.get(
+                '/metrics', headers = { 'Authorization': 'Bearer foo' })
+            self.assert200(res)
+
+
+class TestProfiles(TestAPIv1):
+    def setUp(self):
+        self.dir   = tempfile.TemporaryDirectory()
+        self.store = nightshades.profiling.ProfileStore(self.dir.name)
+        self.token = nightshades.profiling.token('sekret')
+
+        profile = cProfile.Profile()
+        profile.runcall(self.client.get, url_for('api.v1.me'))
+        self.store.save(profile, dict(
+            created = time.time(), method = 'GET', path = '/v1/me'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def get(self, url):
+        with patch('nightshades.http.profiles.store', self.store):
+            return self.client.get(url, headers = {
+                nightshades.profiling.header: self.token })
+
+    def test_list_profiles(self):
+        res = self.get('/debug/profiles')
+        self.assert200(res)
+        self.assertEqual(res.json['profiles'][0]['path'], '/v1/me')
+
+        name = res.json['profiles'][0]['name']
+        res  = self.get('/debug/profiles/{}?format=text'.format(name))
+        self.assert200(res)
+        self.assertIn('function calls', res.data.decode('utf-8'))
+
+    def test_requires_token(self):
+        with patch('nightshades.http.profiles.store', self.store):
+            self.assert404(self.client.get('/debug/profiles'))
+
+    def test_unknown_profile(self):
+        self.assert404(self.get('/debug/profiles/foo'))
+
+
+class TestQueryBudgets(TestEndpoints):
+    def unit_payload(self, attributes):
+        return dict(
+            data = dumps({ 'data': { 'type': 'unit', 'attributes': attributes } }),
+            content_type = 'application/json'
+        )
+
+    def test_server_timing(self):
+        res = self.client.get(url_for('api.v1.me'))
+        self.assertIn('queries', res.headers.get('Server-Timing'))
+
+    def test_me(self):
+        with max_queries(self, 2):
+            self.client.get(url_for('api.v1.me'))
+
+    def test_not_modified(self):
+        etag = self.client.get(url_for('api.v1.me')).headers['ETag']
+        with max_queries(self, 1):
+            res = self.client.get(url_for('api.v1.me'),
+                                  headers = { 'If-None-Match': etag })
+
+        self.assertStatus(res, 304)
+
+    def test_index_units(self):
+        for i in range(5):
+            create_tag(Unit.create(
+                user        = self.user,
+                completed   = True,
+                start_time  = SQL("NOW() - INTERVAL '%s minutes'", 30 * i + 30),
+                expiry_time = SQL("NOW() - INTERVAL '%s minutes'", 30 * i + 5)
+            ), 'foo')
+
+        with max_queries(self, 2):
+            res = self.client.get(url_for('api.v1.index_units'))
+
+        self.assertEqual(len(res.json['data']), 5)
+
+    def test_create_unit(self):
+        with max_queries(self, 1):
+            res = self.client.post(url_for('api.v1.create_unit'),
+                                   **self.unit_payload({ 'delta': 1500 }))
+
+        self.assertStatus(res, 201)
+
+    def test_create_unit_with_tags(self):
+        with max_queries(self, 7):
+            res = self.client.post(url_for('api.v1.create_unit'),
+                                   **self.unit_payload({ 'tags': 'foo,bar' }))
+
+        self.assertStatus(res, 201)
+
+    def test_show_unit(self):
+        unit = Unit.create(user = self.user)
+        with max_queries(self, 2):
+            self.client.get(url_for('api.v1.show_unit', uuid = unit.id))
+
+    def test_update_tags(self):
+        unit = Unit.create(user = self.user)
+        with max_queries(self, 7):
+            res = self.client.patch(
+                url_for('api.v1.update_unit', uuid = unit.id),
+                **self.unit_payload({ 'tags': 'foo,bar' }))
+
+        self.assertStatus(res, 200)
+
+    def test_complete_unit(self):
+        unit = Unit.create(
+            user        = self.user,
+            start_time  = SQL("NOW() - INTERVAL '25 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 second'"))
+
+        with max_queries(self, 2):
+            res = self.client.patch(
+                url_for('api.v1.update_unit', uuid = unit.id),
+                **self.unit_payload({ 'completed': True }))
+
+        self.assertStatus(res, 200)
+
+    def test_delete_unit(self):
+        Unit.create(user = self.user)
+        with max_queries(self, 1):
+            res = self.client.delete(url_for('api.v1.delete_unit'))
+
+        self.assertStatus(res, 200)
+
 
 class TestValidateUUID(TestEndpoints):
     def test_invalid_uuid(self):
@@ -432,5 +824,268 @@ class TestValidatePayload(TestEndpoints):
         self.assertIn('type', res.json['errors'][0]['title'])
 
 
+class ASGIResponse(object):
+    def __init__(self, status, headers, body):
+        self.status  = status
+        self.headers = headers
+        self.body    = body
+
+    @property
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+@unittest.skipIf(asgi is None, 'nightshades.asgi is unavailable')
+class TestASGI(TestEndpoints):
+    '''Requests to nightshades.asgi.app, which should answer like the Flask
+    app does.
+    '''
+    def setUp(self):
+        TestEndpoints.setUp(self)
+        self.token   = jwt.encode({ 'user_id': str(self.user.id) }, 'sekret')
+        self.patcher = patch.object(asgi, 'secret_key', 'sekret')
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    @classmethod
+    def tearDownClass(cls):
+        run(aio.close())
+
+    def scope(self, method, url, payload = None, headers = None):
+        path, _, query_string = url.partition('?')
+        headers = dict(headers or {})
+        headers['Cookie'] = 'jwt={}'.format(self.token.decode('ascii'))
+        if payload is not None:
+            headers['Content-Type'] = 'application/json'
+
+        return {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query_string.encode('latin-1'),
+            'headers': [(k.lower().encode('latin-1'), v.encode('latin-1'))
+                        for k, v in headers.items()],
+        }
+
+    def resolved(self, value):
+        future = asyncio.Future()
+        future.set_result(value)
+        return future
+
+    def response(self, sent):
+        headers = dict((k.decode('latin-1'), v.decode('latin-1'))
+                       for k, v in sent[0]['headers'])
+        return ASGIResponse(sent[0]['status'], headers,
+                            b''.join(m.get('body', b'') for m in sent[1:]))
+
+    def request(self, method, url, payload = None, headers = None):
+        scope    = self.scope(method, url, payload, headers)
+        body     = json.dumps(payload).encode('utf-8') if payload else b''
+        messages = [{ 'type': 'http.request', 'body': body }]
+        sent     = []
+
+        def receive():
+            return self.resolved(
+                messages.pop(0) if messages else { 'type': 'http.disconnect' })
+
+        def send(message):
+            sent.append(message)
+            return self.resolved(None)
+
+        run(asgi.app(scope, receive, send))
+        return self.response(sent)
+
+    def without_meta(self, res):
+        data = res.json
+        data.pop('meta', None)
+        return data
+
+    def test_not_found(self):
+        res = self.request('GET', '/foobar')
+        self.assertEqual(res.status, 404)
+        self.assertEqual(res.json['errors'][0]['title'], 'Not Found')
+
+    def test_unauthorized(self):
+        self.token = b'foobar'
+        res = self.request('GET', '/v1/me')
+        self.assertEqual(res.status, 401)
+        self.assertEqual(
+            res.json['errors'][0]['title'], 'Invalid Authorization token')
+
+    def test_me(self):
+        res = self.request('GET', '/v1/me')
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.json['data']['attributes']['name'], 'Alice')
+        self.assertEqual(self.without_meta(res),
+                         self.without_meta(self.client.get('/v1/me')))
+
+    def test_update_me(self):
+        res = self.request('PATCH', '/v1/me', {
+            'data': { 'type': 'user', 'attributes': { 'timezone': 'Asia/Tokyo' } }
+        })
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.json['data']['attributes']['timezone'], 'Asia/Tokyo')
+
+        res = self.request('PATCH', '/v1/me', {
+            'data': { 'type': 'user', 'attributes': { 'timezone': 'Nowhere' } }
+        })
+        self.assertEqual(res.status, 400)
+        self.assertEqual(res.json['errors'][0]['title'], 'Invalid timezone')
+
+    def test_not_modified(self):
+        res = self.request('GET', '/v1/units')
+        etag = res.headers.get('ETag')
+        self.assertTrue(etag.startswith('W/'))
+
+        res = self.request('GET', '/v1/units', headers = { 'If-None-Match': etag })
+        self.assertEqual(res.status, 304)
+        self.assertEqual(res.body, b'')
+
+        nightshades.api.start_unit(self.user.id)
+        res = self.request('GET', '/v1/units', headers = { 'If-None-Match': etag })
+        self.assertEqual(res.status, 200)
+        self.assertEqual(len(res.json['data']), 1)
+
+    def test_index_units(self):
+        units = [Unit.create(
+            user        = self.user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '%s days'", days),
+            expiry_time = SQL("NOW() - INTERVAL '%s days' + INTERVAL '25 minutes'", days)
+        ) for days in (1, 2, 3)]
+        create_tag(units[0], 'foo')
+
+        url = url_for('api.v1.index_units', **{
+            'filter[from]': (datetime.datetime.now() - datetime.timedelta(days = 7)).isoformat(),
+            'filter[to]': datetime.datetime.now().isoformat(),
+            'page[size]': 2,
+        })
+        res = self.request('GET', url)
+        self.assertEqual(res.status, 200)
+        self.assertEqual([u['id'] for u in res.json['data']],
+                         [str(units[0].id), str(units[1].id)])
+        self.assertEqual(res.json['data'],
+                         self.without_meta(self.client.get(url))['data'])
+
+        res = self.request('GET', res.json['links']['next'])
+        self.assertEqual([u['id'] for u in res.json['data']], [str(units[2].id)])
+        self.assertNotIn('next', res.json['links'])
+
+        res = self.request('GET', '/v1/units?page[size]=0')
+        self.assertEqual(res.status, 400)
+
+    def test_create_unit(self):
+        payload = { 'data': { 'type': 'unit', 'attributes': {
+            'description': 'Writing', 'tags': 'foo,bar' } } }
+        res = self.request('POST', '/v1/units', payload)
+        self.assertEqual(res.status, 201)
+        self.assertEqual(res.json['data']['attributes']['description'], 'Writing')
+        self.assertEqual(set(res.json['data']['attributes']['tags']),
+                         set(('foo', 'bar')))
+
+        res = self.request('POST', '/v1/units', payload)
+        self.assertEqual(res.status, 400)
+        self.assertEqual(res.json['errors'][0]['title'], 'Unit already ongoing')
+
+    def test_show_unit(self):
+        unit = Unit.create(user = self.user)
+        create_tag(unit, 'foo')
+
+        url = '/v1/units/{}'.format(unit.id)
+        res = self.request('GET', url)
+        self.assertEqual(res.status, 200)
+        self.assertEqual(self.without_meta(res),
+                         self.without_meta(self.client.get(url)))
+
+        self.assertEqual(self.request('GET', '/v1/units/abcd').status, 404)
+        self.assertEqual(
+            self.request('GET', '/v1/units/{}'.format(uuid4())).status, 404)
+
+    def test_update_unit(self):
+        unit = Unit.create(
+            user        = self.user,
+            start_time  = SQL("NOW() - INTERVAL '25 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 second'"))
+        url = '/v1/units/{}'.format(unit.id)
+
+        res = self.request('PATCH', url, {
+            'data': { 'type': 'unit', 'attributes': { 'tags': 'foo' } } })
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.json['data']['attributes']['tags'], ['foo'])
+
+        res = self.request('PATCH', url, {
+            'data': { 'type': 'unit', 'attributes': { 'completed': True } } })
+        self.assertEqual(res.status, 200)
+        self.assertTrue(Unit.get(Unit.id == unit.id).completed)
+
+        res = self.request('PATCH', url, {
+            'data': { 'type': 'unit', 'attributes': { 'completed': True } } })
+        self.assertEqual(res.status, 400)
+        self.assertEqual(res.json['errors'][0]['title'],
+                         'Unit has already been marked complete')
+
+    def test_validate_payload(self):
+        url = '/v1/units/{}'.format(uuid4())
+        res = self.request('PATCH', url, {})
+        self.assertEqual(res.status, 400)
+        self.assertEqual(res.json['errors'][0]['title'], 'No data')
+
+        res = self.request('PATCH', url, { 'data': { 'type': 'foobar' } })
+        self.assertEqual(res.status, 400)
+        self.assertIn('type', res.json['errors'][0]['title'])
+
+    def test_delete_unit(self):
+        nightshades.api.start_unit(self.user.id)
+        res = self.request('DELETE', '/v1/units')
+        self.assertEqual(res.status, 200)
+        self.assertFalse(nightshades.api.has_ongoing_unit(self.user.id))
+
+        self.assertEqual(self.request('DELETE', '/v1/units').status, 404)
+
+    def test_unit_events(self):
+        sent       = []
+        disconnect = asyncio.Future()
+        messages   = [{ 'type': 'http.request', 'body': b'' }]
+
+        def receive():
+            return self.resolved(messages.pop(0)) if messages else disconnect
+
+        def send(message):
+            sent.append(message)
+            if b'event: started' in message.get('body', b''):
+                disconnect.set_result({ 'type': 'http.disconnect' })
+
+            return self.resolved(None)
+
+        scope = self.scope('GET', '/v1/units/events')
+        task  = asyncio.ensure_future(asgi.app(scope, receive, send))
+        while not sent:
+            run(asyncio.sleep(0.01))
+
+        run(asyncio.wait_for(aio.listener.listening.wait(), 5))
+        unit = nightshades.api.start_unit(self.user.id)
+        run(asyncio.wait_for(task, 5))
+
+        res = self.response(sent)
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.headers['Content-Type'], 'text/event-stream')
+
+        event, data = res.body.decode('utf-8').strip().split('\n')
+        self.assertEqual(event, 'event: started')
+        self.assertEqual(json.loads(data[len('data: '):]), {
+            'event': 'started',
+            'user_id': str(self.user.id),
+            'unit_id': str(unit['id']),
+        })
+
+        # The stream unsubscribed when the client went away.
+        self.assertNotIn(str(self.user.id), aio.listener.subscribers)
+
+    def test_method_not_allowed(self):
+        self.assertEqual(self.request('PUT', '/v1/units').status, 405)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,83 @@
 import nightshades
-from nightshades.models import User, LoginProvider, Unit, Tag
+from nightshades import rollups
+from nightshades.models import (
+    User, LoginProvider, Unit, Tag, TagName, DailyUnitRollup, partial_indexes,
+    added_indexes, ONE_ONGOING_UNIT_CONSTRAINT, one_ongoing_unit_exclusion
+)
 
 db = nightshades.connection()
+
+
+def migrate_tag_strings():
+    '''Tags used to store their string on every row. Move the strings into
+    tag_names and point the tags at them instead.
+    '''
+    with db.atomic():
+        db.execute_sql('''
+            INSERT INTO tag_names (user_id, name)
+            SELECT DISTINCT units.user_id, tags.string
+            FROM tags JOIN units ON units.id = tags.unit_id
+            ON CONFLICT (user_id, name) DO NOTHING
+        ''')
+        db.execute_sql('''
+            ALTER TABLE tags ADD COLUMN tag_name_id INTEGER
+            REFERENCES tag_names (id) ON DELETE CASCADE
+        ''')
+        db.execute_sql('''
+            UPDATE tags SET tag_name_id = tag_names.id
+            FROM units, tag_names
+            WHERE units.id = tags.unit_id
+              AND tag_names.user_id = units.user_id
+              AND tag_names.name = tags.string
+        ''')
+        db.execute_sql('ALTER TABLE tags ALTER COLUMN tag_name_id SET NOT NULL')
+        db.execute_sql('ALTER TABLE tags DROP COLUMN string')
+        db.execute_sql('''
+            CREATE UNIQUE INDEX tags_unit_id_tag_name_id
+            ON tags (unit_id, tag_name_id)
+        ''')
+        db.execute_sql('''
+            CREATE INDEX tags_tag_name_id_unit_id
+            ON tags (tag_name_id, unit_id)
+        ''')
+
+
 db.execute_sql('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";')
-db.create_tables([User, LoginProvider, Unit, Tag], safe = True)
+db.execute_sql('CREATE EXTENSION IF NOT EXISTS "btree_gist";')
+
+# Existing units are only counted in the rollups by a backfill, which has to
+# wait for the tags to be migrated below.
+has_rollups = DailyUnitRollup.table_exists()
+db.create_tables([User, LoginProvider, Unit, TagName, DailyUnitRollup], safe = True)
+
+# create_tables() leaves existing tables alone, so older units tables don't
+# have the constraint start_unit relies on yet.
+has_constraint = db.execute_sql(
+    'SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = %s)',
+    (ONE_ONGOING_UNIT_CONSTRAINT,)).fetchone()[0]
+if not has_constraint:
+    db.execute_sql('ALTER TABLE units ADD CONSTRAINT {} {}'.format(
+        ONE_ONGOING_UNIT_CONSTRAINT, one_ongoing_unit_exclusion))
+
+if 'revision' not in [column.name for column in db.get_columns('users')]:
+    db.execute_sql('ALTER TABLE users ADD COLUMN revision BIGINT NOT NULL DEFAULT 0')
+
+if 'timezone' not in [column.name for column in db.get_columns('users')]:
+    db.execute_sql(
+        "ALTER TABLE users ADD COLUMN timezone TEXT NOT NULL DEFAULT 'UTC'")
+
+if 'expired' not in [column.name for column in db.get_columns('units')]:
+    db.execute_sql(
+        'ALTER TABLE units ADD COLUMN expired BOOLEAN NOT NULL DEFAULT false')
+
+if Tag.table_exists():
+    if 'string' in [column.name for column in db.get_columns('tags')]:
+        migrate_tag_strings()
+else:
+    Tag.create_table()
+
+for sql in partial_indexes + added_indexes:
+    db.execute_sql(sql)
+
+if not has_rollups:
+    rollups.backfill()
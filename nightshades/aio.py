@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+'''Asynchronous versions of the functions in nightshades.api, on aiopg with a
+connection pool. These run the same SQL (peewee only builds the queries),
+return the same values and raise the same exceptions as their synchronous
+counterparts.
+
+This needs Python 3.5+ and the packages in requirements.aio.txt::
+
+    import asyncio
+    from nightshades import aio
+
+    async def main():
+        await aio.connect()
+        unit = await aio.start_unit(user_id)
+        await aio.close()
+
+    asyncio.get_event_loop().run_until_complete(main())
+'''
+import os
+import json
+import asyncio
+import logging
+import datetime
+from uuid import UUID
+
+import aiopg
+import psycopg2
+import peewee
+from playhouse.db_url import parse
+
+from . import api, cache, events, metrics, rollups
+from .models import User, Unit, Tag, LoginProvider
+
+pool = None
+
+
+async def connect(**kwargs):
+    '''Create the connection pool from ``NIGHTSHADES_POSTGRESQL_DB_URI``. Its
+    size is ``NIGHTSHADES_POSTGRESQL_POOL_MAX_CONNECTIONS`` (10 by default).
+    Keyword arguments are passed on to `aiopg.create_pool`.
+    '''
+    global pool
+    if pool is not None:
+        return pool
+
+    opts = connection_options()
+    max_connections = os.environ.get('NIGHTSHADES_POSTGRESQL_POOL_MAX_CONNECTIONS')
+    opts['maxsize'] = int(max_connections or 10)
+    opts.update(kwargs)
+
+    pool = await aiopg.create_pool(**opts)
+    return pool
+
+
+def connection_options():
+    k = 'NIGHTSHADES_POSTGRESQL_DB_URI'
+    db_conn_uri = os.environ.get(k, default = 'postgresqlext:///nightshades')
+
+    opts = parse(db_conn_uri)
+    opts['dbname'] = opts.pop('database')
+    return opts
+
+
+async def close():
+    global pool
+    await listener.stop()
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+        pool = None
+
+
+class transaction(object):
+    '''Check out a connection and run everything on the cursor this gives
+    inside a transaction, rolling it back if an exception is raised.
+    aiopg connections are always in autocommit mode, so this is done with
+    explicit BEGIN and COMMIT statements.
+    '''
+    async def __aenter__(self):
+        self.conn   = await (await connect()).acquire()
+        self.cursor = await self.conn.cursor()
+        await self.cursor.execute('BEGIN')
+        return self.cursor
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.cursor.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.cursor.close()
+            pool.release(self.conn)
+
+
+class _Rollback(Exception): pass
+
+
+async def fetchall(sql, params = None):
+    '''Run a single statement on a pooled connection.'''
+    async with (await connect()).acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+            return await cursor.fetchall(), cursor.description
+
+
+async def execute(sql, params = None):
+    '''Run a single statement that returns no rows on a pooled connection.
+
+    :return: the number of rows affected
+    '''
+    async with (await connect()).acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+            return cursor.rowcount
+
+
+async def fetchone(sql, params = None):
+    rows, description = await fetchall(sql, params)
+    return (rows[0] if rows else None), description
+
+
+async def get_dicts(model, query):
+    rows, description = await fetchall(*query.sql())
+    return [api.to_dict(model, row, description) for row in rows]
+
+
+async def get_dict(model, query):
+    '''Like ``query.dicts().get()``.
+
+    :raises peewee.DoesNotExist: (the model's subclass) if there is no row
+    '''
+    row, description = await fetchone(*query.limit(1).sql())
+    if row is None:
+        raise model.DoesNotExist
+
+    return api.to_dict(model, row, description)
+
+
+async def get_user(user_id):
+    return await get_dict(User, User.select().where(User.id == user_id))
+
+
+async def get_revision(user_id):
+    query = User.select(User.revision).where(User.id == user_id)
+    row, description = await fetchone(*query.sql())
+    return row[0] if row else None
+
+
+async def get_today(user_id):
+    '''See :func:`nightshades.api.get_today`.'''
+    return await get_dict(User, api.query_today(user_id))
+
+
+async def get_revision_and_today(user_id):
+    '''See :func:`nightshades.api.get_revision_and_today`.'''
+    return await get_dict(User, api.query_today(user_id, User.revision))
+
+
+async def set_timezone(user_id, timezone):
+    '''See :func:`nightshades.api.set_timezone`.'''
+    row, description = await fetchone(
+        'SELECT EXISTS (SELECT 1 FROM pg_timezone_names WHERE name = %s)',
+        (timezone,))
+    if not row[0]:
+        raise api.ValidationError('Invalid timezone')
+
+    await execute(*api.query_set_timezone(user_id, timezone).sql())
+
+
+async def start_unit(user_id, seconds = 1500, description = None):
+    '''See :func:`nightshades.api.start_unit`.'''
+    query = api.start_unit_query(user_id, seconds, description)
+    try:
+        row, description = await fetchone(*query)
+    except psycopg2.IntegrityError as e:
+        if api.is_ongoing_unit_violation(e):
+            raise api.HasOngoingUnitAlready
+
+        raise
+
+    api.invalidate_ongoing_unit(user_id)
+    metrics.units_started.inc()
+    return api.to_dict(Unit, row, description)
+
+
+async def complete_unit(unit_id, **kwargs):
+    '''See :func:`nightshades.api.complete_unit`.'''
+    row, description = await fetchone(*api.complete_unit_query(unit_id, **kwargs))
+    user_id = api.complete_unit_result(row)
+    api.invalidate_ongoing_unit(user_id)
+    metrics.units_completed.inc()
+
+
+async def mark_complete(unit_id, **kwargs):
+    '''See :func:`nightshades.api.mark_complete`.'''
+    try:
+        await complete_unit(unit_id, **kwargs)
+        return True
+    except (api.UnitNotFound, api.UnitAlreadyCompleted,
+            api.UnitNotYetComplete, api.UnitExpired):
+        return False
+
+
+async def set_tags(unit_id, tag_csv, **kwargs):
+    '''See :func:`nightshades.api.set_tags`.'''
+    valids, invalids = api.validate_tag_csv(unit_id, tag_csv)
+    if len(tag_csv) > 0 and len(valids) == 0:
+        raise api.ValidationError('No valid tags')
+
+    tags = []
+    async with transaction() as cursor:
+        await cursor.execute(*api.lock_units_query([unit_id], **kwargs))
+        api.check_locked_units([unit_id], await cursor.fetchall(), **kwargs)
+
+        await cursor.execute(api.bump_revision_sql, ([str(unit_id)],))
+        await cursor.execute(*rollups.update_many_sql(
+            [unit_id], count = -1, completed = -1, total = False))
+        await cursor.execute(*Tag.delete().where(Tag.unit == unit_id).sql())
+
+        if len(valids) > 0:
+            names = [valid['string'] for valid in valids]
+            await cursor.execute(
+                api.insert_tags_sql, ([str(unit_id)] * len(names), names))
+            tags = [name for _, name in await cursor.fetchall()]
+
+            await cursor.execute(*rollups.update_many_sql(
+                [unit_id], count = 1, completed = 1, total = False))
+
+        await cursor.execute(*events.notify_units_query(events.TAGGED, [unit_id]))
+
+    if kwargs.get('user_id', False):
+        api.invalidate_ongoing_unit(kwargs['user_id'])
+
+    return tags
+
+
+async def get_unit(unit_id, **kwargs):
+    '''See :func:`nightshades.api.get_unit`.'''
+    filters = [Unit.id == unit_id]
+    if kwargs.get('user_id', False):
+        filters.append(Unit.user == kwargs['user_id'])
+
+    query = Unit.select(Unit, api.tags_array().alias('tags')).join(
+        Tag, peewee.JOIN.LEFT_OUTER
+    ).join(
+        api.TagName, peewee.JOIN.LEFT_OUTER
+    ).where(*filters).group_by(Unit)
+
+    return await get_dict(Unit, query)
+
+
+async def get_units(user_id, date_a, date_b, limit = None, after = None,
+                    tag = None, expired = None):
+    '''See :func:`nightshades.api.get_units`. Returns a list.'''
+    query = api.get_units(user_id, date_a, date_b, limit, after, tag, expired)
+    return await get_dicts(Unit, query)
+
+
+async def get_ongoing_unit(user_id):
+    '''See :func:`nightshades.api.get_ongoing_unit`. This shares its cache,
+    so keep to the in-process cache backend to avoid blocking the event loop.
+    '''
+    key  = api.ongoing_unit_cache_key(user_id)
+    unit = cache.get(key, default = False)
+    if unit is False:
+        try:
+            unit = await get_dict(Unit, api.query_ongoing_unit(user_id))
+            now  = datetime.datetime.now(datetime.timezone.utc)
+            cache.set(key, unit, (unit['expiry_time'] - now).total_seconds())
+        except Unit.DoesNotExist:
+            unit = None
+            cache.set(key, unit)
+
+    if unit is None:
+        raise api.NoOngoingUnit
+
+    return unit
+
+
+async def has_ongoing_unit(user_id):
+    try:
+        await get_ongoing_unit(user_id)
+        return True
+    except api.NoOngoingUnit:
+        return False
+
+
+async def cancel_ongoing_unit(user_id):
+    '''See :func:`nightshades.api.cancel_ongoing_unit`.
+
+    :raises peewee.DoesNotExist: if there is no ongoing unit
+    '''
+    rows, description = await fetchall(*api.cancel_ongoing_unit_query(user_id))
+    if not rows:
+        raise Unit.DoesNotExist
+
+    api.invalidate_ongoing_unit(user_id)
+    metrics.units_cancelled.inc()
+    return len(rows)
+
+
+async def login_or_register(name, provider, provider_user_id):
+    '''See :func:`nightshades.api.login_or_register`.'''
+    if provider not in api.valid_login_providers:
+        raise api.InvalidLoginProvider
+
+    params = dict(
+        name             = name,
+        provider         = provider,
+        provider_user_id = str(provider_user_id),
+    )
+
+    for attempt in range(2):
+        try:
+            async with transaction() as cursor:
+                await cursor.execute(api.login_or_register_sql, params)
+                res = await cursor.fetchone()
+                if res is None:
+                    raise _Rollback
+
+                metrics.logins.inc(provider = provider)
+                return UUID(str(res[0]))
+        except _Rollback:
+            pass
+
+    raise api.UsageError('Could not log in')
+
+
+async def add_new_provider(user_id, provider, provider_user_id):
+    query = LoginProvider.insert(
+        user             = user_id,
+        provider         = provider,
+        provider_user_id = provider_user_id
+    )
+    await execute(*query.sql())
+
+
+class Listener(object):
+    '''Fans the events published by nightshades.events out to subscribers
+    in this process, over a single connection that LISTENs on their channel.
+    The connection is opened with the first subscription and reopened if it
+    drops.
+    '''
+    reconnect_seconds = 5
+
+    def __init__(self):
+        self.subscribers = {}
+        self.task        = None
+
+        # Set while the connection is LISTENing.
+        self.listening   = None
+
+    def subscribe(self, user_id):
+        ''':return: an `asyncio.Queue` of the user's events, as dicts'''
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(str(user_id), set()).add(queue)
+        if self.task is None:
+            self.listening = asyncio.Event()
+            self.task      = asyncio.ensure_future(self.listen())
+
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self.subscribers.get(str(user_id), set())
+        queues.discard(queue)
+        if not queues:
+            self.subscribers.pop(str(user_id), None)
+
+    def publish(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logging.error('Invalid event payload %r', payload)
+            return
+
+        for queue in self.subscribers.get(event.get('user_id'), ()):
+            queue.put_nowait(event)
+
+    async def listen(self):
+        while True:
+            try:
+                conn = await aiopg.connect(**connection_options())
+                try:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute('LISTEN {}'.format(events.channel))
+
+                    self.listening.set()
+                    while True:
+                        notify = await conn.notifies.get()
+                        self.publish(notify.payload)
+                finally:
+                    self.listening.clear()
+                    conn.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(e)
+                await asyncio.sleep(self.reconnect_seconds)
+
+    async def stop(self):
+        if self.task is None:
+            return
+
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+        self.task = None
+
+
+listener = Listener()
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import base64
 import logging
 import datetime
+from uuid import uuid4, UUID
 
 import peewee
+import iso8601
 
-from .models import db, User, Unit, Tag, LoginProvider, SQL
+from . import cache, events, metrics, rollups
+from .models import (
+    db, User, Unit, Tag, TagName, LoginProvider, SQL,
+    ONE_ONGOING_UNIT_CONSTRAINT
+)
 
 # This is how long one has after the expiry_time to mark a unit as complete.
 expiry_interval_seconds = 300
@@ -15,6 +22,8 @@ class UsageError(Exception):
     '''An exception thrown when the API has been used improperly, typically a
     parent class.
     '''
+    status_code = 400
+
     def __init__(self, message = ''):
         Exception.__init__(self)
         self.message = message
@@ -27,6 +36,13 @@ class ValidationError(UsageError): pass
 class HasOngoingUnitAlready(UsageError): pass
 class NoOngoingUnit(UsageError): pass
 class InvalidLoginProvider(UsageError): pass
+class UnitNotYetComplete(UsageError): pass
+class UnitAlreadyCompleted(UsageError): pass
+class UnitExpired(UsageError): pass
+
+
+class UnitNotFound(UsageError):
+    status_code = 404
 
 
 # Let's define some things.
@@ -34,7 +50,13 @@ class InvalidLoginProvider(UsageError): pass
 # Unit states:
 #   * completed: Unit.completed == true
 #   * ongoing: NOW() < Unit.expiry_time
-#   * expired: NOW() > Unit.expiry_time + expiry_threshold
+#   * expired: NOW() > Unit.expiry_time + expiry_threshold, which
+#     nightshades.sweeper records as Unit.expired == true
+
+valid_stats_periods = (
+    'day',
+    'week',
+)
 
 valid_login_providers = (
     'twitter',
@@ -46,6 +68,155 @@ def get_user(user_id):
     return User.select().where(User.id == user_id).dicts().get()
 
 
+def get_revision(user_id):
+    '''A number that changes whenever the user's units do, for cheaply
+    telling whether anything derived from them is still current.
+    '''
+    return User.select(User.revision).where(User.id == user_id).scalar()
+
+
+def query_today(user_id, *columns):
+    ''':param columns: more of the user's columns to select'''
+    local_day = "date_trunc('day', NOW() AT TIME ZONE timezone)"
+    return User.select(
+        SQL('({})::date'.format(local_day)).alias('date'),
+        SQL('{} AT TIME ZONE timezone'.format(local_day)).alias('start'),
+        SQL("({} + INTERVAL '1 day' - INTERVAL '1 microsecond') "
+            "AT TIME ZONE timezone".format(local_day)).alias('end'),
+        *columns
+    ).where(User.id == user_id)
+
+
+def get_today(user_id):
+    '''The current day in the user's timezone, according to postgres' clock.
+
+    :return: dict of the ``date`` and the ``start`` and ``end`` (inclusive)
+             of the day as timezone-aware datetimes
+    '''
+    return query_today(user_id).dicts().get()
+
+
+def get_revision_and_today(user_id):
+    '''Like :func:`get_today`, with the user's ``revision`` (see
+    :func:`get_revision`) as well, in one query. This is everything a
+    conditional request needs.
+    '''
+    return query_today(user_id, User.revision).dicts().get()
+
+
+def is_valid_timezone(timezone):
+    cursor = db.execute_sql(
+        'SELECT EXISTS (SELECT 1 FROM pg_timezone_names WHERE name = %s)',
+        (timezone,))
+    return cursor.fetchone()[0]
+
+
+def query_set_timezone(user_id, timezone):
+    # Days, and so the default listings, start at different times now.
+    return User.update(
+        timezone = timezone,
+        revision = User.revision + 1
+    ).where(User.id == user_id)
+
+
+def set_timezone(user_id, timezone):
+    '''Set the timezone the user's days are in.
+
+    :param str timezone: a name from the tz database, such as
+                         ``America/Toronto``
+    :raises ValidationError: if postgres doesn't know the timezone
+    '''
+    if not is_valid_timezone(timezone):
+        raise ValidationError('Invalid timezone')
+
+    query_set_timezone(user_id, timezone).execute()
+
+
+bump_revision_sql = '''
+    UPDATE users SET revision = revision + 1
+    WHERE id IN (SELECT user_id FROM units WHERE id = ANY(%s::uuid[]))
+'''
+
+
+def query_bump_revision(user_id):
+    return User.update(revision = User.revision + 1).where(User.id == user_id)
+
+
+def bump_revision(user_id):
+    query_bump_revision(user_id).execute()
+
+
+def bump_revision_for_units(unit_ids):
+    db.execute_sql(bump_revision_sql, (list(map(str, unit_ids)),))
+
+
+def to_dict(model, row, description):
+    '''Build the dict peewee's ``.dicts()`` would for a row of ``model``,
+    converting values the model's fields know about.
+    '''
+    fields = dict((f.db_column, f) for f in model._meta.sorted_fields)
+    res = {}
+    for column, value in zip((c[0] for c in description), row):
+        field = fields.get(column)
+        if field is None:
+            res[column] = value
+        else:
+            res[field.name] = field.python_value(value)
+
+    return res
+
+
+unit_columns = ', '.join(f.db_column for f in Unit._meta.sorted_fields)
+
+# Starts a unit, applies it to the rollups, bumps the user's revision and
+# publishes the started event, all in one statement (see complete_unit_sql).
+start_unit_sql = '''
+    WITH inserted AS (
+        INSERT INTO units (user_id, expiry_time, description)
+        VALUES (%(user_id)s, NOW() + %(seconds)s * INTERVAL '1 second',
+                %(description)s)
+        RETURNING units.*
+    ), rollup AS (
+        {rollup}
+    ), revision AS (
+        UPDATE users SET revision = revision + 1
+        WHERE id = (SELECT user_id FROM inserted)
+    ), notified AS (
+        {notified}
+    )
+    SELECT {columns} FROM notified
+'''
+
+
+def start_unit_query(user_id, seconds, description):
+    ''':return: the SQL and parameters for start_unit()
+    :raises ValidationError: if the specified unit is less than 2 minutes
+    '''
+    if seconds < 120:
+        raise ValidationError('Unit must be at least 2 minutes')
+
+    sql = start_unit_sql.format(
+        rollup   = rollups.upsert(units = 'inserted'),
+        notified = events.notify_rows('inserted'),
+        columns  = unit_columns,
+    )
+
+    return (sql, dict(
+        user_id     = str(getattr(user_id, 'id', user_id)),
+        seconds     = seconds,
+        description = description,
+        count       = 1,
+        completed   = 0,
+        total       = True,
+        channel     = events.channel,
+        event       = events.STARTED,
+    ))
+
+
+def is_ongoing_unit_violation(e):
+    return ONE_ONGOING_UNIT_CONSTRAINT in str(e)
+
+
 def start_unit(user_id, seconds = 1500, description = None):
     '''Start a unit for a given user with a default period of 25 minutes.
 
@@ -58,43 +229,149 @@ def start_unit(user_id, seconds = 1500, description = None):
     :raises HasOngoingUnitAlready: if the user already has an ongoing unit
     '''
 
-    if seconds < 120:
-        raise ValidationError('Unit must be at least 2 minutes')
+    # The ongoing unit check is left to the exclusion constraint on the units
+    # table so that this is a single query and safe under concurrency.
+    try:
+        with db.atomic():
+            cursor = db.execute_sql(
+                *start_unit_query(user_id, seconds, description))
+            unit = to_dict(Unit, cursor.fetchone(), cursor.description)
+
+        invalidate_ongoing_unit(user_id)
+        metrics.units_started.inc()
+        return unit
+    except peewee.IntegrityError as e:
+        if is_ongoing_unit_violation(e):
+            raise HasOngoingUnitAlready
+
+        raise
+
+
+# Looks the unit up, completes it if it is within its grace window, applies
+# the completion to the rollups and publishes the completed event, all in one
+# statement. The unit's state is reported back so failures can be explained
+# without another query.
+complete_unit_sql = '''
+    WITH target AS (
+        SELECT
+            id,
+            user_id,
+            completed,
+            NOW() < expiry_time AS too_early,
+            expired OR
+            NOW() > expiry_time + %(grace)s * INTERVAL '1 second' AS expired
+        FROM units
+        WHERE id = %(unit_id)s {user_filter}
+    ), updated AS (
+        UPDATE units SET completed = true
+        WHERE id = (SELECT id FROM target)
+          AND NOT completed
+          AND NOT expired
+          AND expiry_time <= NOW()
+          AND NOW() <= expiry_time + %(grace)s * INTERVAL '1 second'
+        RETURNING units.*
+    ), rollup AS (
+        {rollup}
+    ), revision AS (
+        UPDATE users SET revision = revision + 1
+        WHERE id = (SELECT user_id FROM updated)
+    ), notified AS (
+        {notified}
+    )
+    SELECT
+        target.user_id,
+        target.completed,
+        target.too_early,
+        target.expired,
+        -- Unlike the updates, notified only runs if it is read from.
+        (SELECT COUNT(*) FROM notified) > 0 AS updated
+    FROM target
+'''
+
+
+def complete_unit(unit_id, **kwargs):
+    '''Mark a given unit as completed. This must be done within the expiry
+    threshold of the unit’s expiry_time.
 
-    if has_ongoing_unit(user_id):
-        raise HasOngoingUnitAlready
+    :param unit_id: the ID of the unit
+    :type unit_id: `str` or `UUID`
+    :param user_id: only complete the unit if it belongs to this user
+    :raises UnitNotFound: if there is no such unit (for the user)
+    :raises UnitAlreadyCompleted: if the unit was already completed
+    :raises UnitNotYetComplete: if the unit has not reached its expiry_time
+    :raises UnitExpired: if the unit's expiry threshold has passed
+    '''
+    res = db.execute_sql(*complete_unit_query(unit_id, **kwargs)).fetchone()
+    user_id = complete_unit_result(res)
+    invalidate_ongoing_unit(user_id)
+    metrics.units_completed.inc()
+
+
+def complete_unit_query(unit_id, **kwargs):
+    ''':return: the SQL and parameters for complete_unit()'''
+    params = dict(
+        unit_id   = str(unit_id),
+        grace     = expiry_interval_seconds,
+        count     = 0,
+        completed = 1,
+        total     = True,
+        channel   = events.channel,
+        event     = events.COMPLETED,
+    )
 
-    res = Unit.insert(
-        user        = user_id,
-        expiry_time = SQL("NOW() + INTERVAL '%s seconds'", seconds),
-        description = description
-    ).execute()
+    user_filter = ''
+    if kwargs.get('user_id', False):
+        user_filter = 'AND user_id = %(user_id)s'
+        params['user_id'] = str(kwargs['user_id'])
 
-    return Unit.select().where(Unit.id == res).dicts().get()
+    sql = complete_unit_sql.format(
+        user_filter = user_filter,
+        rollup      = rollups.upsert(units = 'updated'),
+        notified    = events.notify_rows('updated'),
+    )
 
+    return (sql, params)
 
-def mark_complete(unit_id, **kwargs):
-    '''Mark a given unit as completed. This must be done within the expiry
-    threshold of the unit’s expiry_time.
 
-    :param unit_id: the ID of the unit
-    :type unit_id: `str` or `UUID`
-    :return: True if a unit was updated
-    :rtype: bool
+def complete_unit_result(res):
+    '''Interpret the row returned by complete_unit_sql.
+
+    :return: the ID of the completed unit's user
     '''
+    if res is None:
+        raise UnitNotFound('Unit not found')
 
-    filters = [
-        Unit.id == unit_id,
-        Unit.completed == False,
-        Unit.expiry_time <= SQL('NOW()'),
-        SQL('NOW() <= expiry_time + {}'.format(expiry_interval)),
-    ]
+    user_id, completed, too_early, expired, updated = res
+    if updated:
+        return user_id
+
+    if completed:
+        raise UnitAlreadyCompleted('Unit has already been marked complete')
+
+    if too_early:
+        raise UnitNotYetComplete('Unit is not yet complete')
+
+    if expired:
+        raise UnitExpired('Unit has expired')
+
+    # The unit changed between the lookup and the update, that is, it was
+    # completed concurrently.
+    raise UnitAlreadyCompleted('Unit has already been marked complete')
 
-    if kwargs.get('user_id', False):
-        filters.append(Unit.user == kwargs['user_id'])
 
-    res = Unit.update(completed = True).where(*filters).execute()
-    return res == 1
+def mark_complete(unit_id, **kwargs):
+    '''Like :func:`complete_unit`, but reports failure as False instead of
+    raising.
+
+    :return: True if a unit was updated
+    :rtype: bool
+    '''
+    try:
+        complete_unit(unit_id, **kwargs)
+        return True
+    except (UnitNotFound, UnitAlreadyCompleted,
+            UnitNotYetComplete, UnitExpired):
+        return False
 
 
 def validate_tag_csv(unit_id, tag_csv):
@@ -117,6 +394,80 @@ def validate_tag_csv(unit_id, tag_csv):
     return (valids, invalids)
 
 
+# Tags the units in one array with the names in the other, creating the unit
+# owners' tag names that don't exist yet. The no-op update makes the insert
+# return the tag names that already exist as well, including ones a
+# concurrent transaction has just inserted (which the statement's snapshot
+# can't see).
+insert_tags_sql = '''
+    WITH pairs AS (
+        SELECT pairs.unit_id, units.user_id, pairs.name
+        FROM unnest(%s::uuid[], %s::text[]) AS pairs (unit_id, name)
+        JOIN units ON units.id = pairs.unit_id
+    ), names AS (
+        INSERT INTO tag_names (user_id, name)
+        SELECT DISTINCT user_id, name FROM pairs
+        ON CONFLICT (user_id, name) DO UPDATE SET name = EXCLUDED.name
+        RETURNING id, user_id, name
+    ), inserted AS (
+        INSERT INTO tags (unit_id, tag_name_id)
+        SELECT pairs.unit_id, names.id
+        FROM pairs
+        JOIN names USING (user_id, name)
+        RETURNING unit_id, tag_name_id
+    )
+    SELECT inserted.unit_id, names.name
+    FROM inserted
+    JOIN names ON names.id = inserted.tag_name_id
+'''
+
+
+def insert_tags(unit_ids, names):
+    cursor = db.execute_sql(insert_tags_sql, (list(map(str, unit_ids)), names))
+    return cursor.fetchall()
+
+
+# Locks units for the rest of the transaction, in a consistent order so that
+# concurrent bulk retags can't deadlock.
+lock_units_sql = '''
+    SELECT id FROM units
+    WHERE id = ANY(%(unit_ids)s::uuid[]) {user_filter}
+    ORDER BY id
+    FOR UPDATE
+'''
+
+
+def lock_units_query(unit_ids, **kwargs):
+    ''':return: the SQL and parameters for lock_units()'''
+    params = dict(unit_ids = list(map(str, unit_ids)))
+
+    user_filter = ''
+    if kwargs.get('user_id', False):
+        user_filter = 'AND user_id = %(user_id)s'
+        params['user_id'] = str(kwargs['user_id'])
+
+    return (lock_units_sql.format(user_filter = user_filter), params)
+
+
+def check_locked_units(unit_ids, rows, **kwargs):
+    ''':raises UsageError: if a user was given and not all of the units were
+                           theirs
+    '''
+    if kwargs.get('user_id', False) and len(rows) != len(set(unit_ids)):
+        raise UsageError('Unauthorized')
+
+
+def lock_units(unit_ids, **kwargs):
+    '''Lock units, which must be done inside a transaction before anything
+    that reads their tags to change them (such as the rollups).
+
+    :param user_id: only lock the units if they all belong to this user
+    :raises UsageError: if they don't
+    '''
+    rows = db.execute_sql(*lock_units_query(unit_ids, **kwargs)).fetchall()
+    check_locked_units(unit_ids, rows, **kwargs)
+
+
 def set_tags(unit_id, tag_csv, **kwargs):
     '''Replace the tags of a unit with a given string of comma-separated tags.
 
@@ -130,27 +481,99 @@ def set_tags(unit_id, tag_csv, **kwargs):
     if len(tag_csv) > 0 and len(valids) == 0:
         raise ValidationError('No valid tags')
 
-    # Ensure this is the given user's unit.
-    if kwargs.get('user_id', False):
-        res =  Unit.select().where(
-            Unit.id == unit_id,
-            Unit.user == kwargs['user_id']
-        ).count()
-
-        if res != 1:
-            raise UsageError('Unauthorized')
-
-    with db.atomic() as trans:
+    tags = []
+    with db.atomic():
+        # This also ensures this is the given user's unit. Without the lock
+        # two concurrent retags would both subtract the old tags from the
+        # rollups.
+        lock_units([unit_id], **kwargs)
+        bump_revision_for_units([unit_id])
+        rollups.update(unit_id, count = -1, completed = -1, total = False)
         Tag.delete().where(
             Tag.unit_id == unit_id
         ).execute()
 
         if len(valids) > 0:
-            tags = Tag.insert_many(valids).returning(Tag.string).tuples().execute()
-            trans.commit()
-            return list(map(lambda t: t[0], tags))
+            res  = insert_tags(
+                [unit_id] * len(valids),
+                [valid['string'] for valid in valids])
+            tags = list(map(lambda t: t[1], res))
+            rollups.update(unit_id, count = 1, completed = 1, total = False)
+
+        events.notify_units(events.TAGGED, [unit_id])
+
+    # Units created by start_unit have already invalidated the cache.
+    if kwargs.get('user_id', False):
+        invalidate_ongoing_unit(kwargs['user_id'])
+
+    return tags
+
+
+def set_tags_bulk(tag_csvs, **kwargs):
+    '''Replace the tags of many units at once, given a dict of unit IDs to
+    strings of comma-separated tags. Each string is handled like in
+    :func:`set_tags`. All units are authorized and locked with one query and
+    the tags are replaced with set-based statements in a single transaction, so
+    either every unit is retagged or none are.
+
+    :param user_id: only retag the units if they all belong to this user
+    :return: dict of unit IDs to lists of their new tags
+    :raises ValidationError: if any string of tags is invalid
+    '''
+    try:
+        tag_csvs = dict((str(UUID(str(unit_id))), tag_csv)
+                        for unit_id, tag_csv in tag_csvs.items())
+    except ValueError:
+        raise ValidationError('Invalid unit ID')
+
+    unit_ids = list(tag_csvs)
+    tags     = dict((unit_id, []) for unit_id in unit_ids)
+
+    unit_column   = []
+    string_column = []
+    for unit_id, tag_csv in tag_csvs.items():
+        valids, invalids = validate_tag_csv(unit_id, tag_csv)
+        if len(tag_csv) > 0 and len(valids) == 0:
+            raise ValidationError('No valid tags for unit {}'.format(unit_id))
 
-    return []
+        for valid in valids:
+            unit_column.append(valid['unit'])
+            string_column.append(valid['string'])
+
+    if not unit_ids:
+        return tags
+
+    with db.atomic():
+        lock_units(unit_ids, **kwargs)
+        bump_revision_for_units(unit_ids)
+        rollups.update_many(unit_ids, count = -1, completed = -1, total = False)
+        db.execute_sql(
+            'DELETE FROM tags WHERE unit_id = ANY(%s::uuid[])', (unit_ids,))
+
+        if unit_column:
+            for unit_id, name in insert_tags(unit_column, string_column):
+                tags[str(unit_id)].append(name)
+
+            rollups.update_many(unit_ids, count = 1, completed = 1, total = False)
+
+        events.notify_units(events.TAGGED, unit_ids)
+
+    if kwargs.get('user_id', False):
+        invalidate_ongoing_unit(kwargs['user_id'])
+
+    return tags
+
+
+def tags_array():
+    '''An aggregate of the joined tag names as a postgres array, which
+    psycopg2 returns as a list. Units without tags get an empty list rather
+    than the NULL from the LEFT JOIN.
+    '''
+    names = peewee.Clause(
+        peewee.fn.array_agg(TagName.name),
+        SQL('FILTER (WHERE'), TagName.name.is_null(False), SQL(')'))
+
+    return peewee.fn.COALESCE(names, SQL("'{}'::text[]")).coerce(False)
 
 
 def get_unit(unit_id, **kwargs):
@@ -160,48 +583,392 @@ def get_unit(unit_id, **kwargs):
 
     return Unit.select(
         Unit,
-        peewee.fn.string_agg(Tag.string, SQL("', '")).alias('tags')
+        tags_array().alias('tags')
     ).join(
         Tag, peewee.JOIN.LEFT_OUTER
+    ).join(
+        TagName, peewee.JOIN.LEFT_OUTER
     ).where(*filters).group_by(Unit).dicts().get()
 
 
-def get_units(user_id, date_a, date_b):
-    return Unit.select(
-        Unit, peewee.fn.string_agg(Tag.string, SQL("', '")).alias('tags')
-    ).join(Tag, peewee.JOIN.LEFT_OUTER).where(
+def query_units_with_tag(user_id, tag):
+    '''IDs of a user's units with a given tag. The tag name is found through
+    the unique (user_id, name) index and its units through the tags
+    (tag_name_id, unit_id) index.
+    '''
+    return Tag.select(Tag.unit).join(TagName).where(
+        TagName.user == user_id,
+        TagName.name == tag
+    )
+
+
+def encode_cursor(unit):
+    '''An opaque cursor for continuing :func:`get_units` after a unit. It
+    holds the unit's position (its start_time and ID) rather than a
+    reference to it, so it still works if the unit is deleted.
+    '''
+    value = '{},{}'.format(unit['start_time'].isoformat(), unit['id'])
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    ''':return: the (start_time, id) a cursor from encode_cursor() holds
+    :raises ValidationError: if it isn't such a cursor
+    '''
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        start_time, unit_id = value.split(',')
+        return (iso8601.parse_date(start_time), UUID(unit_id))
+    except (ValueError, iso8601.ParseError):
+        raise ValidationError('Invalid cursor')
+
+
+def get_units(user_id, date_a, date_b, limit = None, after = None, tag = None,
+              expired = None):
+    '''Get a user's units that started between two dates, most recent first.
+
+    Results are keyset paginated: pass the cursor of the last unit of the
+    previous page (see :func:`encode_cursor`) as ``after`` to get the units
+    that follow it. This has the same cost for every page, unlike an OFFSET.
+
+    :param limit: maximum number of units to return
+    :param str after: the cursor to continue after
+    :param str tag: only get units with this tag
+    :param bool expired: only get units that are (True) or aren't (False)
+                         expired, by the flag nightshades.sweeper sets
+    :raises ValidationError: if the cursor is invalid
+    '''
+    query = Unit.select(
+        Unit, tags_array().alias('tags')
+    ).join(
+        Tag, peewee.JOIN.LEFT_OUTER
+    ).join(
+        TagName, peewee.JOIN.LEFT_OUTER
+    ).where(
         Unit.user == user_id,
-        SQL('start_time BETWEEN SYMMETRIC %s AND %s', date_a, date_b),
-    ).group_by(Unit).order_by(Unit.start_time.desc()).dicts()
+        # Rather than BETWEEN SYMMETRIC, so that this is a range scan.
+        SQL('start_time >= LEAST(%s::timestamptz, %s::timestamptz)',
+            date_a, date_b),
+        SQL('start_time <= GREATEST(%s::timestamptz, %s::timestamptz)',
+            date_a, date_b),
+    )
+
+    if tag:
+        query = query.where(Unit.id << query_units_with_tag(user_id, tag))
+
+    if expired is not None:
+        query = query.where(Unit.expired == expired)
+
+    if after:
+        start_time, unit_id = decode_cursor(after)
+        query = query.where(
+            peewee.EnclosedClause(Unit.start_time, Unit.id) <
+            peewee.EnclosedClause(SQL('%s::timestamptz', start_time),
+                                  SQL('%s::uuid', str(unit_id)))
+        )
+
+    query = query.group_by(Unit).order_by(Unit.start_time.desc(), Unit.id.desc())
+    if limit:
+        query = query.limit(limit)
+
+    return query.dicts()
+
+
+def iter_units(user_id, itersize = 2000):
+    '''Yield every unit a user has, oldest first, as a dict. This uses a
+    server-side cursor so rows are fetched ``itersize`` at a time instead of
+    loading the user's whole history into memory.
+
+    Unlike the other functions here rows come straight from psycopg2, so IDs
+    are strings rather than `UUID`.
+    '''
+    sql, params = Unit.select(
+        Unit.id, Unit.completed, Unit.description,
+        Unit.start_time, Unit.expiry_time,
+        tags_array().alias('tags')
+    ).join(
+        Tag, peewee.JOIN.LEFT_OUTER
+    ).join(
+        TagName, peewee.JOIN.LEFT_OUTER
+    ).where(
+        Unit.user == user_id
+    ).group_by(Unit).order_by(Unit.start_time, Unit.id).sql()
+
+    # Named cursors only live as long as the transaction they were opened in.
+    with db.transaction():
+        cursor = db.get_conn().cursor('units_{}'.format(uuid4().hex))
+        cursor.itersize = itersize
+        cursor.execute(sql, params)
+
+        try:
+            columns = None
+            for row in cursor:
+                if columns is None:
+                    columns = [column[0] for column in cursor.description]
+
+                yield dict(zip(columns, row))
+        finally:
+            cursor.close()
+
+
+def fetch_dicts(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def execute_stats_sql(sql, params):
+    try:
+        return db.execute_sql(sql, params)
+    except peewee.DataError as e:
+        logging.error(e)
+        raise ValidationError('Invalid timezone')
+
+
+def get_unit_totals(user_id, date_a, date_b, period = 'day', timezone = 'UTC'):
+    '''Totals of a user's units per day or week, computed by postgres. In UTC
+    these come from the daily rollups, so whole days are counted.
+
+    :param str period: either ``day`` or ``week``
+    :param str timezone: the timezone whose days and weeks are used
+    :return: list of dicts with the ``period`` (date it starts on), ``units``,
+             ``completed`` and focused ``seconds`` (of completed units)
+    :raises ValidationError: if the period or timezone is invalid
+    '''
+    if period not in valid_stats_periods:
+        raise ValidationError('Period must be one of {}'.format(
+            ', '.join(valid_stats_periods)))
+
+    params = dict(
+        period  = period,
+        tz      = timezone,
+        user_id = str(user_id),
+        date_a  = date_a,
+        date_b  = date_b,
+    )
+
+    if timezone == rollups.timezone:
+        cursor = db.execute_sql('''
+            SELECT
+                date_trunc(%(period)s, day)::date AS period,
+                SUM(count) AS units,
+                SUM(completed_count) AS completed,
+                SUM(seconds)::bigint AS seconds
+            FROM daily_unit_rollups
+            WHERE user_id = %(user_id)s
+              AND tag = ''
+              AND day BETWEEN SYMMETRIC
+                  (%(date_a)s::timestamptz AT TIME ZONE %(tz)s)::date AND
+                  (%(date_b)s::timestamptz AT TIME ZONE %(tz)s)::date
+            GROUP BY 1
+            HAVING SUM(count) > 0
+            ORDER BY 1
+        ''', params)
+
+        return fetch_dicts(cursor)
+
+    cursor = execute_stats_sql('''
+        SELECT
+            date_trunc(%(period)s, start_time AT TIME ZONE %(tz)s)::date AS period,
+            COUNT(*) AS units,
+            COUNT(*) FILTER (WHERE completed) AS completed,
+            COALESCE(SUM(EXTRACT(EPOCH FROM expiry_time - start_time))
+                     FILTER (WHERE completed), 0)::bigint AS seconds
+        FROM units
+        WHERE user_id = %(user_id)s
+          AND start_time BETWEEN SYMMETRIC %(date_a)s AND %(date_b)s
+        GROUP BY 1
+        ORDER BY 1
+    ''', params)
+
+    return fetch_dicts(cursor)
+
+
+def get_tag_totals(user_id, date_a, date_b):
+    '''Totals of a user's units per tag over the (UTC) days between two
+    dates, most focused seconds first. These come from the daily rollups.
+
+    :return: list of dicts with the ``tag``, ``units``, ``completed`` and
+             focused ``seconds`` (of completed units)
+    '''
+    cursor = db.execute_sql('''
+        SELECT
+            tag,
+            SUM(count) AS units,
+            SUM(completed_count) AS completed,
+            SUM(seconds)::bigint AS seconds
+        FROM daily_unit_rollups
+        WHERE user_id = %(user_id)s
+          AND tag <> ''
+          AND day BETWEEN SYMMETRIC
+              (%(date_a)s::timestamptz AT TIME ZONE %(tz)s)::date AND
+              (%(date_b)s::timestamptz AT TIME ZONE %(tz)s)::date
+        GROUP BY tag
+        HAVING SUM(count) > 0
+        ORDER BY seconds DESC, tag
+    ''', dict(
+        tz      = rollups.timezone,
+        user_id = str(user_id),
+        date_a  = date_a,
+        date_b  = date_b,
+    ))
+
+    return fetch_dicts(cursor)
+
+
+def get_streak(user_id, timezone = 'UTC'):
+    '''The user's current streak: consecutive days, ending today or
+    yesterday, on which they completed at least one unit.
+
+    :return: dict with the streak ``days`` and the date it ``started`` on
+             (``None`` without a streak)
+    :raises ValidationError: if the timezone is invalid
+    '''
+    if timezone == rollups.timezone:
+        days = '''
+            SELECT day FROM daily_unit_rollups
+            WHERE user_id = %(user_id)s AND tag = '' AND completed_count > 0
+        '''
+    else:
+        days = '''
+            SELECT DISTINCT (start_time AT TIME ZONE %(tz)s)::date AS day
+            FROM units
+            WHERE user_id = %(user_id)s AND completed
+        '''
+
+    # Subtracting a day's rank from it gives the same date for every day in
+    # an unbroken run ("gaps and islands").
+    cursor = execute_stats_sql('''
+        WITH days AS ({days}), islands AS (
+            SELECT day, day - (ROW_NUMBER() OVER (ORDER BY day))::int AS island
+            FROM days
+        )
+        SELECT
+            COUNT(*) AS days,
+            MIN(day) AS started,
+            MAX(day) >= (NOW() AT TIME ZONE %(tz)s)::date - 1 AS current
+        FROM islands
+        GROUP BY island
+        ORDER BY MAX(day) DESC
+        LIMIT 1
+    '''.format(days = days), dict(tz = timezone, user_id = str(user_id)))
+
+    res = cursor.fetchone()
+    if res is None or not res[2]:
+        return { 'days': 0, 'started': None }
+
+    return { 'days': res[0], 'started': res[1] }
 
 
 def query_ongoing_unit(user_id):
     unit = Unit.select().where(
         Unit.user == user_id,
         Unit.completed == False,
-        Unit.expiry_time >= datetime.datetime.now()
+        Unit.expiry_time >= peewee.fn.NOW()
     ).order_by(Unit.start_time.desc())
 
     return unit
 
 
+def ongoing_unit_cache_key(user_id):
+    # A User instance is accepted wherever a user ID is.
+    return 'nightshades:ongoing_unit:{}'.format(getattr(user_id, 'id', user_id))
+
+
+def invalidate_ongoing_unit(user_id):
+    cache.delete(ongoing_unit_cache_key(user_id))
+
+
 def get_ongoing_unit(user_id):
-    try:
-        return query_ongoing_unit(user_id).dicts().get()
-    except peewee.DoesNotExist as e:
-        logging.error(e)
+    '''Get the user's ongoing unit. Results, including the lack of an
+    ongoing unit, are cached (see nightshades.cache) until the unit expires
+    or the user's units change.
+
+    :raises NoOngoingUnit: if the user has no ongoing unit
+    '''
+    key  = ongoing_unit_cache_key(user_id)
+    unit = cache.get(key, default = False)
+    if unit is False:
+        try:
+            unit = query_ongoing_unit(user_id).dicts().get()
+            now  = datetime.datetime.now(datetime.timezone.utc)
+            cache.set(key, unit, (unit['expiry_time'] - now).total_seconds())
+        except peewee.DoesNotExist as e:
+            logging.error(e)
+            unit = None
+            cache.set(key, unit)
+
+    if unit is None:
         raise NoOngoingUnit
 
+    return unit
+
 
 def has_ongoing_unit(user_id):
-    return query_ongoing_unit(user_id).count()
+    try:
+        get_ongoing_unit(user_id)
+        return True
+    except NoOngoingUnit:
+        return False
+
+
+# Deletes the user's ongoing unit (see query_ongoing_unit), removes it from
+# the rollups, bumps the user's revision and publishes the cancelled event,
+# all in one statement. The deleted unit's tags are still visible to the
+# rollup since every part of the statement sees the same snapshot.
+cancel_ongoing_unit_sql = '''
+    WITH deleted AS (
+        DELETE FROM units
+        WHERE id = (
+            SELECT id FROM units
+            WHERE user_id = %(user_id)s
+              AND NOT completed
+              AND expiry_time >= NOW()
+            ORDER BY start_time DESC
+            LIMIT 1
+        ) AND NOT completed
+        RETURNING units.*
+    ), rollup AS (
+        {rollup}
+    ), revision AS (
+        UPDATE users SET revision = revision + 1
+        WHERE id = (SELECT user_id FROM deleted)
+    ), notified AS (
+        {notified}
+    )
+    SELECT id FROM notified
+'''
+
+
+def cancel_ongoing_unit_query(user_id):
+    ''':return: the SQL and parameters for cancel_ongoing_unit()'''
+    sql = cancel_ongoing_unit_sql.format(
+        rollup   = rollups.upsert(units = 'deleted'),
+        notified = events.notify_rows('deleted'),
+    )
+
+    return (sql, dict(
+        user_id   = str(getattr(user_id, 'id', user_id)),
+        count     = -1,
+        completed = -1,
+        total     = True,
+        channel   = events.channel,
+        event     = events.CANCELLED,
+    ))
 
 
 # You can't cancel an ongoing unit that has exceeded its expiry_time, even if
 # it is still within the grace period of the expiry threshold.
 def cancel_ongoing_unit(user_id):
-    unit = query_ongoing_unit(user_id)
-    return unit.get().delete_instance()
+    ''':return: the number of units cancelled, 1
+    :raises peewee.DoesNotExist: if there is no ongoing unit
+    '''
+    res = db.execute_sql(*cancel_ongoing_unit_query(user_id)).rowcount
+    if res == 0:
+        raise Unit.DoesNotExist
+
+    invalidate_ongoing_unit(user_id)
+    metrics.units_cancelled.inc()
+    return res
 
 
 def register_user(name, provider, provider_user_id):
@@ -229,6 +996,61 @@ def register_user(name, provider, provider_user_id):
         raise ValidationError('Provider ID already used')
 
 
+# Finds the user behind a login provider account, creating both when it's
+# new. If a concurrent request creates the login first, the login insert does
+# nothing and no row comes back.
+login_or_register_sql = '''
+    WITH existing AS (
+        SELECT user_id FROM login_providers
+        WHERE provider = %(provider)s AND provider_user_id = %(provider_user_id)s
+    ), new_user AS (
+        INSERT INTO users (name)
+        SELECT %(name)s WHERE NOT EXISTS (SELECT 1 FROM existing)
+        RETURNING id
+    ), new_login AS (
+        INSERT INTO login_providers (user_id, provider, provider_user_id)
+        SELECT id, %(provider)s, %(provider_user_id)s FROM new_user
+        ON CONFLICT (provider, provider_user_id) DO NOTHING
+        RETURNING user_id
+    )
+    SELECT user_id FROM existing
+    UNION ALL
+    SELECT user_id FROM new_login
+'''
+
+
+def login_or_register(name, provider, provider_user_id):
+    '''Get the ID of the user with a given login provider account,
+    registering them if there is none, in a single query. Safe to call
+    concurrently for the same account.
+
+    :return: the user's ID
+    :rtype: `UUID`
+    :raises InvalidLoginProvider: if the provider isn't supported
+    '''
+    if provider not in valid_login_providers:
+        raise InvalidLoginProvider
+
+    params = dict(
+        name             = name,
+        provider         = provider,
+        provider_user_id = str(provider_user_id),
+    )
+
+    # A second attempt will see the login created by the concurrent request.
+    for attempt in range(2):
+        with db.atomic() as trans:
+            res = db.execute_sql(login_or_register_sql, params).fetchone()
+            if res is not None:
+                metrics.logins.inc(provider = provider)
+                return UUID(str(res[0]))
+
+            # Don't keep the user created for the login that lost the race.
+            trans.rollback()
+
+    raise UsageError('Could not log in')
+
+
 def login_via_provider(provider, provider_user_id):
     return User.select().join(LoginProvider).where(
         LoginProvider.provider == provider,
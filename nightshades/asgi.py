@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+'''An ASGI application serving the same /v1 routes as nightshades.http
+(authentication, /me and /units), with the same JSON payloads and errors,
+on top of nightshades.aio. Run it with ``run_asgi.py``.
+
+It reads its settings from the environment rather than from an app config,
+since every worker process imports it separately.
+'''
+import os
+import re
+import json
+import asyncio
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs, urlencode
+
+import jwt
+import peewee
+import socialauth
+
+from . import api, aio, jsonapi
+from .jsonapi import (
+    add_date_meta, serialize_user_data, parse_date_arg, parse_bool_arg,
+    parse_page_args
+)
+from .jsonapi import InvalidAPIUsage, Unauthorized, error_document
+from .tokens import decode_token
+
+secret_key    = os.environ.get('NIGHTSHADES_APP_SECRET')
+cors          = os.environ.get('NIGHTSHADES_CORS', False)
+cookie_domain = os.environ.get('NIGHTSHADES_COOKIE_DOMAIN', None)
+public_origin = os.environ.get('NIGHTSHADES_PUBLIC_ORIGIN', None)
+
+
+class Request(object):
+    def __init__(self, scope, body):
+        self.method       = scope['method']
+        self.path         = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args         = dict(
+            (k, v[0]) for k, v in parse_qs(self.query_string).items())
+        self.headers      = dict(
+            (k.decode('latin-1').lower(), v.decode('latin-1'))
+            for k, v in scope.get('headers', []))
+        self.body         = body
+        self.user_id      = None
+        self.today        = None
+
+        self.cookies = {}
+        cookie = SimpleCookie()
+        cookie.load(self.headers.get('cookie', ''))
+        for key, morsel in cookie.items():
+            self.cookies[key] = morsel.value
+
+        scheme = scope.get('scheme', 'http')
+        host   = self.headers.get('host', 'localhost')
+        self.base_url  = '{}://{}{}'.format(scheme, host, self.path)
+        self.full_path = '{}?{}'.format(self.path, self.query_string)
+
+    def get_json(self):
+        content_type = self.headers.get('content-type', '')
+        if content_type.split(';')[0].strip() != 'application/json':
+            return None
+
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            raise InvalidAPIUsage('Bad Request')
+
+
+class Response(object):
+    def __init__(self, body = b'', status = 200, content_type = 'text/html'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        self.body    = body
+        self.status  = status
+        self.headers = [('Content-Type', content_type)]
+
+    def set_cookie(self, key, value, expires = None):
+        cookie = SimpleCookie()
+        cookie[key] = value
+        cookie[key]['path']     = '/'
+        cookie[key]['httponly'] = True
+        if cookie_domain:
+            cookie[key]['domain'] = cookie_domain
+        if expires == 0:
+            cookie[key]['expires'] = 'Thu, 01 Jan 1970 00:00:00 GMT'
+
+        self.headers.append(('Set-Cookie', cookie[key].OutputString()))
+
+    async def send(self, send, receive):
+        headers = self.headers + [('Content-Length', str(len(self.body)))]
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': [
+                (k.encode('latin-1'), v.encode('latin-1')) for k, v in headers
+            ],
+        })
+        await send({ 'type': 'http.response.body', 'body': self.body })
+
+
+class EventStream(Response):
+    '''Streams a user's unit events (see nightshades.events) as server-sent
+    events until the client disconnects.
+    '''
+    keepalive_seconds = 15
+
+    def __init__(self, user_id):
+        Response.__init__(self, content_type = 'text/event-stream')
+        self.headers.extend([
+            ('Cache-Control', 'no-cache'),
+            ('X-Accel-Buffering', 'no'),
+        ])
+        self.user_id = user_id
+
+    async def send(self, send, receive):
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': [
+                (k.encode('latin-1'), v.encode('latin-1'))
+                for k, v in self.headers
+            ],
+        })
+
+        queue        = aio.listener.subscribe(self.user_id)
+        disconnected = asyncio.ensure_future(receive())
+        try:
+            while True:
+                event = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                    [event, disconnected],
+                    timeout     = self.keepalive_seconds,
+                    return_when = asyncio.FIRST_COMPLETED)
+
+                if disconnected in done:
+                    event.cancel()
+                    return
+
+                if event in done:
+                    body = 'event: {}\ndata: {}\n\n'.format(
+                        event.result()['event'], json.dumps(event.result()))
+                else:
+                    event.cancel()
+                    body = ': keepalive\n\n'
+
+                await send({
+                    'type': 'http.response.body',
+                    'body': body.encode('utf-8'),
+                    'more_body': True,
+                })
+        finally:
+            disconnected.cancel()
+            aio.listener.unsubscribe(self.user_id, queue)
+
+
+def jsonify(obj, status = 200):
+    return Response(json.dumps(obj), status, 'application/json')
+
+
+def json_error(status, title):
+    return jsonify(error_document(status, title), status)
+
+
+def redirect(location):
+    resp = Response('', 302)
+    resp.headers.append(('Location', location))
+    return resp
+
+
+def url_for_unit(unit_id):
+    return '/v1/units/{}'.format(unit_id)
+
+
+def url_for_units(args):
+    if not args:
+        return '/v1/units'
+
+    return '/v1/units?{}'.format(urlencode(args))
+
+
+def serialize_unit_data(unit):
+    return jsonapi.serialize_unit_data(unit, url_for_unit)
+
+
+# Handlers take the request and the URL's parameters and return a Response.
+# These wrap them like the decorators in nightshades.http.api.v1.decorators.
+
+def logged_in(func):
+    async def wrapped(request, **kwargs):
+        token = request.cookies.get('jwt', False)
+        try:
+            user_id = decode_token(token, secret_key) if token else False
+        except InvalidAPIUsage as e:
+            raise Unauthorized(e.message)
+
+        if not user_id:
+            raise Unauthorized
+
+        request.user_id = user_id
+        return await func(request, **kwargs)
+
+    return wrapped
+
+
+def validate_uuid(func):
+    async def wrapped(request, **kwargs):
+        if not jsonapi.is_uuid(kwargs['uuid']):
+            raise peewee.DoesNotExist
+
+        return await func(request, **kwargs)
+
+    return wrapped
+
+
+def validate_payload(type, attributes_required = False):
+    def decorator(func):
+        async def wrapped(request, **kwargs):
+            jsonapi.validate_payload(request.get_json(), type, attributes_required)
+            return await func(request, **kwargs)
+
+        return wrapped
+    return decorator
+
+
+def if_none_match(request):
+    tags = set()
+    for tag in request.headers.get('if-none-match', '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+
+        tags.add(tag.strip('"'))
+
+    return tags
+
+
+def etagged(func):
+    async def wrapped(request, **kwargs):
+        request.today = await aio.get_revision_and_today(request.user_id)
+        etag = jsonapi.etag(request.user_id, request.today, request.full_path)
+
+        matches = if_none_match(request)
+        if etag in matches or '*' in matches:
+            resp = Response('', 304)
+            resp.headers.append(('ETag', 'W/"{}"'.format(etag)))
+            return resp
+
+        resp = await func(request, **kwargs)
+        if resp.status == 200:
+            resp.headers.append(('ETag', 'W/"{}"'.format(etag)))
+
+        return resp
+
+    return wrapped
+
+
+async def authenticate(request, provider):
+    loop = asyncio.get_event_loop()
+    res  = await loop.run_in_executor(
+        None,
+        socialauth.http_get_provider,
+        provider,
+        request.base_url,
+        request.args,
+        secret_key,
+        request.cookies.get('jwt')
+    )
+
+    if res.get('status') == 302:
+        resp = redirect(res.get('redirect'))
+        if request.args.get('postMessage', False) == 'true':
+            resp.set_cookie('postMessage', 'true')
+
+        token = res.get('set_token_cookie', False)
+        if token:
+            resp.set_cookie('jwt', token)
+
+        return resp
+
+    if res.get('status') == 200:
+        return await complete_flow(request, provider, res)
+
+    return json_error(400, 'Bad Request')
+
+
+async def complete_flow(request, provider, res):
+    opener_url = request.cookies.get('postMessage', False)
+    if opener_url and public_origin:
+        resp = Response('''
+        <script type='text/javascript'>
+        window.opener.postMessage('COMPLETE', '{}')
+        </script>
+        '''.format(public_origin))
+
+        resp.set_cookie('postMessage', '', expires = 0)
+    else:
+        resp = jsonify({ 'status': 'success' })
+
+    cookie = request.cookies.get('jwt', False)
+    if cookie:
+        user_id = decode_token(cookie, secret_key)
+        if user_id:
+            puid = res.get('provider_user_id')
+            await aio.add_new_provider(user_id, provider, puid)
+
+            # Set to the same value
+            resp.set_cookie('jwt', cookie)
+            return resp
+
+    user_id = await aio.login_or_register(
+        res.get('provider_user_name'),
+        provider,
+        res.get('provider_user_id')
+    )
+    token = jwt.encode({ 'user_id': str(user_id) }, secret_key, algorithm = 'HS256')
+    resp.set_cookie('jwt', token.decode('utf-8'))
+    return resp
+
+
+async def logout(request):
+    resp = jsonify({ 'status': 'success' })
+    resp.set_cookie('jwt', '', expires = 0)
+    return resp
+
+
+@logged_in
+@etagged
+async def me(request):
+    user = await aio.get_user(request.user_id)
+    return jsonify(add_date_meta({ 'data': serialize_user_data(user) }))
+
+
+@logged_in
+@validate_payload(type = 'user', attributes_required = True)
+async def update_me(request):
+    attributes = request.get_json()['data']['attributes']
+    if 'timezone' not in attributes:
+        raise InvalidAPIUsage('No operations to perform')
+
+    await aio.set_timezone(request.user_id, attributes['timezone'])
+
+    user = await aio.get_user(request.user_id)
+    return jsonify(add_date_meta({ 'data': serialize_user_data(user) }))
+
+
+@logged_in
+async def delete_unit(request):
+    await aio.cancel_ongoing_unit(request.user_id)
+    return jsonify({ 'status': 'success' })
+
+
+@logged_in
+@etagged
+async def index_units(request):
+    # Listings default to the user's today, by postgres' clock (see etagged).
+    date_a = parse_date_arg(request.args, 'filter[from]', request.today['start'])
+    date_b = parse_date_arg(request.args, 'filter[to]', request.today['end'])
+    size, after = parse_page_args(request.args)
+
+    tag     = request.args.get('filter[tag]', None)
+    expired = parse_bool_arg(request.args, 'filter[expired]')
+
+    # Fetch one extra unit to find out whether there is a next page.
+    units = await aio.get_units(
+        request.user_id, date_a, date_b, limit = size + 1, after = after,
+        tag = tag, expired = expired)
+
+    args = {
+        'filter[from]': date_a.isoformat(),
+        'filter[to]': date_b.isoformat(),
+        'page[size]': size,
+    }
+    if tag:
+        args['filter[tag]'] = tag
+    if expired is not None:
+        args['filter[expired]'] = request.args['filter[expired]']
+
+    ret = {}
+    ret['links'] = { 'self': url_for_units(request.args) }
+    if len(units) > size:
+        units = units[:size]
+        args['page[after]'] = api.encode_cursor(units[-1])
+        ret['links']['next'] = url_for_units(args)
+
+    ret['data']  = list(map(serialize_unit_data, units))
+    return jsonify(add_date_meta(ret))
+
+
+@logged_in
+async def unit_events(request):
+    return EventStream(request.user_id)
+
+
+@logged_in
+@validate_payload(type='unit', attributes_required=True)
+async def create_unit(request):
+    payload     = request.get_json()['data']
+    attributes  = payload['attributes']
+    seconds     = attributes.get('delta', 1500)
+    description = attributes.get('description', None)
+    result      = await aio.start_unit(request.user_id, seconds, description)
+
+    tags = attributes.get('tags', None)
+    if tags:
+        valid_tags = await aio.set_tags(result.get('id'), tags)
+        result['tags'] = valid_tags
+
+    ret = { 'data': serialize_unit_data(result) }
+    return jsonify(add_date_meta(ret), 201)
+
+
+@logged_in
+@validate_uuid
+@etagged
+async def show_unit(request, uuid):
+    unit = await aio.get_unit(uuid, user_id = request.user_id)
+
+    ret  = { 'data': serialize_unit_data(unit) }
+    return jsonify(add_date_meta(ret))
+
+
+@logged_in
+@validate_uuid
+@validate_payload(type = 'unit', attributes_required = True)
+async def update_unit(request, uuid):
+    attributes = request.get_json()['data']['attributes']
+
+    tags = attributes.get('tags', False)
+    if tags:
+        valid_tags = await aio.set_tags(uuid, tags, user_id = request.user_id)
+        return jsonify(add_date_meta({
+            'data': serialize_unit_data({
+                'id': uuid,
+                'tags': valid_tags
+            })
+        }))
+
+    if attributes.get('completed', False):
+        await aio.complete_unit(uuid, user_id = request.user_id)
+
+        return jsonify(add_date_meta({
+            'data': serialize_unit_data({
+                'id': uuid,
+                'completed': True
+            })
+        }))
+
+    raise InvalidAPIUsage('No operations to perform')
+
+
+routes = [
+    (r'/v1/auth/(?P<provider>[^/]+)', { 'GET': authenticate }),
+    (r'/v1/logout', { 'GET': logout }),
+    (r'/v1/me', { 'GET': me, 'PATCH': update_me }),
+    (r'/v1/units', {
+        'GET': index_units,
+        'POST': create_unit,
+        'DELETE': delete_unit,
+    }),
+    (r'/v1/units/events', { 'GET': unit_events }),
+    (r'/v1/units/(?P<uuid>[^/]+)', {
+        'GET': show_unit,
+        'PATCH': update_unit,
+    }),
+]
+routes = [(re.compile(pattern + '$'), methods) for pattern, methods in routes]
+
+
+def apply_cors(resp):
+    if cors:
+        resp.headers.extend([
+            ('Access-Control-Allow-Origin', cors),
+            ('Access-Control-Allow-Credentials', 'true'),
+            ('Access-Control-Allow-Methods', 'OPTIONS, GET, POST, PATCH, DELETE'),
+            ('Access-Control-Allow-Headers', 'content-type'),
+        ])
+
+    return resp
+
+
+async def dispatch(request):
+    for pattern, methods in routes:
+        match = pattern.match(request.path)
+        if not match:
+            continue
+
+        if request.method == 'OPTIONS':
+            return Response('')
+
+        handler = methods.get(request.method)
+        if handler is None:
+            return json_error(405, 'Method Not Allowed')
+
+        try:
+            return await handler(request, **match.groupdict())
+        except peewee.DoesNotExist:
+            return json_error(404, 'Not Found')
+        except api.HasOngoingUnitAlready:
+            return json_error(400, 'Unit already ongoing')
+        except api.UsageError as e:
+            return json_error(getattr(e, 'status_code', 400), e.message)
+
+    return json_error(404, 'Not Found')
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await aio.connect()
+            await send({ 'type': 'lifespan.startup.complete' })
+        elif message['type'] == 'lifespan.shutdown':
+            await aio.close()
+            await send({ 'type': 'lifespan.shutdown.complete' })
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    request = Request(scope, await read_body(receive))
+    resp    = await dispatch(request)
+    if request.path.startswith('/v1/'):
+        apply_cors(resp)
+
+    await resp.send(send, receive)
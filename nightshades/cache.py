@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''A small cache for hot reads in nightshades.api.
+
+Values are pickled and handed to a backend with a subset of the redis-py
+client interface: ``get(key)``, ``set(key, value, ex = seconds)`` and
+``delete(*keys)``. The default backend is an in-process LRU, which is only
+invalidated by writes made in the same process. With several processes,
+share a redis client instead::
+
+    nightshades.cache.configure(redis.StrictRedis())
+'''
+import os
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''An in-process, thread-safe LRU cache with per-key expiry.'''
+    def __init__(self, max_size = 10000, clock = time.monotonic):
+        self.max_size = max_size
+        self.clock    = clock
+        self.entries  = OrderedDict()
+        self.lock     = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires is not None and expires <= self.clock():
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ex = None):
+        expires = None if ex is None else self.clock() + ex
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+
+        return True
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(1 for key in keys if self.entries.pop(key, None))
+
+
+backend = LRUCache(int(os.environ.get('NIGHTSHADES_CACHE_MAX_SIZE', 10000)))
+
+# How long (in seconds) a cached read may be served. Keep this short with the
+# in-process backend since other processes' writes don't invalidate it.
+ttl = int(os.environ.get('NIGHTSHADES_CACHE_TTL', 5))
+
+
+def configure(cache_backend = None, cache_ttl = None):
+    '''Replace the backend (anything redis-compatible) and/or the TTL.'''
+    global backend, ttl
+    if cache_backend is not None:
+        backend = cache_backend
+
+    if cache_ttl is not None:
+        ttl = cache_ttl
+
+
+def get(key, default = None):
+    '''Get a cached value, or ``default`` if it isn't cached. Pass a default
+    other than None to tell a cached None apart from a miss.
+    '''
+    value = backend.get(key)
+    if value is None:
+        return default
+
+    return pickle.loads(value)
+
+
+def set(key, value, seconds = None):
+    '''Cache a value for ``seconds`` (at most the configured TTL).'''
+    seconds = int(ttl if seconds is None else min(seconds, ttl))
+    if seconds <= 0:
+        return
+
+    backend.set(key, pickle.dumps(value), ex = seconds)
+
+
+def delete(*keys):
+    if keys:
+        backend.delete(*keys)
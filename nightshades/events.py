@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''Unit lifecycle events, published with postgres NOTIFY on ``channel``.
+
+The write functions in nightshades.api (and nightshades.aio) publish an event
+in the same transaction as the change, so listeners only hear about changes
+that were committed. Each payload is a JSON object like::
+
+    {"event": "completed", "user_id": "…", "unit_id": "…"}
+
+nightshades.aio.listener subscribes to these for the ASGI app's event stream.
+'''
+import json
+
+from .models import db
+
+channel = 'nightshades_units'
+
+STARTED   = 'started'
+TAGGED    = 'tagged'
+COMPLETED = 'completed'
+CANCELLED = 'cancelled'
+EXPIRED   = 'expired'
+
+notify_sql = 'SELECT pg_notify(%s, %s)'
+
+# Publishes an event for each of the units, looking their users up.
+notify_units_sql = '''
+    SELECT pg_notify(%s, json_build_object(
+        'event', %s::text,
+        'user_id', user_id,
+        'unit_id', id
+    )::text)
+    FROM units WHERE id = ANY(%s::uuid[])
+'''
+
+# Publishes an event for each row of a relation with the units table's id and
+# user_id columns, such as the RETURNING of a data-modifying CTE, and passes
+# the rows on. Takes the ``channel`` and ``event`` parameters. As a SELECT in
+# a CTE this only runs if the statement reads from it.
+notify_rows_sql = '''
+    SELECT {rows}.*, pg_notify(%(channel)s, json_build_object(
+        'event', %(event)s::text,
+        'user_id', {rows}.user_id,
+        'unit_id', {rows}.id
+    )::text)
+    FROM {rows}
+'''
+
+
+def notify_rows(rows):
+    ''':return: the SQL of notify_rows_sql for the relation ``rows``'''
+    return notify_rows_sql.format(rows = rows)
+
+
+def payload(event, user_id, unit_id):
+    return json.dumps(dict(
+        event   = event,
+        user_id = str(user_id),
+        unit_id = str(unit_id),
+    ))
+
+
+def notify_query(event, user_id, unit_id):
+    ''':return: the SQL and parameters for notify()'''
+    return (notify_sql, (channel, payload(event, user_id, unit_id)))
+
+
+def notify(event, user_id, unit_id):
+    db.execute_sql(*notify_query(event, user_id, unit_id))
+
+
+def notify_units_query(event, unit_ids):
+    ''':return: the SQL and parameters for notify_units()'''
+    return (notify_units_sql, (channel, event, list(map(str, unit_ids))))
+
+
+def notify_units(event, unit_ids):
+    db.execute_sql(*notify_units_query(event, unit_ids))
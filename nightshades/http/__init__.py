@@ -1,9 +1,15 @@
 import os
+import json
+import time
+import logging
 
 from .api.v1 import api
+from nightshades import metrics, profiling, querystats
 from nightshades.models import db
 
-from flask import Flask
+from flask import Flask, Response, g, request, abort
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('NIGHTSHADES_APP_SECRET')
@@ -12,9 +18,69 @@ app.debug      = os.environ.get('ENVIRONMENT') == 'development'
 app.register_blueprint(api)
 
 
+@app.before_request
+def start_query_stats():
+    g.request_start = time.perf_counter()
+    g.query_stats   = querystats.start()
+
+
+@app.after_request
+def report_query_stats(response):
+    stats = g.get('query_stats', None)
+    if stats is None:
+        return response
+
+    querystats.stop(stats)
+    total_ms = (time.perf_counter() - g.request_start) * 1000
+    sql_ms   = stats.seconds * 1000
+
+    response.headers.add('Server-Timing', 'db;dur={:.2f};desc="{} queries"'.format(
+        sql_ms, stats.count))
+    response.headers.add('Server-Timing', 'total;dur={:.2f}'.format(total_ms))
+
+    logger.info(json.dumps({
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round(total_ms, 2),
+        'queries': stats.count,
+        'sql_ms': round(sql_ms, 2),
+        'slowest_sql': stats.slowest_sql,
+        'slowest_sql_ms': round(stats.slowest_seconds * 1000, 2),
+    }, sort_keys = True))
+
+    return response
+
+
+@app.teardown_request
+def stop_query_stats(exception):
+    stats = g.get('query_stats', None)
+    if stats is not None:
+        querystats.stop(stats)
+
+
+@app.route('/metrics')
+def show_metrics():
+    # Set NIGHTSHADES_METRICS_TOKEN to require it as a bearer token.
+    token = os.environ.get('NIGHTSHADES_METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        abort(404)
+
+    return Response(metrics.exposition(),
+                    mimetype = 'text/plain; version=0.0.4')
+
+
+# When pooling is enabled (see nightshades/session.py) closing the connection
+# hands it back to the pool rather than tearing it down.
 @app.teardown_appcontext
 def close_connection(exception):
     if not db.is_closed():
         db.close()
 
 from . import errorhandlers
+from . import profiles
+
+profiles.store = profiling.store_from_environ()
+if profiles.store is not None:
+    profiling.install(app, profiles.store)
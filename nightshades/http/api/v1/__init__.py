@@ -1,15 +1,38 @@
+import time
+
 import peewee
-from flask import Blueprint, jsonify, current_app
+from flask import Blueprint, jsonify, current_app, request, g
 
 api = Blueprint('api.v1', __name__, url_prefix='/v1')
 
 import nightshades
+from nightshades import metrics
 from nightshades.models import db
 from . import authentication
 from . import endpoints
+from . import stats
 from . import errors
 
 
+@api.before_request
+def start_timer():
+    g.api_request_start = time.perf_counter()
+
+
+@api.after_request
+def observe_latency(response):
+    start = g.get('api_request_start', None)
+    if start is not None:
+        metrics.http_request_duration.observe(
+            time.perf_counter() - start,
+            method   = request.method,
+            endpoint = request.endpoint or 'unknown',
+            status   = response.status_code,
+        )
+
+    return response
+
+
 @api.after_request
 def apply_cors(response):
     cors = current_app.config.get('CORS', False)
@@ -35,4 +58,5 @@ def handle_has_ongoing_unit(e):
 
 @api.errorhandler(nightshades.api.UsageError)
 def handle_invalid_api_usage(e):
-    return errors.InvalidAPIUsage.to_dict(e), getattr(e, 'status_code', 400)
+    status = getattr(e, 'status_code', 400)
+    return errors.json_error(status, e.message), status
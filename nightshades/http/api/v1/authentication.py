@@ -6,8 +6,8 @@ from flask import (
 )
 
 import nightshades
+import nightshades.tokens
 from . import api
-from . import errors
 
 
 def set_cookie(resp, key, value, **kwargs):
@@ -24,6 +24,17 @@ def set_jwt_cookie(resp, value, **kwargs):
     set_cookie(resp, 'jwt', value, **kwargs)
 
 
+def decode_token(token, secret = None):
+    '''See nightshades.tokens.decode_token.
+
+    :param secret: defaults to the app's secret key
+    '''
+    if secret is None:
+        secret = current_app.secret_key
+
+    return nightshades.tokens.decode_token(token, secret)
+
+
 def current_user_id():
     user_id = g.get('user_id', None)
     if user_id is not None:
@@ -36,29 +47,19 @@ def current_user_id():
     if not token:
         return False
 
-    try:
-        payload = jwt.decode(token, current_app.secret_key, algorithm = 'HS256')
-        if 'user_id' not in payload:
-            return False
+    user_id = decode_token(token)
+    if user_id:
+        g.user_id = user_id
 
-        g.user_id = payload['user_id']
-        return g.user_id
-    except:
-        raise errors.InvalidAPIUsage('Invalid Authorization token')
+    return user_id
 
 
 def login_or_register(provider, res):
-    try:
-        user_id = nightshades.api.login_via_provider(
-            provider,
-            res.get('provider_user_id')
-        ).get('id')
-    except:
-        user_id = nightshades.api.register_user(
-            res.get('provider_user_name'),
-            provider,
-            res.get('provider_user_id')
-        )
+    user_id = nightshades.api.login_or_register(
+        res.get('provider_user_name'),
+        provider,
+        res.get('provider_user_id')
+    )
 
     return jwt.encode(
         { 'user_id': str(user_id) },
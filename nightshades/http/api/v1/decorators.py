@@ -1,8 +1,9 @@
-from uuid import UUID
 from functools import wraps
 
-from flask import abort, request
+from flask import abort, request, make_response, g
 
+import nightshades
+import nightshades.jsonapi
 from .authentication import current_user_id
 from . import errors
 
@@ -11,9 +12,11 @@ def logged_in(func):
     @wraps(func)
     def wrapped(*args, **kwargs):
         try:
-            if not current_user_id():
-                raise
-        except:
+            user_id = current_user_id()
+        except errors.InvalidAPIUsage as e:
+            raise errors.Unauthorized(e.message)
+
+        if not user_id:
             raise errors.Unauthorized
 
         return func(*args, **kwargs)
@@ -24,9 +27,7 @@ def logged_in(func):
 def validate_uuid(func):
     @wraps(func)
     def wrapped(*args, **kwargs):
-        try:
-            UUID(kwargs['uuid'], version=4)
-        except ValueError:
+        if not nightshades.jsonapi.is_uuid(kwargs['uuid']):
             abort(404)
 
         return func(*args, **kwargs)
@@ -38,17 +39,35 @@ def validate_payload(type, attributes_required = False):
     def decorator(func):
         @wraps(func)
         def wrapped(*args, **kwargs):
-            payload = request.get_json()
-            if not payload or 'data' not in payload:
-                raise errors.InvalidAPIUsage('No data')
-
-            if payload['data'].get('type') != type:
-                raise errors.InvalidAPIUsage('Wrong type, expected {}'.format(type))
-
-            if attributes_required and not payload['data'].get('attributes', False):
-                raise errors.InvalidAPIUsage('No attributes given')
+            nightshades.jsonapi.validate_payload(
+                request.get_json(), type, attributes_required)
 
             return func(*args, **kwargs)
 
         return wrapped
     return decorator
+
+
+def etagged(func):
+    '''Give responses a weak ETag (see nightshades.jsonapi.etag) and answer
+    a matching If-None-Match with 304 before running the endpoint. The
+    user's revision and today are fetched with one query and left in
+    ``g.today`` for the endpoint. Must be applied after logged_in.
+    '''
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        g.today = nightshades.api.get_revision_and_today(g.user_id)
+        etag = nightshades.jsonapi.etag(g.user_id, g.today, request.full_path)
+
+        if request.if_none_match.contains_weak(etag):
+            resp = make_response('', 304)
+            resp.set_etag(etag, weak = True)
+            return resp
+
+        resp = make_response(func(*args, **kwargs))
+        if resp.status_code == 200:
+            resp.set_etag(etag, weak = True)
+
+        return resp
+
+    return wrapped
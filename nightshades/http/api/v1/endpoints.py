@@ -1,73 +1,48 @@
-import datetime
+import io
+import csv
+import json
 
 from . import api
 from . import errors
-from .decorators import logged_in, validate_uuid, validate_payload
+from .decorators import logged_in, validate_uuid, validate_payload, etagged
 
 import nightshades
-from flask import request, jsonify, url_for, g
+from nightshades import jsonapi
+from nightshades.jsonapi import (
+    add_date_meta, serialize_user_data, parse_date_arg, parse_bool_arg,
+    parse_page_args
+)
+from flask import request, jsonify, url_for, g, Response, stream_with_context
 
 
-def add_date_meta(obj):
-    if 'meta' not in obj:
-        obj['meta'] = {}
-
-    obj['meta']['date'] = datetime.datetime.now().isoformat()
-    return obj
+def url_for_unit(unit_id):
+    return url_for('.show_unit', uuid = unit_id)
 
 
 def serialize_unit_data(unit):
-    if type(unit) is not dict:
-        unit = { 'id': unit }
-
-    data = {
-        'type': 'unit',
-        'id': unit.get('id'),
-        'links': {
-            'self': url_for('.show_unit', uuid=unit.get('id'))
-        }
-    }
-
-    attrs = {
-        'expiry_threshold_seconds': nightshades.api.expiry_interval_seconds
-    }
-
-    if 'completed' in unit:
-        attrs['completed'] = unit.get('completed')
+    return jsonapi.serialize_unit_data(unit, url_for_unit)
 
-    if 'description' in unit:
-        attrs['description'] = unit.get('description')
 
-    if 'start_time' in unit:
-        attrs['start_time'] = unit.get('start_time').isoformat()
-
-    if 'expiry_time' in unit:
-        attrs['expiry_time'] = unit.get('expiry_time').isoformat()
-
-    tags = unit.get('tags', False)
-    if type(tags) is list:
-        attrs['tags'] = tags
-    elif type(tags) is str:
-        attrs['tags'] = tags.split(', ')
+@api.route('/me')
+@logged_in
+@etagged
+def me():
+    user = nightshades.api.get_user(g.user_id)
+    return jsonify(add_date_meta({ 'data': serialize_user_data(user) }))
 
-    if attrs:
-        data['attributes'] = attrs
 
-    return data
+@api.route('/me', methods=['PATCH'])
+@logged_in
+@validate_payload(type = 'user', attributes_required = True)
+def update_me():
+    attributes = request.get_json()['data']['attributes']
+    if 'timezone' not in attributes:
+        raise errors.InvalidAPIUsage('No operations to perform')
 
+    nightshades.api.set_timezone(g.user_id, attributes['timezone'])
 
-@api.route('/me')
-@logged_in
-def me():
     user = nightshades.api.get_user(g.user_id)
-    return jsonify(add_date_meta({
-        'data': {
-            'type': 'user',
-            'attributes': {
-                'name': user.get('name')
-            }
-        }
-    }))
+    return jsonify(add_date_meta({ 'data': serialize_user_data(user) }))
 
 
 @api.route('/units', methods=['DELETE'])
@@ -79,19 +54,101 @@ def delete_unit():
 
 @api.route('/units')
 @logged_in
+@etagged
 def index_units():
-    now = datetime.datetime.now()
-    beginning_of_today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    end_of_today = now.replace(hour=23, minute=59, second=59, microsecond=999999)
-
-    units = nightshades.api.get_units(g.user_id, beginning_of_today, end_of_today)
+    # Listings default to the user's today, by postgres' clock (see etagged).
+    date_a = parse_date_arg(request.args, 'filter[from]', g.today['start'])
+    date_b = parse_date_arg(request.args, 'filter[to]', g.today['end'])
+    size, after = parse_page_args(request.args)
+
+    tag     = request.args.get('filter[tag]', None)
+    expired = parse_bool_arg(request.args, 'filter[expired]')
+
+    # Fetch one extra unit to find out whether there is a next page.
+    units = list(nightshades.api.get_units(
+        g.user_id, date_a, date_b, limit = size + 1, after = after, tag = tag,
+        expired = expired))
+
+    args = {
+        'filter[from]': date_a.isoformat(),
+        'filter[to]': date_b.isoformat(),
+        'page[size]': size,
+    }
+    if tag:
+        args['filter[tag]'] = tag
+    if expired is not None:
+        args['filter[expired]'] = request.args['filter[expired]']
 
     ret = {}
-    ret['links'] = { 'self': url_for('.index_units') }
+    ret['links'] = { 'self': url_for('.index_units', **request.args.to_dict()) }
+    if len(units) > size:
+        units = units[:size]
+        args['page[after]'] = nightshades.api.encode_cursor(units[-1])
+        ret['links']['next'] = url_for('.index_units', **args)
+
     ret['data']  = list(map(serialize_unit_data, units))
     return jsonify(add_date_meta(ret))
 
 
+export_columns = (
+    'id', 'start_time', 'expiry_time', 'completed', 'description', 'tags',
+)
+
+
+def export_row(unit):
+    row = dict((k, unit.get(k)) for k in export_columns)
+    row['start_time']  = row['start_time'].isoformat()
+    row['expiry_time'] = row['expiry_time'].isoformat()
+    return row
+
+
+def export_ndjson(units):
+    for unit in units:
+        yield json.dumps(export_row(unit)) + '\n'
+
+
+def export_csv(units):
+    buf    = io.StringIO()
+    writer = csv.DictWriter(buf, export_columns)
+
+    def flush():
+        value = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return value
+
+    writer.writeheader()
+    yield flush()
+
+    for unit in units:
+        row = export_row(unit)
+        row['tags'] = ', '.join(row['tags'])
+        writer.writerow(row)
+        yield flush()
+
+
+export_formats = {
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+    'csv': (export_csv, 'text/csv'),
+}
+
+
+@api.route('/units/export')
+@logged_in
+def export_units():
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export_formats:
+        raise errors.InvalidAPIUsage('format must be one of {}'.format(
+            ', '.join(sorted(export_formats))))
+
+    serialize, mimetype = export_formats[fmt]
+    units = nightshades.api.iter_units(g.user_id)
+
+    resp = Response(stream_with_context(serialize(units)), mimetype = mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename=units.{}'.format(fmt)
+    return resp
+
+
 @api.route('/units', methods=['POST'])
 @logged_in
 @validate_payload(type='unit', attributes_required=True)
@@ -114,6 +171,7 @@ def create_unit():
 @api.route('/units/<uuid>')
 @logged_in
 @validate_uuid
+@etagged
 def show_unit(uuid):
     unit = nightshades.api.get_unit(uuid, user_id = g.user_id)
 
@@ -139,9 +197,7 @@ def update_unit(uuid):
         }))
 
     if attributes.get('completed', False):
-        res = nightshades.api.mark_complete(uuid, user_id = g.user_id)
-        if not res:
-            raise errors.InvalidAPIUsage('Unit is not yet complete or has already been marked complete')
+        nightshades.api.complete_unit(uuid, user_id = g.user_id)
 
         return jsonify(add_date_meta({
             'data': serialize_unit_data({
@@ -0,0 +1,91 @@
+import datetime
+
+from . import api
+from .decorators import logged_in
+
+import nightshades
+from nightshades.jsonapi import add_date_meta, parse_date_arg
+from flask import request, jsonify, url_for, g
+
+
+def stats_range():
+    now    = datetime.datetime.now(datetime.timezone.utc)
+    date_a = parse_date_arg(
+        request.args, 'filter[from]', now - datetime.timedelta(days = 30))
+    date_b = parse_date_arg(request.args, 'filter[to]', now)
+    return (date_a, date_b)
+
+
+def completion_ratio(row):
+    if not row['units']:
+        return 0
+
+    return row['completed'] / row['units']
+
+
+@api.route('/stats/totals')
+@logged_in
+def stats_totals():
+    date_a, date_b = stats_range()
+    period   = request.args.get('period', 'day')
+    timezone = request.args.get('timezone', 'UTC')
+
+    rows = nightshades.api.get_unit_totals(
+        g.user_id, date_a, date_b, period, timezone)
+
+    ret = {}
+    ret['links'] = { 'self': url_for('.stats_totals', **request.args.to_dict()) }
+    ret['data']  = [{
+        'type': 'unit-totals',
+        'id': '{}-{}'.format(period, row['period'].isoformat()),
+        'attributes': {
+            'period': period,
+            'start_date': row['period'].isoformat(),
+            'units': row['units'],
+            'completed': row['completed'],
+            'seconds': row['seconds'],
+            'completion_ratio': completion_ratio(row),
+        }
+    } for row in rows]
+
+    return jsonify(add_date_meta(ret))
+
+
+@api.route('/stats/tags')
+@logged_in
+def stats_tags():
+    date_a, date_b = stats_range()
+    rows = nightshades.api.get_tag_totals(g.user_id, date_a, date_b)
+
+    ret = {}
+    ret['links'] = { 'self': url_for('.stats_tags', **request.args.to_dict()) }
+    ret['data']  = [{
+        'type': 'tag-totals',
+        'id': row['tag'],
+        'attributes': {
+            'units': row['units'],
+            'completed': row['completed'],
+            'seconds': row['seconds'],
+            'completion_ratio': completion_ratio(row),
+        }
+    } for row in rows]
+
+    return jsonify(add_date_meta(ret))
+
+
+@api.route('/stats/streak')
+@logged_in
+def stats_streak():
+    timezone = request.args.get('timezone', 'UTC')
+    streak   = nightshades.api.get_streak(g.user_id, timezone)
+
+    started = streak['started']
+    return jsonify(add_date_meta({
+        'data': {
+            'type': 'streak',
+            'attributes': {
+                'days': streak['days'],
+                'started': started.isoformat() if started else None,
+            }
+        }
+    }))
@@ -0,0 +1,42 @@
+import io
+import pstats
+
+from flask import jsonify, request, abort, send_file, Response
+
+from nightshades import profiling
+from . import app
+
+# Set up by nightshades.http when NIGHTSHADES_PROFILE_DIR is set.
+store = None
+
+
+def require_profile_access():
+    # Answer as if there were nothing here unless profiling is on and the
+    # request carries a valid profiling token.
+    token = request.headers.get(profiling.header)
+    if store is None or not profiling.is_valid_token(token, app.secret_key):
+        abort(404)
+
+
+@app.route('/debug/profiles')
+def list_profiles():
+    require_profile_access()
+    return jsonify(profiles = store.list())
+
+
+@app.route('/debug/profiles/<name>')
+def show_profile(name):
+    require_profile_access()
+    path = store.path(name)
+    if path is None:
+        abort(404)
+
+    if request.args.get('format') != 'text':
+        return send_file(path, mimetype = 'application/octet-stream',
+                         as_attachment = True,
+                         attachment_filename = name + '.prof')
+
+    out   = io.StringIO()
+    stats = pstats.Stats(path, stream = out)
+    stats.sort_stats('cumulative').print_stats(50)
+    return Response(out.getvalue(), mimetype = 'text/plain')
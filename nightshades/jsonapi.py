@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+'''The parts of the v1 HTTP API that don't depend on a web framework, shared
+by the Flask app (nightshades.http) and the ASGI app (nightshades.asgi):
+serializing resources and errors, and validating payloads and query
+arguments.
+
+Invalid input raises `nightshades.api.ValidationError`, which both apps
+answer (like any `nightshades.api.UsageError`) with its status code, 400 by
+default, and the message as the error's title.
+'''
+import hashlib
+import datetime
+from uuid import UUID
+
+import iso8601
+
+from . import api
+
+default_page_size = 100
+max_page_size     = 500
+
+
+class InvalidAPIUsage(api.UsageError):
+    def __init__(self, message, status_code = 400):
+        api.UsageError.__init__(self, message)
+        self.status_code = status_code
+
+
+class Unauthorized(InvalidAPIUsage):
+    def __init__(self, message = 'Must be logged in'):
+        InvalidAPIUsage.__init__(self, message, 401)
+
+
+def error_document(status, title):
+    return {
+        'errors': [{
+            'status': status,
+            'title': title
+        }]
+    }
+
+
+def etag(user_id, state, full_path):
+    '''An ETag for a response to a user's request, which changes with their
+    revision (which every write to their units bumps). Send it as a weak
+    ETag: responses carry a fresh ``meta.date`` (see add_date_meta), so two
+    with the same ETag are equivalent but not byte-identical.
+
+    :param state: the user's revision and today, from
+                  `nightshades.api.get_revision_and_today`
+    :param str full_path: the path and query string of the request
+    '''
+    # The user's date is included since listings default to their today.
+    key = '{}:{}:{}:{}'.format(
+        user_id, state['revision'], full_path, state['date'])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def add_date_meta(obj):
+    if 'meta' not in obj:
+        obj['meta'] = {}
+
+    obj['meta']['date'] = datetime.datetime.now().isoformat()
+    return obj
+
+
+def serialize_unit_data(unit, url_for_unit):
+    ''':param url_for_unit: a function returning the URL of a unit given its
+                            ID
+    '''
+    if type(unit) is not dict:
+        unit = { 'id': unit }
+
+    data = {
+        'type': 'unit',
+        'id': str(unit.get('id')),
+        'links': {
+            'self': url_for_unit(unit.get('id'))
+        }
+    }
+
+    attrs = {
+        'expiry_threshold_seconds': api.expiry_interval_seconds
+    }
+
+    if 'completed' in unit:
+        attrs['completed'] = unit.get('completed')
+
+    if 'expired' in unit:
+        attrs['expired'] = unit.get('expired')
+
+    if 'description' in unit:
+        attrs['description'] = unit.get('description')
+
+    if 'start_time' in unit:
+        attrs['start_time'] = unit.get('start_time').isoformat()
+
+    if 'expiry_time' in unit:
+        attrs['expiry_time'] = unit.get('expiry_time').isoformat()
+
+    if 'tags' in unit:
+        attrs['tags'] = unit.get('tags')
+
+    data['attributes'] = attrs
+    return data
+
+
+def serialize_user_data(user):
+    return {
+        'type': 'user',
+        'attributes': {
+            'name': user.get('name'),
+            'timezone': user.get('timezone'),
+        }
+    }
+
+
+def validate_payload(payload, type, attributes_required = False):
+    '''Check that a request's JSON payload is a resource of the given type.'''
+    if not payload or 'data' not in payload:
+        raise api.ValidationError('No data')
+
+    if payload['data'].get('type') != type:
+        raise api.ValidationError('Wrong type, expected {}'.format(type))
+
+    if attributes_required and not payload['data'].get('attributes', False):
+        raise api.ValidationError('No attributes given')
+
+
+def is_uuid(value):
+    try:
+        UUID(value, version = 4)
+        return True
+    except ValueError:
+        return False
+
+
+def parse_date_arg(args, key, default):
+    ''':param args: the query arguments, a mapping of names to strings'''
+    value = args.get(key, None)
+    if value is None:
+        return default
+
+    try:
+        return iso8601.parse_date(value)
+    except iso8601.ParseError:
+        raise api.ValidationError('{} must be an ISO 8601 date'.format(key))
+
+
+def parse_bool_arg(args, key):
+    ''':return: True or False for ``true`` or ``false``, None if not given'''
+    value = args.get(key, None)
+    if value is None:
+        return None
+
+    if value not in ('true', 'false'):
+        raise api.ValidationError('{} must be true or false'.format(key))
+
+    return value == 'true'
+
+
+def parse_page_args(args):
+    ''':return: the page size and the cursor to continue after (or None)'''
+    try:
+        size = int(args.get('page[size]', default_page_size))
+    except ValueError:
+        raise api.ValidationError('page[size] must be an integer')
+
+    if not 0 < size <= max_page_size:
+        raise api.ValidationError(
+            'page[size] must be between 1 and {}'.format(max_page_size))
+
+    after = args.get('page[after]', None)
+    if after is not None:
+        try:
+            api.decode_cursor(after)
+        except api.ValidationError:
+            raise api.ValidationError(
+                'page[after] must be a cursor from a next link')
+
+    return (size, after)
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+'''Counters, gauges and histograms exposed in the Prometheus text format at
+``/metrics`` (see nightshades.http).
+
+Each process keeps its own values. When ``NIGHTSHADES_METRICS_DIR`` is set,
+processes also write them to a file of their own there, at most every
+``flush_seconds``, and exposition adds up the files of every process. This
+way pre-forked workers can be scraped through any one of them. Counters and
+histograms of workers that have exited still count. Gauges only count while
+their process is alive. Empty the directory when deploying.
+'''
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+from . import querystats
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+flush_seconds = 1
+
+# Seconds
+default_buckets = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+registry = []
+collectors = []
+lock = threading.RLock()
+last_flush = [0]
+
+
+class Metric(object):
+    def __init__(self, name, help, labels = ()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} takes the labels {}'.format(
+                self.name, ', '.join(self.labels)))
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+        maybe_flush()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    '''Values are the count in each bucket (not cumulative), then the
+    overflow count and the sum of the observations.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = default_buckets):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-2] += 1
+
+            counts[-1] += value
+
+        maybe_flush()
+
+
+def collector(func):
+    '''Register a function that sets gauges just before they are read.'''
+    collectors.append(func)
+    return func
+
+
+def collect():
+    for func in collectors:
+        func()
+
+
+def snapshot():
+    ''':return: this process' values as something JSON serializable'''
+    collect()
+    with lock:
+        return dict(
+            (metric.name, [[list(k), v] for k, v in metric.values.items()])
+            for metric in registry
+        )
+
+
+def directory():
+    return os.environ.get('NIGHTSHADES_METRICS_DIR')
+
+
+def flush():
+    '''Write this process' values to its file, if there is a directory. The
+    metrics are only a side effect of requests, so failing to write them is
+    logged rather than raised.
+    '''
+    path = directory()
+    if not path:
+        return
+
+    with lock:
+        # Even when writing fails, so as to only retry every flush_seconds.
+        last_flush[0] = time.monotonic()
+        filename = os.path.join(path, 'metrics-{}.json'.format(os.getpid()))
+        data     = json.dumps(dict(pid = os.getpid(), metrics = snapshot()))
+
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir = path, prefix = 'metrics-',
+                                       suffix = '.tmp')
+            with open(fd, 'w') as f:
+                f.write(data)
+
+            os.replace(tmp, filename)
+        except OSError as e:
+            logger.error('Could not write metrics to %s: %s', path, e)
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+
+def maybe_flush():
+    if not directory():
+        return
+
+    with lock:
+        if time.monotonic() - last_flush[0] >= flush_seconds:
+            flush()
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def add(metric, total, value):
+    if metric.type != 'histogram':
+        return total + value
+
+    return [a + b for a, b in zip(total, value)]
+
+
+def aggregate():
+    ''':return: dict of metric names to dicts of label values to the values
+                of every process
+    '''
+    path = directory()
+    if not path:
+        processes = [(True, snapshot())]
+    else:
+        flush()
+        processes = []
+        for name in os.listdir(path):
+            if not name.endswith('.json'):
+                continue
+
+            try:
+                with open(os.path.join(path, name)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            processes.append((is_alive(data['pid']), data['metrics']))
+
+    totals = dict((metric.name, {}) for metric in registry)
+    metrics = dict((metric.name, metric) for metric in registry)
+    for alive, values in processes:
+        for name, entries in values.items():
+            metric = metrics.get(name)
+            if metric is None or (metric.type == 'gauge' and not alive):
+                continue
+
+            for key, value in entries:
+                key = tuple(key)
+                if key in totals[name]:
+                    totals[name][key] = add(metric, totals[name][key], value)
+                else:
+                    totals[name][key] = value
+
+    return totals
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+def exposition():
+    ''':return: every metric, of every process, in the Prometheus text
+                exposition format
+    '''
+    totals = aggregate()
+    lines  = []
+    for metric in registry:
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+
+        for key, value in sorted(totals[metric.name].items()):
+            if metric.type != 'histogram':
+                lines.append('{}{} {}'.format(
+                    metric.name, format_labels(metric.labels, key),
+                    format_value(value)))
+                continue
+
+            cumulative = 0
+            bounds = list(metric.buckets) + [float('inf')]
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    metric.name,
+                    format_labels(metric.labels, key,
+                                  [('le', format_value(bound))]),
+                    format_value(cumulative)))
+
+            labels = format_labels(metric.labels, key)
+            lines.append('{}_sum{} {}'.format(
+                metric.name, labels, format_value(value[-1])))
+            lines.append('{}_count{} {}'.format(
+                metric.name, labels, format_value(cumulative)))
+
+    return '\n'.join(lines) + '\n'
+
+
+http_request_duration = Histogram(
+    'nightshades_http_request_duration_seconds',
+    'Time taken to respond to v1 API requests.',
+    ('method', 'endpoint', 'status'))
+
+db_query_duration = Histogram(
+    'nightshades_db_query_duration_seconds',
+    'Time taken by SQL statements.')
+
+db_pool_connections = Gauge(
+    'nightshades_db_pool_connections',
+    'Connections in the connection pool.',
+    ('state',))
+
+units_started = Counter(
+    'nightshades_units_started_total', 'Units started.')
+
+units_completed = Counter(
+    'nightshades_units_completed_total', 'Units completed.')
+
+units_cancelled = Counter(
+    'nightshades_units_cancelled_total', 'Units cancelled.')
+
+logins = Counter(
+    'nightshades_logins_total', 'Logins, and registrations, by provider.',
+    ('provider',))
+
+
+def observe_query(sql, seconds):
+    db_query_duration.observe(seconds)
+
+
+querystats.listeners.append(observe_query)
+
+
+@collector
+def collect_pool():
+    # Only pooled databases (see nightshades.session) have these.
+    if hasattr(db, '_in_use'):
+        db_pool_connections.set(len(db._in_use), state = 'in_use')
+        db_pool_connections.set(len(db._connections), state = 'idle')
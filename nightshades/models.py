@@ -1,7 +1,8 @@
 from playhouse.postgres_ext import DateTimeTZField
 from peewee import (
     Model, UUIDField, ForeignKeyField,
-    TextField, BooleanField, SQL
+    TextField, BooleanField, SQL,
+    DateField, IntegerField, BigIntegerField, CompositeKey
 )
 
 from . import connection
@@ -9,6 +10,40 @@ from . import connection
 
 db = connection()
 
+ONE_ONGOING_UNIT_CONSTRAINT = 'units_one_ongoing_per_user'
+
+# A user may only have one incomplete unit whose time range overlaps with
+# another. Since a new unit always starts at NOW(), this is the "one ongoing
+# unit per user" rule enforced by postgres itself. This requires the
+# btree_gist extension (see migration.py).
+one_ongoing_unit_exclusion = (
+    'EXCLUDE USING gist ('
+    'user_id WITH =, '
+    'tstzrange(start_time, expiry_time) WITH &&'
+    ') WHERE (NOT completed)'
+)
+
+# Indexes peewee can't express through Meta.indexes (partial indexes). These
+# are created by migration.py.
+partial_indexes = (
+    # Ongoing unit lookups only ever look at a user's incomplete units.
+    'CREATE INDEX IF NOT EXISTS units_incomplete_user_id_expiry_time '
+    'ON units (user_id, expiry_time) WHERE NOT completed',
+
+    # The expiry sweeper (nightshades.sweeper) only looks for units it has
+    # yet to mark expired.
+    'CREATE INDEX IF NOT EXISTS units_unexpired_expiry_time '
+    'ON units (expiry_time) WHERE NOT completed AND NOT expired',
+)
+
+# Indexes in Meta.indexes which were added after their table, and so aren't
+# made by create_tables() for existing databases. migration.py creates these
+# too.
+added_indexes = (
+    'CREATE INDEX IF NOT EXISTS units_user_id_start_time_id '
+    'ON units (user_id, start_time, id)',
+)
+
 
 class BaseModel(Model):
     class Meta:
@@ -21,6 +56,13 @@ class User(BaseModel):
     name       = TextField()
     created_at = DateTimeTZField(constraints = [SQL("DEFAULT NOW()")])
 
+    # Bumped whenever any of the user's units change, see
+    # nightshades.api.bump_revision.
+    revision   = BigIntegerField(default = 0, constraints = [SQL('DEFAULT 0')])
+
+    # A tz database name. "Today" for the user's listings is in this timezone.
+    timezone   = TextField(default = 'UTC', constraints = [SQL("DEFAULT 'UTC'")])
+
     class Meta:
         db_table = 'users'
 
@@ -48,17 +90,65 @@ class Unit(BaseModel):
     start_time  = DateTimeTZField(constraints = [SQL("DEFAULT NOW()")])
     expiry_time = DateTimeTZField(constraints = [SQL("DEFAULT NOW() + INTERVAL '25 minutes'")])
 
+    # Set by nightshades.sweeper once an incomplete unit is past its expiry
+    # threshold and can no longer be completed.
+    expired     = BooleanField(default = False, constraints = [SQL('DEFAULT false')])
+
     class Meta:
         db_table = 'units'
 
+        # Serves listings by user ordered by start_time (postgres can scan the
+        # index backwards for ORDER BY start_time DESC), date ranges and
+        # keyset pagination on (start_time, id).
+        indexes = (
+            (('user', 'start_time', 'id'), False),
+        )
+
+        constraints = [
+            SQL('CONSTRAINT {} {}'.format(
+                ONE_ONGOING_UNIT_CONSTRAINT, one_ongoing_unit_exclusion)),
+        ]
+
+
+class TagName(BaseModel):
+    '''Each distinct tag a user has used, stored once.'''
+    user = ForeignKeyField(User, on_delete = 'CASCADE')
+    name = TextField()
+
+    class Meta:
+        db_table = 'tag_names'
+
+        indexes = (
+            (('user', 'name'), True),
+        )
+
 
 class Tag(BaseModel):
-    unit   = ForeignKeyField(Unit, on_delete = 'CASCADE')
-    string = TextField()
+    unit     = ForeignKeyField(Unit, on_delete = 'CASCADE')
+    tag_name = ForeignKeyField(TagName, on_delete = 'CASCADE')
 
     class Meta:
         db_table = 'tags'
 
+        # The second index serves looking up the units with a given tag.
         indexes = (
-            (('unit', 'string'), True),
+            (('unit', 'tag_name'), True),
+            (('tag_name', 'unit'), False),
         )
+
+
+class DailyUnitRollup(BaseModel):
+    '''Per user, per (UTC) day totals of units, kept up to date by
+    nightshades.rollups. The row with a blank tag is the total of all units
+    that day, the others are per tag.
+    '''
+    user            = ForeignKeyField(User, on_delete = 'CASCADE')
+    day             = DateField()
+    tag             = TextField(default = '')
+    count           = IntegerField(default = 0)
+    completed_count = IntegerField(default = 0)
+    seconds         = BigIntegerField(default = 0)
+
+    class Meta:
+        db_table = 'daily_unit_rollups'
+        primary_key = CompositeKey('user', 'day', 'tag')
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+'''Opt-in cProfile profiling of individual requests to a WSGI app.
+
+A request is profiled if it carries a valid ``X-Nightshades-Profile`` header
+(see token()), or at random at ``NIGHTSHADES_PROFILE_SAMPLE_RATE`` (a
+fraction, 0 by default). Profiles are saved to ``NIGHTSHADES_PROFILE_DIR``,
+keeping the latest ``NIGHTSHADES_PROFILE_MAX_FILES``. Without a directory
+the middleware isn't installed at all. Requests for the saved profiles
+themselves (`excluded_paths`) are never profiled. Mint a header value with::
+
+    $ python -m nightshades.profiling token
+
+and read a saved profile with ``python -m pstats <file>``.
+'''
+import os
+import re
+import sys
+import json
+import time
+import random
+import cProfile
+import threading
+
+from itsdangerous import TimestampSigner, BadSignature
+
+header = 'X-Nightshades-Profile'
+environ_key = 'HTTP_' + header.upper().replace('-', '_')
+
+# Tokens are valid for this many seconds after being minted.
+token_max_age = 3600
+
+# Paths that are never profiled, since reading profiles needs the header
+# that requests a profile (see nightshades.http.profiles).
+excluded_paths = ('/debug/profiles',)
+
+
+def signer(secret):
+    return TimestampSigner(secret, salt = 'nightshades.profiling')
+
+
+def token(secret):
+    return signer(secret).sign(b'profile').decode('ascii')
+
+
+def is_valid_token(value, secret):
+    if not value or not secret:
+        return False
+
+    try:
+        signer(secret).unsign(value, max_age = token_max_age)
+        return True
+    except BadSignature:
+        return False
+
+
+class ProfileStore(object):
+    '''A directory of profiles, each a ``.prof`` file of pstats data with a
+    ``.json`` file describing the request, rotated to the latest
+    ``max_files``.
+    '''
+    def __init__(self, directory, max_files = 100):
+        self.directory = directory
+        self.max_files = max_files
+        self.lock      = threading.Lock()
+        os.makedirs(directory, exist_ok = True)
+
+    def name(self, meta):
+        path = re.sub(r'[^A-Za-z0-9]+', '_', meta['path']).strip('_')
+        return '{:.6f}-{}-{}-{}'.format(
+            meta['created'], os.getpid(), meta['method'], path[:60] or 'root')
+
+    def save(self, profile, meta):
+        name = self.name(meta)
+        base = os.path.join(self.directory, name)
+        profile.dump_stats(base + '.prof')
+        with open(base + '.json', 'w') as f:
+            json.dump(meta, f)
+
+        self.rotate()
+        return name
+
+    def names(self):
+        ''':return: names of the stored profiles, newest first'''
+        names = [f[:-len('.prof')] for f in os.listdir(self.directory)
+                 if f.endswith('.prof')]
+        return sorted(names, reverse = True)
+
+    def rotate(self):
+        with self.lock:
+            for name in self.names()[self.max_files:]:
+                for ext in ('.prof', '.json'):
+                    try:
+                        os.remove(os.path.join(self.directory, name + ext))
+                    except FileNotFoundError:
+                        pass
+
+    def path(self, name):
+        ''':return: the path of a stored profile, or None if there is none'''
+        if name not in self.names():
+            return None
+
+        return os.path.join(self.directory, name + '.prof')
+
+    def list(self):
+        profiles = []
+        for name in self.names():
+            try:
+                with open(os.path.join(self.directory, name + '.json')) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            meta['name'] = name
+            profiles.append(meta)
+
+        return profiles
+
+
+class ProfiledBody(object):
+    '''Wraps a response body to keep profiling while the server iterates
+    over it, without buffering it, until the server closes it.
+
+    :param done: called once the body is closed
+    '''
+    def __init__(self, body, profile, done):
+        self.body    = body
+        self.profile = profile
+        self.done    = done
+
+    def __iter__(self):
+        chunks = iter(self.body)
+        while True:
+            self.profile.enable()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.profile.disable()
+
+            yield chunk
+
+    def close(self):
+        self.profile.enable()
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.profile.disable()
+            self.done()
+
+
+class ProfilerMiddleware(object):
+    '''WSGI middleware profiling sampled or requested requests, from the
+    start of the app call to the end of the response body.
+    '''
+    def __init__(self, app, store, sample_rate = 0, secret = lambda: None):
+        self.app         = app
+        self.store       = store
+        self.sample_rate = sample_rate
+        self.secret      = secret
+
+    def should_profile(self, environ):
+        path = environ.get('PATH_INFO', '')
+        if any(path == p or path.startswith(p + '/') for p in excluded_paths):
+            return False
+
+        if environ_key in environ:
+            return is_valid_token(environ[environ_key], self.secret())
+
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.app(environ, start_response)
+
+        status = []
+
+        def profiled_start_response(s, headers, *args):
+            status.append(s)
+            return start_response(s, headers, *args)
+
+        profile = cProfile.Profile()
+        start   = time.perf_counter()
+
+        def done():
+            self.store.save(profile, dict(
+                created     = time.time(),
+                method      = environ.get('REQUEST_METHOD'),
+                path        = environ.get('PATH_INFO', ''),
+                query       = environ.get('QUERY_STRING', ''),
+                status      = status[-1] if status else None,
+                duration_ms = round((time.perf_counter() - start) * 1000, 2),
+                sampled     = environ_key not in environ,
+            ))
+
+        profile.enable()
+        try:
+            res = self.app(environ, profiled_start_response)
+        finally:
+            profile.disable()
+
+        return ProfiledBody(res, profile, done)
+
+
+def store_from_environ():
+    ''':return: a `ProfileStore` for ``NIGHTSHADES_PROFILE_DIR``, or None if
+                profiling isn't configured
+    '''
+    directory = os.environ.get('NIGHTSHADES_PROFILE_DIR')
+    if not directory:
+        return None
+
+    max_files = int(os.environ.get('NIGHTSHADES_PROFILE_MAX_FILES', 100))
+    return ProfileStore(directory, max_files)
+
+
+def install(app, store):
+    '''Wrap a Flask app's WSGI app with the profiler, sampling at
+    ``NIGHTSHADES_PROFILE_SAMPLE_RATE``.
+    '''
+    rate = float(os.environ.get('NIGHTSHADES_PROFILE_SAMPLE_RATE', 0))
+    app.wsgi_app = ProfilerMiddleware(
+        app.wsgi_app, store, rate, lambda: app.secret_key)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['token']:
+        sys.exit('Usage: python -m nightshades.profiling token')
+
+    from nightshades import load_dotenv
+    load_dotenv()
+
+    secret = os.environ.get('NIGHTSHADES_APP_SECRET')
+    if not secret:
+        sys.exit('NIGHTSHADES_APP_SECRET must be set')
+
+    print(token(secret))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+'''Counting and timing of the SQL sent through nightshades.models.db.
+
+Statements are only recorded while something is collecting them on the
+current thread::
+
+    with querystats.collect() as stats:
+        nightshades.api.get_units(user_id, date_a, date_b)
+
+    stats.count, stats.seconds, stats.slowest_sql
+
+nightshades.http collects for every request (see its Server-Timing header).
+'''
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+# Functions called with every statement and the seconds it took, whether or
+# not anything is collecting.
+listeners = []
+
+
+class QueryStats(object):
+    def __init__(self):
+        self.count           = 0
+        self.seconds         = 0.0
+        self.slowest_sql     = None
+        self.slowest_seconds = 0.0
+
+    def record(self, sql, seconds):
+        self.count   += 1
+        self.seconds += seconds
+        if self.slowest_sql is None or seconds > self.slowest_seconds:
+            self.slowest_sql     = sql
+            self.slowest_seconds = seconds
+
+
+def collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+
+    return _local.collectors
+
+
+def start():
+    ''':return: a new `QueryStats` recording this thread's statements until
+                it is passed to stop()
+    '''
+    stats = QueryStats()
+    collectors().append(stats)
+    return stats
+
+
+def stop(stats):
+    try:
+        collectors().remove(stats)
+    except ValueError:
+        pass
+
+
+@contextmanager
+def collect():
+    stats = start()
+    try:
+        yield stats
+    finally:
+        stop(stats)
+
+
+def record(sql, seconds):
+    for stats in getattr(_local, 'collectors', ()):
+        stats.record(sql, seconds)
+
+    for listener in listeners:
+        listener(sql, seconds)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''Maintenance of the daily_unit_rollups table.
+
+Every function in nightshades.api that changes a unit applies the change to
+the rollups in the same transaction. If they ever drift (or after units were
+written some other way) they can be rebuilt with::
+
+    $ python -m nightshades.rollups [user_id ...]
+'''
+import sys
+
+from .models import db
+
+# Rollups are bucketed by the day units start on in this timezone.
+timezone = 'UTC'
+
+# The unit's own row is counted under the blank tag (the daily total) and once
+# more under each of its tags. Only completed units count towards seconds.
+# ``units`` can be any relation with the units table's columns, such as the
+# RETURNING of an UPDATE in a CTE. Rows are summed first since ON CONFLICT can
+# only touch each rollup once per statement.
+upsert_sql = '''
+    INSERT INTO daily_unit_rollups
+        (user_id, day, tag, count, completed_count, seconds)
+    SELECT
+        units.user_id,
+        (units.start_time AT TIME ZONE 'UTC')::date,
+        unit_tags.tag,
+        SUM(%(count)s),
+        SUM(%(completed)s * units.completed::int),
+        SUM(%(completed)s * units.completed::int *
+            EXTRACT(EPOCH FROM units.expiry_time - units.start_time)::bigint)
+    FROM {units} AS units
+    CROSS JOIN LATERAL (
+        SELECT '' AS tag WHERE %(total)s
+        UNION ALL
+        SELECT tag_names.name FROM tags
+        JOIN tag_names ON tag_names.id = tags.tag_name_id
+        WHERE tags.unit_id = units.id
+    ) unit_tags
+    {where}
+    GROUP BY 1, 2, 3
+    ON CONFLICT (user_id, day, tag) DO UPDATE SET
+        count           = daily_unit_rollups.count + EXCLUDED.count,
+        completed_count =
+            daily_unit_rollups.completed_count + EXCLUDED.completed_count,
+        seconds         = daily_unit_rollups.seconds + EXCLUDED.seconds
+'''
+
+
+def upsert(units = 'units', where = ''):
+    '''SQL applying the units in ``units`` to the rollups, taking the
+    ``count``, ``completed`` and ``total`` parameters described in update().
+    '''
+    return upsert_sql.format(units = units, where = where)
+
+
+backfill_sql = '''
+    INSERT INTO daily_unit_rollups
+        (user_id, day, tag, count, completed_count, seconds)
+    SELECT
+        units.user_id,
+        (units.start_time AT TIME ZONE 'UTC')::date,
+        unit_tags.tag,
+        COUNT(*),
+        COUNT(*) FILTER (WHERE units.completed),
+        COALESCE(SUM(EXTRACT(EPOCH FROM units.expiry_time - units.start_time))
+                 FILTER (WHERE units.completed), 0)::bigint
+    FROM units
+    CROSS JOIN LATERAL (
+        SELECT '' AS tag
+        UNION ALL
+        SELECT tag_names.name FROM tags
+        JOIN tag_names ON tag_names.id = tags.tag_name_id
+        WHERE tags.unit_id = units.id
+    ) unit_tags
+    {where}
+    GROUP BY 1, 2, 3
+'''
+
+
+def update(unit_id, count, completed, total = True):
+    '''Add a unit to (or, with negative deltas, remove it from) the rollups
+    of the day it started on.
+
+    :param int count: change in the number of units
+    :param int completed: change in completed units, applied only if the
+                          unit is currently completed
+    :param bool total: whether to change the daily total as well as the
+                       rollups of the unit's current tags
+    '''
+    update_many([unit_id], count, completed, total)
+
+
+def update_many(unit_ids, count, completed, total = True):
+    '''Like update(), for many units at once.'''
+    db.execute_sql(*update_many_sql(unit_ids, count, completed, total))
+
+
+def update_many_sql(unit_ids, count, completed, total = True):
+    ''':return: the SQL and parameters for update_many()'''
+    sql = upsert(where = 'WHERE units.id = ANY(%(unit_ids)s::uuid[])')
+    return (sql, dict(
+        unit_ids  = list(map(str, unit_ids)),
+        count     = count,
+        completed = completed,
+        total     = total,
+    ))
+
+
+def backfill(user_ids = None):
+    '''Rebuild the rollups from the units table, for every user or just the
+    given ones.
+    '''
+    with db.atomic():
+        if user_ids is None:
+            db.execute_sql('DELETE FROM daily_unit_rollups')
+            db.execute_sql(backfill_sql.format(where = ''))
+            return
+
+        user_ids = list(map(str, user_ids))
+        db.execute_sql(
+            'DELETE FROM daily_unit_rollups WHERE user_id = ANY(%s::uuid[])',
+            (user_ids,))
+        db.execute_sql(
+            backfill_sql.format(where = 'WHERE units.user_id = ANY(%s::uuid[])'),
+            (user_ids,))
+
+
+if __name__ == '__main__':
+    backfill(sys.argv[1:] or None)
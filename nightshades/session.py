@@ -1,8 +1,72 @@
 import os
+import time
 import dotenv
 from playhouse.postgres_ext import PostgresqlExtDatabase
+from playhouse.pool import PooledPostgresqlExtDatabase
 from playhouse.db_url import parse
 
+from . import querystats
+
+
+class QueryStatsMixin(object):
+    '''Reports the time every statement takes to nightshades.querystats.'''
+    def execute_sql(self, sql, params = None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super(QueryStatsMixin, self).execute_sql(
+                sql, params, *args, **kwargs)
+        finally:
+            querystats.record(sql, time.perf_counter() - start)
+
+
+class InstrumentedDatabase(QueryStatsMixin, PostgresqlExtDatabase):
+    pass
+
+
+class HealthCheckedPooledDatabase(QueryStatsMixin, PooledPostgresqlExtDatabase):
+    '''A connection pool that, on checkout, discards connections that postgres
+    (or something in between) has silently dropped.
+    '''
+    def __init__(self, *args, **kwargs):
+        self.health_check = kwargs.pop('health_check', True)
+        PooledPostgresqlExtDatabase.__init__(self, *args, **kwargs)
+
+    def _is_closed(self, key, conn):
+        if PooledPostgresqlExtDatabase._is_closed(self, key, conn):
+            return True
+
+        if not self.health_check:
+            return False
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+        except Exception:
+            return True
+
+        return False
+
+
+def pool_options():
+    '''Connection pool settings from the environment. Pooling is only enabled
+    when ``NIGHTSHADES_POSTGRESQL_POOL_MAX_CONNECTIONS`` is set.
+    '''
+    max_connections = os.environ.get('NIGHTSHADES_POSTGRESQL_POOL_MAX_CONNECTIONS')
+    if not max_connections:
+        return None
+
+    stale_timeout = os.environ.get('NIGHTSHADES_POSTGRESQL_POOL_STALE_TIMEOUT')
+    health_check  = os.environ.get(
+        'NIGHTSHADES_POSTGRESQL_POOL_HEALTH_CHECK', 'true')
+
+    return dict(
+        max_connections = int(max_connections),
+        stale_timeout   = int(stale_timeout) if stale_timeout else None,
+        health_check    = health_check.lower() not in ('0', 'false', 'no'),
+    )
+
 
 def connection():
     k = 'NIGHTSHADES_POSTGRESQL_DB_URI'
@@ -14,7 +78,12 @@ def connection():
         autorollback = True
     ))
 
-    return PostgresqlExtDatabase(**opts)
+    pool = pool_options()
+    if pool:
+        opts.update(pool)
+        return HealthCheckedPooledDatabase(**opts)
+
+    return InstrumentedDatabase(**opts)
 
 
 def load_dotenv():
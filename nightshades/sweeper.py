@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+'''Marks units as expired the moment their expiry threshold passes (see
+nightshades.api.expiry_interval_seconds) and publishes an ``expired`` event
+for each, so that nothing has to poll for it. Run one of these::
+
+    $ python -m nightshades.sweeper
+
+Upcoming expiries are kept in a min-heap which is refilled every
+``refill_seconds`` from the units expiring within the next
+``horizon_seconds``. A unit is at least two minutes long and then has its
+threshold, so it is always picked up by a refill before it is due.
+'''
+import time
+import heapq
+import logging
+
+from . import api, events
+from .models import db
+
+refill_seconds  = 60
+horizon_seconds = 120
+batch_size      = 1000
+
+# Written against expiry_time alone so it can use the partial index on
+# unexpired units.
+upcoming_sql = '''
+    SELECT
+        id,
+        EXTRACT(EPOCH FROM expiry_time + %(grace)s * INTERVAL '1 second' - NOW())
+    FROM units
+    WHERE NOT completed AND NOT expired
+      AND expiry_time <= NOW() + %(until)s * INTERVAL '1 second'
+    ORDER BY expiry_time
+    LIMIT %(limit)s
+'''
+
+# Units that were completed or cancelled in the meantime are skipped.
+expire_sql = '''
+    WITH expired AS (
+        UPDATE units SET expired = true
+        WHERE id = ANY(%(unit_ids)s::uuid[])
+          AND NOT completed
+          AND NOT expired
+          AND expiry_time + %(grace)s * INTERVAL '1 second' < NOW()
+        RETURNING id, user_id
+    ), revision AS (
+        UPDATE users SET revision = revision + 1
+        WHERE id IN (SELECT user_id FROM expired)
+    )
+    SELECT expired.id, pg_notify(%(channel)s, json_build_object(
+        'event', %(event)s::text,
+        'user_id', expired.user_id,
+        'unit_id', expired.id
+    )::text)
+    FROM expired
+'''
+
+
+class Sweeper(object):
+    def __init__(self, clock = time.monotonic, sleep = time.sleep):
+        self.clock       = clock
+        self.sleep       = sleep
+        self.heap        = []
+        self.queued      = set()
+        self.next_refill = clock()
+
+    def refill(self):
+        '''Queue the units that will pass their expiry threshold within
+        ``horizon_seconds``, including any that already have.
+        '''
+        now  = self.clock()
+        rows = db.execute_sql(upcoming_sql, dict(
+            grace = api.expiry_interval_seconds,
+            until = horizon_seconds - api.expiry_interval_seconds,
+            limit = batch_size,
+        )).fetchall()
+
+        for unit_id, seconds in rows:
+            if unit_id not in self.queued:
+                heapq.heappush(self.heap, (now + float(seconds), unit_id))
+                self.queued.add(unit_id)
+
+        self.next_refill = now + refill_seconds
+
+        # There may be more units due before the next refill than were
+        # fetched, so come back once the last one fetched is due.
+        if len(rows) == batch_size:
+            self.next_refill = min(self.next_refill, now + float(rows[-1][1]))
+
+    def due(self):
+        ''':return: the IDs of the queued units which are due, dequeued'''
+        now      = self.clock()
+        unit_ids = []
+        while self.heap and self.heap[0][0] <= now:
+            _, unit_id = heapq.heappop(self.heap)
+            self.queued.discard(unit_id)
+            unit_ids.append(unit_id)
+
+        return unit_ids
+
+    def expire(self, unit_ids):
+        ''':return: the IDs of the units that were marked expired'''
+        with db.atomic():
+            rows = db.execute_sql(expire_sql, dict(
+                unit_ids = list(map(str, unit_ids)),
+                grace    = api.expiry_interval_seconds,
+                channel  = events.channel,
+                event    = events.EXPIRED,
+            )).fetchall()
+
+        return [unit_id for unit_id, _ in rows]
+
+    def run_once(self):
+        '''Refill the heap if it is time to and expire the units that are due.
+
+        :return: the number of seconds until there is more to do
+        '''
+        if self.clock() >= self.next_refill:
+            self.refill()
+
+        unit_ids = self.due()
+        if unit_ids:
+            expired = self.expire(unit_ids)
+            logging.info('Expired %d of %d due units', len(expired), len(unit_ids))
+
+        wake = self.next_refill
+        if self.heap:
+            wake = min(wake, self.heap[0][0])
+
+        return max(0, wake - self.clock())
+
+    def run(self):
+        while True:
+            self.sleep(self.run_once())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    Sweeper().run()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+'''Verifying the JWTs that log users in, shared by the Flask app
+(nightshades.http) and the ASGI app (nightshades.asgi).
+'''
+import time
+import hashlib
+
+import jwt
+
+from .cache import LRUCache
+from .jsonapi import InvalidAPIUsage
+
+# Verified tokens, keyed by a hash of the token and secret, mapped to their
+# user ID. Entries last at most token_cache_ttl seconds and never past the
+# token's own exp claim.
+token_cache     = LRUCache(max_size = 10000)
+token_cache_ttl = 300
+
+
+def token_cache_key(token, secret):
+    key = '{}:{}'.format(secret, token)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def decode_token(token, secret):
+    '''Verify a token and return the user ID in it (or False if there is
+    none), remembering the result for tokens seen recently.
+
+    :raises InvalidAPIUsage: if the token is invalid or expired
+    '''
+    key     = token_cache_key(token, secret)
+    user_id = token_cache.get(key)
+    if user_id is not None:
+        return user_id
+
+    try:
+        payload = jwt.decode(token, secret, algorithms = ['HS256'])
+    except jwt.InvalidTokenError:
+        raise InvalidAPIUsage('Invalid Authorization token')
+
+    if 'user_id' not in payload:
+        return False
+
+    ttl = token_cache_ttl
+    if 'exp' in payload:
+        ttl = min(ttl, payload['exp'] - time.time())
+
+    if ttl > 0:
+        token_cache.set(key, payload['user_id'], ex = ttl)
+
+    return payload['user_id']
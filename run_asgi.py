@@ -0,0 +1,18 @@
+import os
+import nightshades
+
+if __name__ == '__main__':
+    nightshades.load_dotenv()
+
+    # Find me in nightshades/asgi.py! Each worker is a separate process with
+    # its own connection pool, so the database sees up to
+    # workers * NIGHTSHADES_POSTGRESQL_POOL_MAX_CONNECTIONS connections.
+    import uvicorn
+    uvicorn.run(
+        'nightshades.asgi:app',
+        host          = os.environ.get('NIGHTSHADES_HOST', '0.0.0.0'),
+        port          = int(os.environ.get('NIGHTSHADES_PORT', 5000)),
+        workers       = int(os.environ.get('NIGHTSHADES_WORKERS', 1)),
+        proxy_headers = True,
+        lifespan      = 'on',
+    )
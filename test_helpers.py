@@ -1,6 +1,8 @@
 import unittest
+from contextlib import contextmanager
 
-from nightshades.models import db
+from nightshades import querystats
+from nightshades.models import db, Tag, TagName
 
 
 class Test(unittest.TestCase):
@@ -9,3 +11,34 @@ class Test(unittest.TestCase):
 
     def tearDown(self):
         db.connect()
+
+
+@contextmanager
+def max_queries(test, budget):
+    '''Fail ``test`` if the block sends more than ``budget`` statements.'''
+    with querystats.collect() as stats:
+        yield stats
+
+    test.assertLessEqual(stats.count, budget, 'Slowest query: {}'.format(
+        stats.slowest_sql))
+
+
+def run(coroutine):
+    '''Run a coroutine (of nightshades.aio or nightshades.asgi) to completion.'''
+    import asyncio
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def create_tag(unit, name):
+    try:
+        tag_name = TagName.get(TagName.user == unit.user, TagName.name == name)
+    except TagName.DoesNotExist:
+        tag_name = TagName.create(user = unit.user, name = name)
+
+    return Tag.create(unit = unit, tag_name = tag_name)
+
+
+def tag_names(*units):
+    return set(name for (name,) in TagName.select(TagName.name).join(Tag).where(
+        Tag.unit << units
+    ).tuples())
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 import datetime
 import random
+import tempfile
 import unittest
 import logging
+from unittest.mock import patch
 from uuid import UUID, uuid4
 
 import psycopg2
@@ -15,15 +18,49 @@ os.environ['NIGHTSHADES_DOTENV'] = '.test.env'
 from nightshades import load_dotenv
 load_dotenv()
 
-from nightshades import api
-from nightshades.models import User, Unit, LoginProvider, Tag
-from test_helpers import Test
+from nightshades import (
+    api, cache, events, metrics, profiling, querystats, rollups, sweeper
+)
+from nightshades.models import (
+    User, Unit, LoginProvider, Tag, TagName, DailyUnitRollup
+)
+from test_helpers import Test, create_tag, tag_names, run
+
+try:
+    import asyncio
+    from nightshades import aio
+except (ImportError, SyntaxError):
+    # It needs Python 3.5+ and requirements.aio.txt
+    aio = None
 
 class TestSession(unittest.TestCase):
     def test_connection_context(self):
         db = nightshades.connection()
         self.assertEqual(db.get_conn().status, psycopg2.extensions.STATUS_READY)
 
+    def test_pooled_connection(self):
+        env = {
+            'NIGHTSHADES_POSTGRESQL_POOL_MAX_CONNECTIONS': '2',
+            'NIGHTSHADES_POSTGRESQL_POOL_STALE_TIMEOUT': '300',
+        }
+        with patch.dict(os.environ, env):
+            db = nightshades.connection()
+
+        self.assertIsInstance(db, nightshades.session.HealthCheckedPooledDatabase)
+        self.assertEqual(db.max_connections, 2)
+        self.assertEqual(db.stale_timeout, 300)
+
+        conn = db.get_conn()
+        db.close()
+        self.assertEqual(db.get_conn(), conn,
+            msg='Closing should return the connection to the pool')
+        db.close()
+
+    def test_pool_disabled_by_default(self):
+        with patch.dict(os.environ):
+            os.environ.pop('NIGHTSHADES_POSTGRESQL_POOL_MAX_CONNECTIONS', None)
+            self.assertIsNone(nightshades.session.pool_options())
+
 
 class TestUserModel(Test):
     def test_can_create_user(self):
@@ -108,14 +145,14 @@ class TestTagModel(Test):
     def test_can_create_tag_model(self):
         user = User.create(name = 'Alice')
         unit = Unit.create(user = user)
-        tag = Tag.create(unit = unit, string = 'foobar')
+        tag = create_tag(unit, 'foobar')
         tag = Tag.get(Tag.id == tag.id)
-        self.assertEqual(tag.string, 'foobar')
+        self.assertEqual(tag.tag_name.name, 'foobar')
 
     def test_tags_deleted_on_unit_delete(self):
         user = User.create(name = 'Alice')
         unit = Unit.create(user = user)
-        tag = Tag.create(unit = unit, string = 'foobar')
+        tag = create_tag(unit, 'foobar')
         unit.delete_instance()
         with self.assertRaises(peewee.DoesNotExist):
             Tag.get(Tag.id == tag.id)
@@ -123,9 +160,20 @@ class TestTagModel(Test):
     def test_tags_are_unique(self):
         user = User.create(name = 'Alice')
         unit = Unit.create(user = user)
-        Tag.create(unit = unit, string = 'foobar')
+        create_tag(unit, 'foobar')
         with self.assertRaisesRegex(peewee.IntegrityError, 'duplicate key'):
-            Tag.create(unit = unit, string = 'foobar')
+            create_tag(unit, 'foobar')
+
+    def test_tag_names_are_shared(self):
+        user = User.create(name = 'Alice')
+        a = create_tag(Unit.create(user = user, completed = True), 'foobar')
+        b = create_tag(Unit.create(user = user, completed = True), 'foobar')
+        self.assertEqual(a.tag_name.id, b.tag_name.id)
+
+    def test_tag_names_are_per_user(self):
+        a = create_tag(Unit.create(user = User.create(name = 'Alice')), 'foobar')
+        b = create_tag(Unit.create(user = User.create(name = 'Ada')), 'foobar')
+        self.assertNotEqual(a.tag_name.id, b.tag_name.id)
 
 
 class TestGetUser(Test):
@@ -135,6 +183,60 @@ class TestGetUser(Test):
         self.assertEqual(res['name'], 'Alice')
 
 
+class TestTimezone(Test):
+    def test_defaults_to_utc(self):
+        user  = User.create(name = 'Alice')
+        today = api.get_today(user.id)
+        self.assertEqual(api.get_user(user.id)['timezone'], 'UTC')
+        # Compare instants, as start is in the session's TimeZone.
+        midnight = datetime.datetime.combine(
+            today['date'], datetime.time(0, tzinfo = datetime.timezone.utc))
+        self.assertEqual(today['start'], midnight)
+
+    def test_today_in_user_timezone(self):
+        user = User.create(name = 'Alice')
+        api.set_timezone(user.id, 'Pacific/Kiritimati')
+        today = api.get_today(user.id)
+
+        # UTC+14, so its days start at 10:00 UTC.
+        start = today['start'].astimezone(datetime.timezone.utc)
+        self.assertEqual((start.hour, start.minute), (10, 0))
+        self.assertEqual(
+            today['end'] - today['start'],
+            datetime.timedelta(days = 1, microseconds = -1))
+
+    def test_invalid_timezone(self):
+        user = User.create(name = 'Alice')
+        with self.assertRaises(api.ValidationError):
+            api.set_timezone(user.id, 'Mars/Olympus_Mons')
+
+    def test_set_timezone_bumps_revision(self):
+        user = User.create(name = 'Alice')
+        api.set_timezone(user.id, 'America/Toronto')
+        self.assertEqual(api.get_revision(user.id), 1)
+
+
+class TestRevision(Test):
+    def test_bumped_by_writes(self):
+        user = User.create(name = 'Alice')
+        self.assertEqual(api.get_revision(user.id), 0)
+
+        unit = api.start_unit(user.id)
+        api.set_tags(unit['id'], 'foo')
+        api.cancel_ongoing_unit(user.id)
+        self.assertEqual(api.get_revision(user.id), 3)
+
+    def test_bumped_by_complete_unit(self):
+        user = User.create(name = 'Alice')
+        unit = Unit.create(
+            user        = user,
+            start_time  = SQL("NOW() - INTERVAL '25 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 second'"))
+
+        api.complete_unit(unit.id)
+        self.assertEqual(api.get_revision(user.id), 1)
+
+
 class TestMarkComplete(Test):
     def test_can_mark_complete(self):
         user = User.create(name = 'Alice')
@@ -179,6 +281,56 @@ class TestMarkComplete(Test):
         self.assertTrue(Unit.get(Unit.id == unit.id).completed)
 
 
+class TestCompleteUnit(Test):
+    def test_not_found(self):
+        with self.assertRaises(api.UnitNotFound):
+            api.complete_unit(uuid4())
+
+    def test_other_users_unit(self):
+        user = User.create(name = 'Alice')
+        unit = Unit.create(
+            user        = user,
+            start_time  = SQL("NOW() - INTERVAL '25 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 second'"))
+
+        with self.assertRaises(api.UnitNotFound):
+            api.complete_unit(unit.id, user_id = User.create(name = 'Ada').id)
+
+        api.complete_unit(unit.id, user_id = user.id)
+        self.assertTrue(Unit.get(Unit.id == unit.id).completed)
+
+    def test_already_completed(self):
+        unit = Unit.create(user = User.create(name = 'Alice'), completed = True)
+        with self.assertRaises(api.UnitAlreadyCompleted):
+            api.complete_unit(unit.id)
+
+    def test_too_early(self):
+        unit = Unit.create(user = User.create(name = 'Alice'))
+        with self.assertRaises(api.UnitNotYetComplete):
+            api.complete_unit(unit.id)
+
+    def test_expired(self):
+        unit = Unit.create(
+            user        = User.create(name = 'Alice'),
+            start_time  = SQL("NOW() - INTERVAL '1 hour'"),
+            expiry_time = SQL("NOW() - INTERVAL '35 minutes'"))
+
+        with self.assertRaises(api.UnitExpired):
+            api.complete_unit(unit.id)
+
+
+    def test_marked_expired(self):
+        # The flag is final, whatever expiry_time says.
+        unit = Unit.create(
+            user        = User.create(name = 'Alice'),
+            start_time  = SQL("NOW() - INTERVAL '25 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 second'"),
+            expired     = True)
+
+        with self.assertRaises(api.UnitExpired):
+            api.complete_unit(unit.id)
+
+
 class TestOngoingUnit(Test):
     def test_ongoing_unit(self):
         user = User.create(name = 'Alice')
@@ -195,6 +347,299 @@ class TestOngoingUnit(Test):
             api.get_ongoing_unit(user.id)
 
 
+class FakeRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex = None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+class TestQueryStats(Test):
+    def test_collects_statements(self):
+        user = User.create(name = 'Alice')
+        with querystats.collect() as stats:
+            api.get_user(user.id)
+            api.get_revision(user.id)
+
+        self.assertEqual(stats.count, 2)
+        self.assertGreater(stats.seconds, 0)
+        self.assertIn('SELECT', stats.slowest_sql)
+
+    def test_nested_collectors(self):
+        user = User.create(name = 'Alice')
+        with querystats.collect() as outer:
+            api.get_user(user.id)
+            with querystats.collect() as inner:
+                api.get_user(user.id)
+
+        self.assertEqual((outer.count, inner.count), (2, 1))
+
+    def test_only_while_collecting(self):
+        stats = querystats.start()
+        querystats.stop(stats)
+        api.get_user(User.create(name = 'Alice').id)
+        self.assertEqual(stats.count, 0)
+
+
+class TestMetrics(Test):
+    def setUp(self):
+        Test.setUp(self)
+        self.registry = list(metrics.registry)
+
+    def tearDown(self):
+        metrics.registry[:] = self.registry
+        Test.tearDown(self)
+
+    def test_exposition(self):
+        counter = metrics.Counter('test_total', 'A test.', ('kind',))
+        counter.inc(kind = 'a')
+        counter.inc(2, kind = 'a "quoted"')
+
+        histogram = metrics.Histogram('test_seconds', 'A test.', buckets = (1, 2))
+        histogram.observe(0.5)
+        histogram.observe(1.5)
+        histogram.observe(3)
+
+        text = metrics.exposition()
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{kind="a"} 1.0', text)
+        self.assertIn('test_total{kind="a \\"quoted\\""} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 1.0', text)
+        self.assertIn('test_seconds_bucket{le="2.0"} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3.0', text)
+        self.assertIn('test_seconds_sum 5.0', text)
+        self.assertIn('test_seconds_count 3.0', text)
+
+    def test_wrong_labels(self):
+        counter = metrics.Counter('test_total', 'A test.', ('kind',))
+        with self.assertRaises(ValueError):
+            counter.inc(sort = 'a')
+
+    def test_aggregates_processes(self):
+        counter = metrics.Counter('test_total', 'A test.')
+        gauge   = metrics.Gauge('test_gauge', 'A test.')
+        counter.inc(3)
+        gauge.set(1)
+
+        with tempfile.TemporaryDirectory() as path:
+            # A worker that has exited: its counter still counts but its
+            # gauge doesn't.
+            with open(os.path.join(path, 'metrics-1.json'), 'w') as f:
+                json.dump({ 'pid': 2 ** 22 + 1, 'metrics': {
+                    'test_total': [[[], 4]],
+                    'test_gauge': [[[], 10]],
+                } }, f)
+
+            with patch.dict(os.environ, { 'NIGHTSHADES_METRICS_DIR': path }):
+                totals = metrics.aggregate()
+
+        self.assertEqual(totals['test_total'], { (): 7 })
+        self.assertEqual(totals['test_gauge'], { (): 1 })
+
+    def test_flush(self):
+        counter = metrics.Counter('test_total', 'A test.')
+        counter.inc(3)
+
+        with tempfile.TemporaryDirectory() as path:
+            with patch.dict(os.environ, { 'NIGHTSHADES_METRICS_DIR': path }):
+                metrics.flush()
+
+            filename = 'metrics-{}.json'.format(os.getpid())
+            self.assertEqual(os.listdir(path), [filename])
+            with open(os.path.join(path, filename)) as f:
+                data = json.load(f)
+
+        self.assertEqual(data['metrics']['test_total'], [[[], 3]])
+
+    def test_flush_errors_are_logged(self):
+        path = os.path.join(tempfile.gettempdir(), 'nightshades-missing')
+        with patch.dict(os.environ, { 'NIGHTSHADES_METRICS_DIR': path }), \
+                patch.object(metrics.logger, 'error') as error:
+            metrics.flush()
+            self.assertEqual(error.call_count, 1)
+
+            # Nor do they reach whatever was being counted.
+            with patch.object(metrics, 'last_flush', [0]):
+                metrics.Counter('test_total', 'A test.').inc()
+
+            self.assertEqual(error.call_count, 2)
+
+    def test_business_counters(self):
+        user  = User.create(name = 'Alice')
+        start = metrics.units_started.values.get((), 0)
+        api.start_unit(user.id)
+        api.cancel_ongoing_unit(user.id)
+        self.assertEqual(metrics.units_started.values[()], start + 1)
+        self.assertGreater(metrics.units_cancelled.values[()], 0)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.dir   = tempfile.TemporaryDirectory()
+        self.store = profiling.ProfileStore(self.dir.name, max_files = 2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def app(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'hello']
+
+    def call(self, middleware, headers = {}):
+        environ = { 'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/me' }
+        for key, value in headers.items():
+            environ['HTTP_' + key.upper().replace('-', '_')] = value
+
+        # Like a server: iterate over the body, then close it.
+        res = middleware(environ, lambda status, headers: None)
+        try:
+            return list(res)
+        finally:
+            if hasattr(res, 'close'):
+                res.close()
+
+    def test_token(self):
+        token = profiling.token('sekret')
+        self.assertTrue(profiling.is_valid_token(token, 'sekret'))
+        self.assertFalse(profiling.is_valid_token(token, 'other'))
+        self.assertFalse(profiling.is_valid_token('foo', 'sekret'))
+        self.assertFalse(profiling.is_valid_token(token, None))
+
+    def test_profiles_requests_with_token(self):
+        middleware = profiling.ProfilerMiddleware(
+            self.app, self.store, secret = lambda: 'sekret')
+
+        self.assertEqual(self.call(middleware), [b'hello'])
+        self.assertEqual(self.store.list(), [])
+
+        res = self.call(middleware, { profiling.header: 'foo' })
+        self.assertEqual(self.store.list(), [])
+
+        token = profiling.token('sekret')
+        res = self.call(middleware, { profiling.header: token })
+        self.assertEqual(res, [b'hello'])
+
+        profiles = self.store.list()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['path'], '/v1/me')
+        self.assertEqual(profiles[0]['status'], '200 OK')
+        self.assertFalse(profiles[0]['sampled'])
+        self.assertTrue(os.path.exists(self.store.path(profiles[0]['name'])))
+
+    def test_sampling(self):
+        middleware = profiling.ProfilerMiddleware(self.app, self.store, 1)
+        self.call(middleware)
+        self.assertTrue(self.store.list()[0]['sampled'])
+
+    def test_does_not_profile_reading_profiles(self):
+        middleware = profiling.ProfilerMiddleware(
+            self.app, self.store, secret = lambda: 'sekret')
+
+        token   = profiling.token('sekret')
+        environ = { 'REQUEST_METHOD': 'GET', 'PATH_INFO': '/debug/profiles',
+                    profiling.environ_key: token }
+        for path in ('/debug/profiles', '/debug/profiles/foo'):
+            environ['PATH_INFO'] = path
+            self.assertEqual(middleware(environ, lambda *args: None), [b'hello'])
+
+        self.assertEqual(self.store.list(), [])
+
+    def test_streams_the_body(self):
+        chunks = []
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            for chunk in (b'a', b'b'):
+                chunks.append(chunk)
+                yield chunk
+
+        middleware = profiling.ProfilerMiddleware(app, self.store, 1)
+        res = middleware({ 'REQUEST_METHOD': 'GET', 'PATH_INFO': '/v1/me' },
+                         lambda *args: None)
+
+        # Chunks are produced as they are asked for, and the profile is
+        # saved once the body is closed.
+        self.assertEqual(next(iter(res)), b'a')
+        self.assertEqual(chunks, [b'a'])
+        self.assertEqual(self.store.list(), [])
+
+        res.close()
+        self.assertEqual(self.store.list()[0]['status'], '200 OK')
+
+    def test_rotation(self):
+        middleware = profiling.ProfilerMiddleware(self.app, self.store, 1)
+        for i in range(3):
+            self.call(middleware)
+
+        self.assertEqual(len(self.store.names()), 2)
+        self.assertEqual(len(os.listdir(self.dir.name)), 4)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_expiry(self):
+        now   = [0]
+        lru   = cache.LRUCache(clock = lambda: now[0])
+        lru.set('foo', b'bar', ex = 5)
+        self.assertEqual(lru.get('foo'), b'bar')
+
+        now[0] = 5
+        self.assertIsNone(lru.get('foo'))
+
+    def test_eviction(self):
+        lru = cache.LRUCache(max_size = 2)
+        lru.set('a', b'1')
+        lru.set('b', b'2')
+        lru.get('a')
+        lru.set('c', b'3')
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), b'1')
+        self.assertEqual(lru.get('c'), b'3')
+
+
+class TestOngoingUnitCache(Test):
+    def setUp(self):
+        Test.setUp(self)
+        self.redis = FakeRedis()
+        self.previous = cache.backend
+        cache.configure(self.redis)
+
+    def tearDown(self):
+        cache.configure(self.previous)
+        Test.tearDown(self)
+
+    def test_populated_and_invalidated(self):
+        user = User.create(name = 'Alice')
+        with self.assertRaises(api.NoOngoingUnit):
+            api.get_ongoing_unit(user.id)
+
+        key = api.ongoing_unit_cache_key(user.id)
+        self.assertIn(key, self.redis.data)
+
+        unit = api.start_unit(user.id)
+        self.assertNotIn(key, self.redis.data)
+        self.assertEqual(api.get_ongoing_unit(user.id)['id'], unit['id'])
+
+        # Served from the cache from now on.
+        Unit.delete().where(Unit.id == unit['id']).execute()
+        self.assertEqual(api.get_ongoing_unit(user.id)['id'], unit['id'])
+
+    def test_invalidated_on_cancel(self):
+        user = User.create(name = 'Alice')
+        api.start_unit(user.id)
+        api.get_ongoing_unit(user.id)
+        api.cancel_ongoing_unit(user)
+        with self.assertRaises(api.NoOngoingUnit):
+            api.get_ongoing_unit(user.id)
+
+
 class TestStartUnit(Test):
     def test_fail_too_short(self):
         with self.assertRaisesRegex(api.ValidationError, 'at least'):
@@ -216,6 +661,20 @@ class TestStartUnit(Test):
         user = User.create(name = 'Alice')
         unit = api.start_unit(user.id, 1200, 'Homework!')
         self.assertIsInstance(unit.get('id'), UUID)
+        self.assertEqual(unit.get('description'), 'Homework!')
+        self.assertFalse(unit.get('completed'))
+
+    def test_start_unit_after_completed_unit(self):
+        user = User.create(name = 'Alice')
+        Unit.create(user = user, completed = True)
+        unit = api.start_unit(user.id)
+        self.assertIsInstance(unit.get('id'), UUID)
+
+    def test_ongoing_unit_enforced_by_database(self):
+        user = User.create(name = 'Alice')
+        Unit.create(user = user)
+        with self.assertRaisesRegex(peewee.IntegrityError, 'units_one_ongoing_per_user'):
+            Unit.create(user = user)
 
 
 class TestValidateTagCSV(Test):
@@ -249,20 +708,36 @@ class TestSetTags(Test):
     def test_set_tags(self):
         user = User.create(name = 'Alice')
         unit = Unit.create(user = user)
-        tag  = Tag.create(unit = unit, string = 'this should be deleted')
+        tag  = create_tag(unit, 'this should be deleted')
 
         tags = api.set_tags(unit.id, 'bar,baz,foo,bal,bee')
         self.assertIn('foo', tags)
         self.assertEqual(len(tags), 5)
 
-        res = list(Tag.select(Tag.string).where(Tag.unit == unit).tuples().execute())
-        self.assertNotIn((tag.string,), res)
+        res = tag_names(unit)
+        self.assertNotIn('this should be deleted', res)
         self.assertEqual(len(res), 5)
 
+    def test_reuses_existing_tag_names(self):
+        user = User.create(name = 'Alice')
+        a = Unit.create(
+            user        = user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '1 hour'"),
+            expiry_time = SQL("NOW() - INTERVAL '35 minutes'"))
+        b = Unit.create(user = user)
+        create_tag(a, 'foo')
+
+        tags = api.set_tags(b.id, 'foo,bar')
+        self.assertEqual(set(tags), set(('foo', 'bar')))
+        self.assertEqual(tag_names(b), set(('foo', 'bar')))
+        self.assertEqual(
+            TagName.select().where(TagName.user == user).count(), 2)
+
     def test_no_valid_tags(self):
         user = User.create(name = 'Alice')
         unit = Unit.create(user = user)
-        tag  = Tag.create(unit = unit, string = 'should not be deleted')
+        tag  = create_tag(unit, 'should not be deleted')
         with self.assertRaisesRegex(api.ValidationError, 'No valid tags'):
             api.set_tags(unit.id, 'a' * 41)
 
@@ -271,12 +746,74 @@ class TestSetTags(Test):
     def test_delete_on_blank_string(self):
         user = User.create(name = 'Alice')
         unit = Unit.create(user = user)
-        tag  = Tag.create(unit = unit, string = 'should be deleted')
+        tag  = create_tag(unit, 'should be deleted')
         res  = api.set_tags(unit.id, '')
         self.assertEqual(res, [])
         self.assertFalse(Tag.select().where(Tag.unit == unit).count())
 
 
+class TestSetTagsBulk(Test):
+    def test_set_tags_bulk(self):
+        user = User.create(name = 'Alice')
+        a = Unit.create(user = user, completed = True)
+        b = Unit.create(
+            user        = user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '1 hour'"),
+            expiry_time = SQL("NOW() - INTERVAL '35 minutes'"))
+        create_tag(a, 'old')
+        create_tag(b, 'old')
+
+        res = api.set_tags_bulk({ a.id: 'foo,bar', b.id: '' }, user_id = user.id)
+        self.assertEqual(set(res[str(a.id)]), set(('foo', 'bar')))
+        self.assertEqual(res[str(b.id)], [])
+
+        self.assertEqual(tag_names(a, b), set(('foo', 'bar')))
+
+    def test_unauthorized(self):
+        user = User.create(name = 'Alice')
+        a = Unit.create(user = user, completed = True)
+        b = Unit.create(user = User.create(name = 'Ada'))
+        create_tag(a, 'old')
+
+        with self.assertRaisesRegex(api.UsageError, 'Unauthorized'):
+            api.set_tags_bulk({ a.id: 'foo', b.id: 'foo' }, user_id = user.id)
+
+        self.assertEqual(tag_names(a), set(('old',)))
+
+    def test_locks_units(self):
+        user = User.create(name = 'Alice')
+        a = Unit.create(user = user, completed = True)
+        other = nightshades.connection().get_conn()
+        other.autocommit = True
+        locked = []
+
+        # By the time the old tags are read for the rollups, another
+        # transaction can't lock the unit.
+        def update_many(*args, **kwargs):
+            try:
+                other.cursor().execute(
+                    'SELECT 1 FROM units WHERE id = %s FOR UPDATE NOWAIT',
+                    (str(a.id),))
+                locked.append(False)
+            except psycopg2.OperationalError:
+                locked.append(True)
+
+        try:
+            with patch.object(rollups, 'update_many', update_many):
+                api.set_tags_bulk({ a.id: 'foo' }, user_id = user.id)
+        finally:
+            other.close()
+
+        self.assertEqual(locked, [True, True])
+
+    def test_invalid_tags(self):
+        user = User.create(name = 'Alice')
+        a = Unit.create(user = user, completed = True)
+        with self.assertRaisesRegex(api.ValidationError, 'No valid tags'):
+            api.set_tags_bulk({ a.id: 'a' * 41 })
+
+
 class TestGetUnits(Test):
     def test_get_units(self):
         user = User.create(name = 'Alice')
@@ -335,26 +872,388 @@ class TestGetUnits(Test):
             start_time = SQL("NOW() - INTERVAL '50 minutes'"),
             expiry_time = SQL("NOW() + INTERVAL '5 minutes'")
         )
-        Tag.create(unit = unit, string = 'foo')
-        Tag.create(unit = unit, string = 'bar')
+        create_tag(unit, 'foo')
+        create_tag(unit, 'bar')
 
         now = datetime.datetime.now()
         beginning_of_today = now.replace(hour=0, minute=0, second=0, microsecond=0)
         end_of_today = now.replace(hour=23, minute=59, second=59, microsecond=999999)
         res = list(api.get_units(user.id, beginning_of_today, end_of_today))
 
-        self.assertEqual(set(res[0].get('tags').split(', ')), set(('foo', 'bar',)))
-        self.assertIsNone(res[1].get('tags'), None)
+        self.assertEqual(set(res[0].get('tags')), set(('foo', 'bar',)))
+        self.assertEqual(res[1].get('tags'), [])
+
+
+    def test_get_units_paginated(self):
+        user = User.create(name = 'Alice')
+        units = []
+        for hours in range(1, 6):
+            units.append(Unit.create(
+                user        = user,
+                completed   = True,
+                start_time  = SQL("NOW() - INTERVAL '%s hours'", hours),
+                expiry_time = SQL("NOW() - INTERVAL '%s hours' + INTERVAL '25 minutes'", hours)))
+
+        date_a = datetime.datetime.now(datetime.timezone.utc)
+        date_b = date_a - datetime.timedelta(days = 1)
+
+        page = list(api.get_units(user.id, date_a, date_b, limit = 2))
+        self.assertEqual([u['id'] for u in page], [units[0].id, units[1].id])
+
+        after = api.encode_cursor(page[-1])
+        page = list(api.get_units(user.id, date_a, date_b, limit = 2, after = after))
+        self.assertEqual([u['id'] for u in page], [units[2].id, units[3].id])
+
+        after = api.encode_cursor(page[-1])
+        page = list(api.get_units(user.id, date_a, date_b, limit = 2, after = after))
+        self.assertEqual([u['id'] for u in page], [units[4].id])
+
+    def test_get_units_after_deleted_unit(self):
+        user = User.create(name = 'Alice')
+        units = []
+        for hours in range(1, 4):
+            units.append(Unit.create(
+                user        = user,
+                completed   = True,
+                start_time  = SQL("NOW() - INTERVAL '%s hours'", hours),
+                expiry_time = SQL("NOW() - INTERVAL '%s hours' + INTERVAL '25 minutes'", hours)))
+
+        date_a = datetime.datetime.now(datetime.timezone.utc)
+        date_b = date_a - datetime.timedelta(days = 1)
+
+        page  = list(api.get_units(user.id, date_a, date_b, limit = 1))
+        after = api.encode_cursor(page[-1])
+        units[0].delete_instance()
+
+        page = list(api.get_units(user.id, date_a, date_b, limit = 2, after = after))
+        self.assertEqual([u['id'] for u in page], [units[1].id, units[2].id])
+
+    def test_invalid_cursor(self):
+        user = User.create(name = 'Alice')
+        now  = datetime.datetime.now(datetime.timezone.utc)
+        with self.assertRaises(api.ValidationError):
+            api.get_units(user.id, now, now, after = str(uuid4()))
+
+
+    def test_get_units_with_tag(self):
+        user = User.create(name = 'Alice')
+        a = Unit.create(
+            user        = user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '2 hours'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 hour'"))
+        b = Unit.create(user = user)
+        create_tag(a, 'foo')
+        create_tag(b, 'foo')
+        create_tag(b, 'bar')
+
+        date_a = datetime.datetime.now(datetime.timezone.utc)
+        date_b = date_a - datetime.timedelta(days = 1)
+        res = list(api.get_units(user.id, date_a, date_b, tag = 'bar'))
+
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0]['id'], b.id)
+        self.assertEqual(set(res[0]['tags']), set(('foo', 'bar')))
+
+    def test_get_units_by_expired(self):
+        user = User.create(name = 'Alice')
+        expired = Unit.create(
+            user        = user,
+            start_time  = SQL("NOW() - INTERVAL '1 hour'"),
+            expiry_time = SQL("NOW() - INTERVAL '35 minutes'"),
+            expired     = True)
+        completed = Unit.create(
+            user        = user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '2 hours'"),
+            expiry_time = SQL("NOW() - INTERVAL '95 minutes'"))
+
+        date_a = datetime.datetime.now(datetime.timezone.utc)
+        date_b = date_a - datetime.timedelta(days = 1)
+
+        res = list(api.get_units(user.id, date_a, date_b, expired = True))
+        self.assertEqual([u['id'] for u in res], [expired.id])
+        self.assertTrue(res[0]['expired'])
+
+        res = list(api.get_units(user.id, date_a, date_b, expired = False))
+        self.assertEqual([u['id'] for u in res], [completed.id])
+
+
+class TestIterUnits(Test):
+    def test_iter_units(self):
+        user = User.create(name = 'Alice')
+        a = Unit.create(
+            user        = user,
+            completed   = True,
+            start_time  = SQL("NOW() - INTERVAL '2 hours'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 hour'"))
+        b = Unit.create(user = user)
+        create_tag(b, 'foo')
+
+        res = list(api.iter_units(user.id, itersize = 1))
+        self.assertEqual([u['id'] for u in res], [str(a.id), str(b.id)])
+        self.assertEqual(res[0]['tags'], [])
+        self.assertEqual(res[1]['tags'], ['foo'])
+
+
+class TestStats(Test):
+    def setUp(self):
+        Test.setUp(self)
+        self.user = User.create(name = 'Alice')
+        self.now  = datetime.datetime.now(datetime.timezone.utc)
+
+        # Two completed 25 minute units yesterday and one today, plus an
+        # incomplete one today.
+        for start in ("NOW() - INTERVAL '1 day 2 hours'",
+                      "NOW() - INTERVAL '1 day 1 hour'",
+                      "NOW() - INTERVAL '2 hours'"):
+            unit = Unit.create(
+                user        = self.user,
+                completed   = True,
+                start_time  = SQL(start),
+                expiry_time = SQL(start + " + INTERVAL '25 minutes'"))
+            create_tag(unit, 'work')
+
+        Unit.create(
+            user        = self.user,
+            start_time  = SQL("NOW() - INTERVAL '1 hour'"),
+            expiry_time = SQL("NOW() - INTERVAL '35 minutes'"))
+
+        rollups.backfill([self.user.id])
+
+    def test_unit_totals(self):
+        rows = api.get_unit_totals(
+            self.user.id, self.now - datetime.timedelta(days = 7), self.now)
+
+        self.assertEqual(sum(r['units'] for r in rows), 4)
+        self.assertEqual(sum(r['completed'] for r in rows), 3)
+        self.assertEqual(sum(r['seconds'] for r in rows), 3 * 1500)
+
+        # Rather than a Decimal, which jsonify can't serialize.
+        self.assertIs(type(rows[0]['seconds']), int)
+
+    def test_unit_totals_in_timezone(self):
+        rows = api.get_unit_totals(
+            self.user.id, self.now - datetime.timedelta(days = 7), self.now,
+            'week', 'America/Toronto')
+
+        self.assertEqual(sum(r['units'] for r in rows), 4)
+        self.assertEqual(sum(r['seconds'] for r in rows), 3 * 1500)
+
+    def test_unit_totals_invalid_period(self):
+        with self.assertRaisesRegex(api.ValidationError, 'Period'):
+            api.get_unit_totals(self.user.id, self.now, self.now, 'fortnight')
+
+    def test_unit_totals_invalid_timezone(self):
+        with self.assertRaisesRegex(api.ValidationError, 'timezone'):
+            api.get_unit_totals(self.user.id, self.now, self.now, 'day', 'Nowhere')
+
+    def test_tag_totals(self):
+        rows = api.get_tag_totals(
+            self.user.id, self.now - datetime.timedelta(days = 7), self.now)
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['tag'], 'work')
+        self.assertEqual(rows[0]['seconds'], 3 * 1500)
+        self.assertIs(type(rows[0]['seconds']), int)
+
+    def test_streak(self):
+        self.assertGreaterEqual(api.get_streak(self.user.id)['days'], 1)
+
+    def test_no_streak(self):
+        user = User.create(name = 'Ada')
+        self.assertEqual(api.get_streak(user.id), { 'days': 0, 'started': None })
+
+
+class TestRollups(Test):
+    def totals(self, user):
+        return list(DailyUnitRollup.select(
+            DailyUnitRollup.tag,
+            DailyUnitRollup.count,
+            DailyUnitRollup.completed_count,
+            DailyUnitRollup.seconds
+        ).where(
+            DailyUnitRollup.user == user
+        ).order_by(DailyUnitRollup.tag).tuples())
+
+    def test_rollups_follow_unit_lifecycle(self):
+        user = User.create(name = 'Alice')
+        unit = api.start_unit(user.id)
+        self.assertEqual(self.totals(user), [('', 1, 0, 0)])
+
+        api.set_tags(unit['id'], 'foo,bar')
+        self.assertEqual(self.totals(user), [
+            ('', 1, 0, 0), ('bar', 1, 0, 0), ('foo', 1, 0, 0)])
+
+        api.set_tags(unit['id'], 'foo')
+        self.assertEqual(self.totals(user), [
+            ('', 1, 0, 0), ('bar', 0, 0, 0), ('foo', 1, 0, 0)])
+
+        api.cancel_ongoing_unit(user.id)
+        self.assertEqual(self.totals(user), [
+            ('', 0, 0, 0), ('bar', 0, 0, 0), ('foo', 0, 0, 0)])
+
+    def test_rollups_on_mark_complete(self):
+        user = User.create(name = 'Alice')
+        unit = Unit.create(
+            user        = user,
+            start_time  = SQL("NOW() - INTERVAL '25 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 second'"))
+        create_tag(unit, 'foo')
+        rollups.backfill([user.id])
+
+        self.assertTrue(api.mark_complete(unit.id))
+        self.assertEqual(self.totals(user), [
+            ('', 1, 1, 1499), ('foo', 1, 1, 1499)])
+
+    def test_backfill_matches_incremental(self):
+        user = User.create(name = 'Alice')
+        unit = api.start_unit(user.id)
+        api.set_tags(unit['id'], 'foo,bar')
+        incremental = self.totals(user)
+
+        rollups.backfill([user.id])
+        self.assertEqual(self.totals(user), incremental)
+
+
+class TestEvents(Test):
+    def setUp(self):
+        Test.setUp(self)
+        self.conn = nightshades.connection().get_conn()
+        self.conn.autocommit = True
+        self.conn.cursor().execute('LISTEN {}'.format(events.channel))
+
+    def tearDown(self):
+        self.conn.close()
+        Test.tearDown(self)
+
+    def received(self):
+        self.conn.poll()
+        res = [json.loads(n.payload) for n in self.conn.notifies]
+        del self.conn.notifies[:]
+        return [(e['event'], e['unit_id']) for e in res]
+
+    def test_unit_lifecycle_events(self):
+        user = User.create(name = 'Alice')
+        unit = api.start_unit(user.id)
+        unit_id = str(unit['id'])
+        self.assertEqual(self.received(), [(events.STARTED, unit_id)])
+
+        api.set_tags(unit['id'], 'foo')
+        self.assertEqual(self.received(), [(events.TAGGED, unit_id)])
+
+        api.cancel_ongoing_unit(user.id)
+        self.assertEqual(self.received(), [(events.CANCELLED, unit_id)])
+
+    def test_completed_event(self):
+        user = User.create(name = 'Alice')
+        unit = Unit.create(
+            user        = user,
+            start_time  = SQL("NOW() - INTERVAL '25 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 second'"))
+
+        self.assertFalse(api.mark_complete(uuid4()))
+        self.assertTrue(api.mark_complete(unit.id))
+        self.assertEqual(self.received(), [(events.COMPLETED, str(unit.id))])
+
+    def test_no_completed_event_on_failure(self):
+        unit = Unit.create(user = User.create(name = 'Alice'))
+        with self.assertRaises(api.UnitNotYetComplete):
+            api.complete_unit(unit.id)
+
+        self.assertEqual(self.received(), [])
+
+    def test_no_event_for_rolled_back_changes(self):
+        user = User.create(name = 'Alice')
+        api.start_unit(user.id)
+        self.received()
+
+        with self.assertRaises(api.HasOngoingUnitAlready):
+            api.start_unit(user.id)
+
+        self.assertEqual(self.received(), [])
+
+    def test_expired_event(self):
+        user = User.create(name = 'Alice')
+        unit = Unit.create(
+            user        = user,
+            start_time  = SQL("NOW() - INTERVAL '1 hour'"),
+            expiry_time = SQL("NOW() - INTERVAL '30 minutes'"))
+
+        sweeper.Sweeper().run_once()
+        self.assertEqual(self.received(), [(events.EXPIRED, str(unit.id))])
+
+
+class TestSweeper(Test):
+    def create_unit(self, user, expired_ago, **kwargs):
+        return Unit.create(
+            user        = user,
+            start_time  = SQL("NOW() - INTERVAL '1 hour'"),
+            expiry_time = SQL("NOW() - INTERVAL '%s seconds'", expired_ago),
+            **kwargs)
+
+    def test_expires_units_past_threshold(self):
+        user     = User.create(name = 'Alice')
+        overdue  = self.create_unit(user, api.expiry_interval_seconds + 60)
+        grace    = self.create_unit(user, 60)
+        complete = self.create_unit(
+            user, api.expiry_interval_seconds + 60, completed = True)
+
+        revision = api.get_revision(user.id)
+        sweeper.Sweeper().run_once()
+
+        expired = dict((str(unit_id), value) for unit_id, value in Unit.select(
+            Unit.id, Unit.expired).where(Unit.user == user).tuples())
+        self.assertTrue(expired[str(overdue.id)])
+        self.assertFalse(expired[str(grace.id)])
+        self.assertFalse(expired[str(complete.id)])
+        self.assertEqual(api.get_revision(user.id), revision + 1)
+
+    def test_queues_units_until_due(self):
+        user  = User.create(name = 'Alice')
+        # Due in 30 seconds, within the horizon and before the next refill.
+        unit  = self.create_unit(user, api.expiry_interval_seconds - 30)
+        now   = [0]
+        sweep = sweeper.Sweeper(clock = lambda: now[0])
+
+        wait = sweep.run_once()
+        self.assertEqual(len(sweep.heap), 1)
+        self.assertAlmostEqual(wait, 30, delta = 5)
+        self.assertFalse(Unit.get(Unit.id == unit.id).expired)
+
+        unit.expiry_time = SQL("NOW() - INTERVAL '1 hour'")
+        unit.save()
+        now[0] += wait
+        sweep.run_once()
+        self.assertEqual(sweep.heap, [])
+        self.assertTrue(Unit.get(Unit.id == unit.id).expired)
+
+    def test_expire_only_once(self):
+        user  = User.create(name = 'Alice')
+        unit  = self.create_unit(user, api.expiry_interval_seconds + 60)
+        sweep = sweeper.Sweeper()
+
+        self.assertEqual(sweep.expire([uuid4()]), [])
+        self.assertEqual(list(map(str, sweep.expire([unit.id]))), [str(unit.id)])
+        self.assertEqual(sweep.expire([unit.id]), [])
 
 
 class TestGetUnit(Test):
     def test_get_unit_with_tags(self):
         user = User.create(name = 'Alice')
         unit = Unit.create(user = user)
-        Tag.create(unit = unit, string = 'foo')
+        create_tag(unit, 'foo')
+
+        res = api.get_unit(unit.id, user_id = user.id)
+        self.assertEqual(res.get('tags'), ['foo'])
+
+    def test_tags_containing_separator(self):
+        user = User.create(name = 'Alice')
+        unit = Unit.create(user = user)
+        create_tag(unit, 'foo, bar')
 
         res = api.get_unit(unit.id, user_id = user.id)
-        self.assertEqual(res.get('tags'), 'foo')
+        self.assertEqual(res.get('tags'), ['foo, bar'])
 
 
 class TestCancelOngoingUnit(Test):
@@ -390,6 +1289,238 @@ class TestLoginProvider(Test):
         with self.assertRaises(peewee.DoesNotExist):
             User.get(User.name == name).id
 
+    def test_login_or_register(self):
+        puid = uuid4()
+        user_id = api.login_or_register('Alice', 'twitter', puid)
+        self.assertIsInstance(user_id, UUID)
+        self.assertEqual(User.get(User.id == user_id).name, 'Alice')
+
+        self.assertEqual(api.login_or_register('Ada', 'twitter', puid), user_id)
+        self.assertEqual(api.login_via_provider('twitter', puid).get('id'), user_id)
+        self.assertFalse(User.select().where(User.name == 'Ada', User.id == user_id).count())
+
+    def test_login_or_register_existing_user(self):
+        puid = uuid4()
+        user_id = api.register_user('Alice', 'facebook', puid)
+        self.assertEqual(api.login_or_register('Alice', 'facebook', puid), user_id)
+
+    def test_login_or_register_invalid_provider(self):
+        with self.assertRaises(api.InvalidLoginProvider):
+            api.login_or_register('Alice', 'foobar', uuid4())
+
+@unittest.skipIf(aio is None, 'nightshades.aio is unavailable')
+class TestAio(Test):
+    '''Each function in nightshades.aio should give the same results as its
+    counterpart in nightshades.api.
+    '''
+    @classmethod
+    def tearDownClass(cls):
+        run(aio.close())
+
+    def create_completable_unit(self, user):
+        return Unit.create(
+            user        = user,
+            start_time  = SQL("NOW() - INTERVAL '25 minutes'"),
+            expiry_time = SQL("NOW() - INTERVAL '1 second'"))
+
+    def test_get_user(self):
+        user = User.create(name = 'Alice')
+        self.assertEqual(run(aio.get_user(user.id)), api.get_user(user.id))
+
+        with self.assertRaises(peewee.DoesNotExist):
+            run(aio.get_user(uuid4()))
+
+    def test_get_revision(self):
+        user = User.create(name = 'Alice')
+        api.bump_revision(user.id)
+        self.assertEqual(run(aio.get_revision(user.id)), api.get_revision(user.id))
+
+    def test_today(self):
+        user = User.create(name = 'Alice')
+        run(aio.set_timezone(user.id, 'Pacific/Kiritimati'))
+        self.assertEqual(api.get_user(user.id)['timezone'], 'Pacific/Kiritimati')
+        self.assertEqual(api.get_revision(user.id), 1)
+        self.assertEqual(run(aio.get_today(user.id)), api.get_today(user.id))
+
+        with self.assertRaises(api.ValidationError):
+            run(aio.set_timezone(user.id, 'Mars/Olympus_Mons'))
+
+    def test_start_unit(self):
+        user = User.create(name = 'Alice')
+        unit = run(aio.start_unit(user.id, 600, 'Writing'))
+        self.assertEqual(
+            unit, Unit.select().where(Unit.id == unit['id']).dicts().get())
+        self.assertEqual(unit['description'], 'Writing')
+        self.assertEqual(api.get_revision(user.id), 1)
+
+        with self.assertRaises(api.HasOngoingUnitAlready):
+            run(aio.start_unit(user.id))
+
+        with self.assertRaises(api.ValidationError):
+            run(aio.start_unit(User.create(name = 'Ada').id, 60))
+
+    def test_complete_unit(self):
+        user = User.create(name = 'Alice')
+        unit = self.create_completable_unit(user)
+
+        with self.assertRaises(api.UnitNotFound):
+            run(aio.complete_unit(unit.id, user_id = User.create(name = 'Ada').id))
+
+        run(aio.complete_unit(unit.id, user_id = user.id))
+        self.assertTrue(Unit.get(Unit.id == unit.id).completed)
+        self.assertEqual(api.get_revision(user.id), 1)
+
+        with self.assertRaises(api.UnitAlreadyCompleted):
+            run(aio.complete_unit(unit.id))
+
+        with self.assertRaises(api.UnitNotYetComplete):
+            run(aio.complete_unit(Unit.create(user = user).id))
+
+    def test_mark_complete(self):
+        user = User.create(name = 'Alice')
+        unit = self.create_completable_unit(user)
+        self.assertFalse(run(aio.mark_complete(uuid4())))
+        self.assertTrue(run(aio.mark_complete(unit.id)))
+        self.assertFalse(run(aio.mark_complete(unit.id)))
+
+    def test_set_tags(self):
+        user = User.create(name = 'Alice')
+        unit = Unit.create(user = user)
+        create_tag(unit, 'old')
+
+        tags = run(aio.set_tags(unit.id, 'foo,bar', user_id = user.id))
+        self.assertEqual(set(tags), set(('foo', 'bar')))
+        self.assertEqual(tag_names(unit), set(('foo', 'bar')))
+        self.assertEqual(api.get_revision(user.id), 1)
+
+        self.assertEqual(run(aio.set_tags(unit.id, '')), [])
+        self.assertEqual(tag_names(unit), set())
+
+        with self.assertRaisesRegex(api.UsageError, 'Unauthorized'):
+            run(aio.set_tags(unit.id, 'foo', user_id = User.create(name = 'Ada').id))
+
+        with self.assertRaisesRegex(api.ValidationError, 'No valid tags'):
+            run(aio.set_tags(unit.id, 'a' * 41))
+
+    def test_get_unit(self):
+        user = User.create(name = 'Alice')
+        unit = Unit.create(user = user)
+        create_tag(unit, 'foo')
+
+        self.assertEqual(
+            run(aio.get_unit(unit.id, user_id = user.id)),
+            api.get_unit(unit.id, user_id = user.id))
+
+        with self.assertRaises(peewee.DoesNotExist):
+            run(aio.get_unit(unit.id, user_id = User.create(name = 'Ada').id))
+
+    def test_get_units(self):
+        user = User.create(name = 'Alice')
+        for hours in range(1, 4):
+            unit = Unit.create(
+                user        = user,
+                completed   = True,
+                start_time  = SQL("NOW() - INTERVAL '%s hours'", hours),
+                expiry_time = SQL("NOW() - INTERVAL '%s hours' + INTERVAL '25 minutes'", hours))
+            create_tag(unit, 'foo')
+
+        date_a = datetime.datetime.now(datetime.timezone.utc)
+        date_b = date_a - datetime.timedelta(days = 1)
+        units  = run(aio.get_units(user.id, date_a, date_b))
+        self.assertEqual(units, list(api.get_units(user.id, date_a, date_b)))
+        self.assertEqual(len(units), 3)
+
+        after = api.encode_cursor(units[0])
+        self.assertEqual(
+            run(aio.get_units(user.id, date_a, date_b, limit = 1, after = after,
+                              tag = 'foo')),
+            list(api.get_units(user.id, date_a, date_b, limit = 1, after = after,
+                               tag = 'foo')))
+
+    def test_ongoing_unit(self):
+        user = User.create(name = 'Alice')
+        self.assertFalse(run(aio.has_ongoing_unit(user.id)))
+        with self.assertRaises(api.NoOngoingUnit):
+            run(aio.get_ongoing_unit(user.id))
+
+        unit = run(aio.start_unit(user.id))
+        self.assertTrue(run(aio.has_ongoing_unit(user.id)))
+        self.assertEqual(run(aio.get_ongoing_unit(user.id)), unit)
+
+        api.invalidate_ongoing_unit(user.id)
+        self.assertEqual(run(aio.get_ongoing_unit(user.id)),
+                         api.query_ongoing_unit(user.id).dicts().get())
+
+    def test_cancel_ongoing_unit(self):
+        user = User.create(name = 'Alice')
+        unit = run(aio.start_unit(user.id))
+        self.assertEqual(run(aio.cancel_ongoing_unit(user.id)), 1)
+        self.assertFalse(Unit.select().where(Unit.id == unit['id']).count())
+        self.assertFalse(api.has_ongoing_unit(user.id))
+        self.assertEqual(api.get_revision(user.id), 2)
+
+        with self.assertRaises(peewee.DoesNotExist):
+            run(aio.cancel_ongoing_unit(user.id))
+
+    def test_login_or_register(self):
+        puid    = uuid4()
+        user_id = run(aio.login_or_register('Alice', 'twitter', puid))
+        self.assertIsInstance(user_id, UUID)
+        self.assertEqual(api.login_or_register('Ada', 'twitter', puid), user_id)
+        self.assertEqual(run(aio.login_or_register('Ada', 'twitter', puid)), user_id)
+
+        with self.assertRaises(api.InvalidLoginProvider):
+            run(aio.login_or_register('Alice', 'foobar', uuid4()))
+
+    def test_add_new_provider(self):
+        user = User.create(name = 'Alice')
+        puid = str(uuid4())
+        run(aio.add_new_provider(user.id, 'facebook', puid))
+        self.assertEqual(api.login_via_provider('facebook', puid)['id'], user.id)
+
+
+@unittest.skipIf(aio is None, 'nightshades.aio is unavailable')
+class TestListener(Test):
+    def setUp(self):
+        Test.setUp(self)
+        self.listener = aio.Listener()
+
+    def tearDown(self):
+        run(self.listener.stop())
+        Test.tearDown(self)
+
+    def test_fans_out_to_users_subscribers(self):
+        alice = User.create(name = 'Alice')
+        ada   = User.create(name = 'Ada')
+
+        a = self.listener.subscribe(alice.id)
+        b = self.listener.subscribe(alice.id)
+        c = self.listener.subscribe(ada.id)
+        run(asyncio.wait_for(self.listener.listening.wait(), 5))
+
+        unit = run(aio.start_unit(alice.id))
+        for queue in (a, b):
+            self.assertEqual(run(asyncio.wait_for(queue.get(), 5)), {
+                'event': events.STARTED,
+                'user_id': str(alice.id),
+                'unit_id': str(unit['id']),
+            })
+
+        self.assertTrue(c.empty())
+
+    def test_unsubscribe(self):
+        user = User.create(name = 'Alice')
+
+        queue = self.listener.subscribe(user.id)
+        self.listener.unsubscribe(user.id, queue)
+        self.assertEqual(self.listener.subscribers, {})
+
+        # Nobody to deliver these to, and invalid payloads are dropped.
+        self.listener.publish(events.payload(events.STARTED, user.id, uuid4()))
+        self.listener.publish('foobar')
+        self.assertTrue(queue.empty())
+
+
 from http_tests import *
 
 if __name__ == '__main__':